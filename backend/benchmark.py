@@ -0,0 +1,335 @@
+"""Benchmarks for the analysis API.
+
+Runs server.py's FastAPI app in-process against an in-memory MongoDB
+(mongomock-motor) and a stub vision model that answers after a fixed delay,
+so results reflect this code rather than the network or the model.
+
+Usage (from the backend directory):
+    python benchmark.py [--concurrency 1,8,32] [--requests 200] [--model-latency 0.05]
+                        [--sizes 512,1024,2048,4096] [--only micro|endpoints]
+                        [--output results.json] [--compare baseline.json]
+
+Results are written as JSON (to stdout unless --output is given). With
+--compare, p95 latency and throughput are diffed against an earlier run.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from io import BytesIO
+
+os.environ.setdefault('EMERGENT_LLM_KEY', 'benchmark')
+# Uploads are stored as in production, but in a directory removed afterwards
+os.environ.setdefault('IMAGE_STORE_DIR', tempfile.mkdtemp(prefix='benchmark-images-'))
+
+import httpx
+from mongomock_motor import AsyncMongoMockClient
+from PIL import Image
+
+import server
+
+WARMUP_REQUESTS = 5
+PANEL_NAMES = ['bonnet', 'roof', 'left door', 'right door', 'front bumper', 'rear bumper', 'boot', 'wing']
+
+
+class StubLlmChat:
+    """Stands in for LlmChat: waits `latency` seconds, then answers with a valid response"""
+    
+    latency = 0.05
+    calls = 0
+    
+    def __init__(self, api_key, session_id, system_message):
+        self.system_message = system_message
+    
+    def with_model(self, provider, model):
+        return self
+    
+    async def send_message(self, message):
+        StubLlmChat.calls += 1
+        await asyncio.sleep(self.latency)
+        assessment = {
+            "car_color": "Red",
+            "condition": "Good",
+            "wash_or_repaint": "Wash",
+            "issues": ["Light dust accumulation"],
+            "recommendations": ["Regular washing recommended"],
+            "detailed_report": "The paintwork is in good condition apart from light dust."
+        }
+        if len(message.file_contents) == 1:
+            return json.dumps(assessment)
+        panels = [{"panel": f"panel {i}", **assessment} for i in range(len(message.file_contents))]
+        return json.dumps({"panels": panels, "vehicle": assessment})
+
+
+def encode_image(image: Image.Image, image_format: str) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def noise_image(width: int, height: int, seed: int) -> Image.Image:
+    """A bright, textured test image; different seeds give perceptually different images"""
+    rng = random.Random(seed)
+    coarse = Image.frombytes('RGB', (16, 12), bytes(rng.randrange(150, 256) for _ in range(16 * 12 * 3)))
+    return coarse.resize((width, height), Image.Resampling.BICUBIC)
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: list) -> dict:
+    ordered = sorted(latencies)
+    return {
+        'min_ms': round(ordered[0] * 1000, 3),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3)
+    }
+
+
+def run_micro_benchmarks(sizes: list, repeat: int) -> list:
+    """Time count_white_pixels across image sizes and encodings"""
+    results = []
+    for size in sizes:
+        image = noise_image(size, size * 3 // 4, seed=size)
+        for image_format in ('PNG', 'JPEG', 'BMP'):
+            data = encode_image(image, image_format)
+            server.count_white_pixels(data)
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                server.count_white_pixels(data, [200, 220, 240], {'grid': [3, 3]})
+                timings.append(time.perf_counter() - started)
+            
+            stats = summarize(timings)
+            megapixels = image.width * image.height / 1_000_000
+            results.append({
+                'benchmark': 'count_white_pixels',
+                'format': image_format,
+                'size': [image.width, image.height],
+                'encoded_bytes': len(data),
+                'repeat': repeat,
+                **stats,
+                'megapixels_per_second': round(megapixels / (stats['p50_ms'] / 1000), 2)
+            })
+            logging.info(
+                f"count_white_pixels {image_format} {image.width}x{image.height}: "
+                f"p50 {stats['p50_ms']}ms, {results[-1]['megapixels_per_second']} MP/s"
+            )
+    return results
+
+
+def endpoint_scenarios(total: int) -> dict:
+    """name -> factory returning (method, url, request kwargs) for the i-th request"""
+    photo = encode_image(noise_image(1024, 768, seed=1), 'JPEG')
+    # Distinct images so every request misses the byte and perceptual caches
+    unique_photos = [encode_image(noise_image(1024, 768, seed=1000 + i), 'JPEG') for i in range(total + WARMUP_REQUESTS)]
+    panels = [encode_image(noise_image(1024, 768, seed=i), 'JPEG') for i in range(2, 6)]
+    
+    def upload(data, name='photo.jpg'):
+        return {'files': {'file': (name, data, 'image/jpeg')}}
+    
+    return {
+        'white_pixels': lambda i: ('POST', '/api/analyze/white-pixels', upload(photo)),
+        'white_pixels_regions': lambda i: (
+            'POST', '/api/analyze/white-pixels', {**upload(photo), 'params': {'thresholds': '200,220,240', 'grid': '4x4'}}
+        ),
+        'bonnet_cached': lambda i: ('POST', '/api/analyze/bonnet', upload(photo)),
+        'bonnet_uncached': lambda i: ('POST', '/api/analyze/bonnet', upload(unique_photos[i])),
+        'vehicle': lambda i: (
+            'POST', '/api/analyze/vehicle',
+            {
+                'files': [('files', (f'panel{n}.jpg', data, 'image/jpeg')) for n, data in enumerate(panels)],
+                'params': {'panels': ','.join(PANEL_NAMES[:len(panels)])}
+            }
+        ),
+        'history': lambda i: ('GET', '/api/analysis/history', {'params': {'limit': 50}}),
+        'stats': lambda i: ('GET', '/api/analysis/stats', {'params': {'analysis_type': 'bonnet'}}),
+    }
+
+
+async def run_load(http: httpx.AsyncClient, factory, requests: int, concurrency: int, offset: int) -> dict:
+    """Send `requests` requests from `concurrency` concurrent workers"""
+    latencies = []
+    statuses = {}
+    next_index = iter(range(requests))
+    
+    async def worker():
+        for i in next_index:
+            method, url, kwargs = factory(offset + i)
+            started = time.perf_counter()
+            response = await http.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'elapsed_seconds': round(elapsed, 3),
+        'rps': round(requests / elapsed, 2),
+        'errors': sum(count for status, count in statuses.items() if status >= 400),
+        'status_codes': {str(status): count for status, count in sorted(statuses.items())},
+        **summarize(latencies)
+    }
+
+
+async def run_endpoint_benchmarks(concurrency_levels: list, requests: int, only: list) -> list:
+    """End-to-end latency and throughput of each endpoint through the ASGI app"""
+    scenarios = endpoint_scenarios(requests * len(concurrency_levels))
+    results = []
+    
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=None) as http:
+        for name, factory in scenarios.items():
+            if only and name not in only:
+                continue
+            
+            # Every scenario starts from an empty database and cold caches
+            server.db = AsyncMongoMockClient(tz_aware=True)[f'benchmark_{uuid.uuid4().hex}']
+            server.bonnet_cache = server.BonnetResultCache(
+                server.BONNET_CACHE_MAX_ENTRIES, server.BONNET_CACHE_MAX_BYTES, server.BONNET_CACHE_TTL_SECONDS
+            )
+            server.phash_index = server.PerceptualHashIndex(server.PHASH_MAX_DISTANCE)
+            
+            # Seed some analyses so the read endpoints have data to page through
+            if name in ('history', 'stats'):
+                photo = scenarios['bonnet_cached'](0)[2]
+                for _ in range(200):
+                    await http.post('/api/analyze/white-pixels', **photo)
+                    await http.post('/api/analyze/bonnet', **photo)
+            
+            offset = 0
+            await run_load(http, factory, WARMUP_REQUESTS, 1, offset)
+            offset += WARMUP_REQUESTS
+            
+            for concurrency in concurrency_levels:
+                calls_before = StubLlmChat.calls
+                result = await run_load(http, factory, requests, concurrency, offset)
+                offset += requests
+                result = {'scenario': name, **result, 'model_calls': StubLlmChat.calls - calls_before}
+                results.append(result)
+                logging.info(
+                    f"{name} x{concurrency}: {result['rps']} req/s, p50 {result['p50_ms']}ms, "
+                    f"p95 {result['p95_ms']}ms, p99 {result['p99_ms']}ms, {result['errors']} errors"
+                )
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(results: dict, baseline: dict):
+    """Log p95 latency and throughput changes against an earlier run"""
+    def keyed(run):
+        entries = {}
+        for entry in run.get('micro', []):
+            entries[('micro', entry['format'], tuple(entry['size']))] = entry
+        for entry in run.get('endpoints', []):
+            entries[(entry['scenario'], entry['concurrency'])] = entry
+        return entries
+    
+    def change(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else 'n/a'
+    
+    previous = keyed(baseline)
+    for key, entry in keyed(results).items():
+        old = previous.get(key)
+        if old is None:
+            continue
+        line = f"{' '.join(str(part) for part in key)}: p95 {old['p95_ms']} -> {entry['p95_ms']}ms ({change(entry['p95_ms'], old['p95_ms'])})"
+        if 'rps' in entry:
+            line += f", {old['rps']} -> {entry['rps']} req/s ({change(entry['rps'], old['rps'])})"
+        logging.info(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario and concurrency level')
+    parser.add_argument('--model-latency', type=float, default=0.05, help='seconds the stub model takes to answer')
+    parser.add_argument('--sizes', default='512,1024,2048,4096', help='image widths for the micro-benchmarks')
+    parser.add_argument('--repeat', type=int, default=10, help='runs per micro-benchmark')
+    parser.add_argument('--only', choices=['micro', 'endpoints'], help='run one group of benchmarks')
+    parser.add_argument('--scenarios', help='comma-separated endpoint scenarios to run (default: all)')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+    
+    # Progress goes to stderr, keep the server's per-request logs out of it
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr, force=True)
+    for name in ('server', 'httpx'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    
+    server.LlmChat = StubLlmChat
+    StubLlmChat.latency = args.model_latency
+    
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'image_workers': server.IMAGE_WORKERS,
+            'llm_max_concurrency': server.LLM_MAX_CONCURRENCY,
+            'vision_provider': server.VISION_PROVIDER,
+            'image_store': server.IMAGE_STORE,
+            'model_latency_seconds': args.model_latency
+        }
+    }
+    
+    try:
+        if args.only in (None, 'micro'):
+            sizes = [int(size) for size in args.sizes.split(',')]
+            results['micro'] = run_micro_benchmarks(sizes, args.repeat)
+        if args.only in (None, 'endpoints'):
+            levels = [int(level) for level in args.concurrency.split(',')]
+            only = args.scenarios.split(',') if args.scenarios else []
+            results['endpoints'] = asyncio.run(run_endpoint_benchmarks(levels, args.requests, only))
+    finally:
+        server.image_executor.shutdown(wait=False, cancel_futures=True)
+        server.batch_executor.shutdown(wait=False, cancel_futures=True)
+        if server.IMAGE_STORE_DIR.name.startswith('benchmark-images-'):
+            shutil.rmtree(server.IMAGE_STORE_DIR, ignore_errors=True)
+    
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp))
+    
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
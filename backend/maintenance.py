@@ -0,0 +1,187 @@
+"""Maintenance tasks for the analyses collection.
+
+Usage (from the backend directory):
+    python maintenance.py migrate-timestamps [--batch-size 1000] [--restart]
+    python maintenance.py rebuild-rollups [--since YYYY-MM-DD]
+    python maintenance.py gc-images [--grace-seconds 3600] [--dry-run]
+"""
+import argparse
+import asyncio
+from datetime import date, datetime, timezone
+
+from pymongo import UpdateOne
+
+from server import db, client, logger, collect_images, IMAGE_GC_GRACE_SECONDS, ROLLUPS_COLLECTION
+
+CHECKPOINTS = 'maintenance_checkpoints'
+
+
+async def load_checkpoint(task: str) -> dict:
+    return await db[CHECKPOINTS].find_one({"_id": task}) or {}
+
+
+async def save_checkpoint(task: str, **fields):
+    fields['updated_at'] = datetime.now(timezone.utc)
+    await db[CHECKPOINTS].update_one({"_id": task}, {"$set": fields}, upsert=True)
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse a legacy ISO timestamp string into an aware UTC datetime"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+async def migrate_timestamps(batch_size: int, restart: bool):
+    """Convert ISO string timestamps in `analyses` to native BSON dates.
+
+    Documents are walked in _id order and the last _id of every finished
+    batch is checkpointed, so an interrupted run resumes where it stopped.
+    """
+    task = 'migrate-timestamps'
+    checkpoint = {} if restart else await load_checkpoint(task)
+    last_id = checkpoint.get('last_id')
+    converted = checkpoint.get('converted', 0)
+    skipped = checkpoint.get('skipped', 0)
+    
+    if last_id is not None:
+        logger.info(f"Resuming timestamp migration after {last_id} ({converted} converted so far)")
+    
+    while True:
+        query = {"timestamp": {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        
+        batch = await db.analyses.find(query, {"_id": 1, "timestamp": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        
+        operations = []
+        for doc in batch:
+            try:
+                timestamp = parse_timestamp(doc['timestamp'])
+            except ValueError:
+                logger.error(f"Skipping analysis {doc['_id']} with unparseable timestamp {doc['timestamp']!r}")
+                skipped += 1
+                continue
+            # Only rewrite the value we read, in case the document changed meanwhile
+            operations.append(UpdateOne(
+                {"_id": doc['_id'], "timestamp": doc['timestamp']},
+                {"$set": {"timestamp": timestamp}}
+            ))
+        
+        if operations:
+            result = await db.analyses.bulk_write(operations, ordered=False)
+            converted += result.modified_count
+        
+        last_id = batch[-1]['_id']
+        await save_checkpoint(task, last_id=last_id, converted=converted, skipped=skipped)
+        logger.info(f"Converted {converted} timestamps ({skipped} skipped)")
+    
+    await save_checkpoint(task, completed=True, converted=converted, skipped=skipped)
+    logger.info(f"Timestamp migration finished: {converted} converted, {skipped} skipped")
+
+
+async def rebuild_rollups(since: date = None):
+    """Recompute the per-day rollups from `analyses` with an aggregation pipeline.
+
+    Without `since` the rollup collection is replaced wholesale via $out;
+    with it only buckets from that day onwards are recomputed and merged.
+    Documents with legacy string timestamps are ignored, migrate them first.
+    """
+    match = {"timestamp": {"$type": "date"}}
+    if since:
+        match["timestamp"]["$gte"] = datetime.combine(since, datetime.min.time(), timezone.utc)
+    
+    def regex_flag(field, pattern):
+        return {"$cond": [
+            {"$regexMatch": {"input": {"$ifNull": [field, ""]}, "regex": pattern, "options": "i"}}, 1, 0
+        ]}
+    
+    def bonnet_only(expression):
+        return {"$sum": {"$cond": ["$is_white_pixel", 0, expression]}}
+    
+    pipeline = [
+        {"$match": match},
+        {"$project": {
+            "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}},
+            "analysis_type": 1,
+            "car_color": {"$toLower": {"$trim": {"input": {"$ifNull": ["$car_color", ""]}}}},
+            "is_white_pixel": {"$eq": ["$analysis_type", "white_pixel"]},
+            "good": regex_flag("$condition", r"^\s*good"),
+            "bad": regex_flag("$condition", r"^\s*bad"),
+            "wash": {"$multiply": [
+                regex_flag("$wash_or_repaint", r"^\s*wash"),
+                {"$subtract": [1, regex_flag("$wash_or_repaint", "repaint")]}
+            ]},
+            "repaint": regex_flag("$wash_or_repaint", "repaint"),
+            "percentage": {"$ifNull": ["$percentage", 0]}
+        }},
+        {"$group": {
+            "_id": {"$concat": ["$day", "|", "$analysis_type", "|", "$car_color"]},
+            "day": {"$first": "$day"},
+            "analysis_type": {"$first": "$analysis_type"},
+            "car_color": {"$first": "$car_color"},
+            "count": {"$sum": 1},
+            "good": bonnet_only("$good"),
+            "bad": bonnet_only("$bad"),
+            "unknown_condition": bonnet_only({"$subtract": [1, {"$add": ["$good", "$bad"]}]}),
+            "wash": bonnet_only("$wash"),
+            "repaint": bonnet_only("$repaint"),
+            "unknown_action": bonnet_only({"$subtract": [1, {"$add": ["$wash", "$repaint"]}]}),
+            "bad_and_repaint": bonnet_only({"$multiply": ["$bad", "$repaint"]}),
+            "percentage_sum": {"$sum": {"$cond": ["$is_white_pixel", "$percentage", 0]}}
+        }}
+    ]
+    
+    if since:
+        pipeline.append({"$merge": {"into": ROLLUPS_COLLECTION, "whenMatched": "replace", "whenNotMatched": "insert"}})
+    else:
+        pipeline.append({"$out": ROLLUPS_COLLECTION})
+    
+    await db.analyses.aggregate(pipeline, allowDiskUse=True).to_list(None)
+    buckets = await db[ROLLUPS_COLLECTION].count_documents({})
+    logger.info(f"Rebuilt analysis rollups, {buckets} buckets")
+
+
+async def gc_images(grace_seconds: int, dry_run: bool):
+    """Recount image references and remove stored images no analysis uses"""
+    result = await collect_images(grace_seconds, dry_run)
+    verb = "Would remove" if dry_run else "Removed"
+    logger.info(
+        f"{verb} {result['deleted']} unreferenced images ({result['freed_bytes']} bytes), "
+        f"{result['recounted']} reference counts corrected"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    migrate = commands.add_parser('migrate-timestamps', help='store analysis timestamps as BSON dates')
+    migrate.add_argument('--batch-size', type=int, default=1000)
+    migrate.add_argument('--restart', action='store_true', help='ignore the saved checkpoint')
+    
+    rollups = commands.add_parser('rebuild-rollups', help='recompute the analysis statistics rollups')
+    rollups.add_argument('--since', type=date.fromisoformat, help='only recompute days from this date (YYYY-MM-DD)')
+    
+    images = commands.add_parser('gc-images', help='remove stored images no analysis refers to')
+    images.add_argument('--grace-seconds', type=int, default=IMAGE_GC_GRACE_SECONDS,
+                        help='keep images referenced within this many seconds')
+    images.add_argument('--dry-run', action='store_true', help='only report what would be removed')
+    
+    args = parser.parse_args()
+    try:
+        if args.command == 'migrate-timestamps':
+            asyncio.run(migrate_timestamps(args.batch_size, args.restart))
+        elif args.command == 'rebuild-rollups':
+            asyncio.run(rebuild_rollups(args.since))
+        elif args.command == 'gc-images':
+            asyncio.run(gc_images(args.grace_seconds, args.dry_run))
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
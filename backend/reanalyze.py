@@ -0,0 +1,283 @@
+"""Re-run analyses whose result came from an older analysis version.
+
+Walks `analyses` of one type in _id order, re-analyzes the stored image of
+every analysis not produced by the current version and writes the new
+result in place, keeping the replaced one under `previous_versions`. The
+last _id of every finished batch is checkpointed, so an interrupted run
+resumes where it stopped.
+
+The runner is meant to share MongoDB and the model quota with the live
+API, so it opens a small connection pool of its own and paces model calls
+independently of the API's limits.
+
+Usage (from the backend directory):
+    python reanalyze.py bonnet|white_pixel [--batch-size 50] [--concurrency 2] [--rate 1]
+                        [--limit N] [--force] [--restart] [--dry-run]
+"""
+import argparse
+import asyncio
+import os
+import re
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+# A handful of connections is plenty for batched reads and bulk writes
+os.environ.setdefault('MONGO_MAX_POOL_SIZE', os.environ.get('REANALYZE_MONGO_POOL_SIZE', '4'))
+os.environ.setdefault('MONGO_MIN_POOL_SIZE', '0')
+
+from fastapi import HTTPException
+from pymongo import UpdateOne
+
+import server
+from server import (
+    db, client, logger, analyze_bonnet_with_gpt4, bonnet_analysis_from_result, count_white_pixels,
+    describe_white_pixels, load_stored_image, run_in_image_pool, update_rollups,
+    BONNET_ANALYSIS_VERSION, WHITE_PIXEL_ANALYSIS_VERSION
+)
+from maintenance import load_checkpoint, save_checkpoint
+
+VERSIONS = {
+    'bonnet': BONNET_ANALYSIS_VERSION,
+    'white_pixel': WHITE_PIXEL_ANALYSIS_VERSION
+}
+
+# Result fields a re-analysis replaces; the others (id, image, timestamp) stay
+RESULT_FIELDS = {
+    'bonnet': [
+        'car_color', 'condition', 'wash_or_repaint', 'issues', 'recommendations', 'detailed_report',
+        'preprocessing', 'phash', 'duplicate_of', 'provider', 'confidence'
+    ],
+    'white_pixel': [
+        'white_pixel_count', 'total_pixels', 'percentage', 'analysis_result', 'thresholds', 'regions', 'sample_scale'
+    ]
+}
+# Fields that differ between runs without the result changing
+VOLATILE_FIELDS = {'preprocessing'}
+
+# Replaced results kept per analysis, oldest dropped first
+MAX_PREVIOUS_VERSIONS = int(os.environ.get('REANALYZE_MAX_PREVIOUS_VERSIONS', 5))
+
+GRID_REGION = re.compile(r'^r(\d+)c(\d+)$')
+
+
+def stored_regions(regions):
+    """The grid or ROI spec that produced an analysis' stored regions"""
+    if not regions:
+        return None
+    cells = [GRID_REGION.match(region['region']) for region in regions]
+    if all(cells):
+        return {'grid': [max(int(cell.group(1)) for cell in cells) + 1, max(int(cell.group(2)) for cell in cells) + 1]}
+    # ROI boxes were stored clipped to the image, which re-clipping leaves as they are
+    return {'roi': [[left, top, right - left, bottom - top] for left, top, right, bottom in (r['box'] for r in regions)]}
+
+
+async def reanalyze_bonnet(doc: dict, source) -> dict:
+    """Ask the vision model again, skipping the result cache and duplicate reuse"""
+    if isinstance(source, str):
+        source = await asyncio.to_thread(Path(source).read_bytes)
+    result = await analyze_bonnet_with_gpt4(source, doc['image_name'])
+    analysis = bonnet_analysis_from_result(doc['image_name'], result)
+    return analysis.model_dump(include=set(RESULT_FIELDS['bonnet']))
+
+
+async def reanalyze_white_pixels(doc: dict, source) -> dict:
+    """Count white pixels again with the thresholds and regions of the original request"""
+    thresholds = [count['threshold'] for count in doc.get('thresholds') or []] or None
+    # Images that were only countable at reduced scale are counted that way again
+    pixel_data = await run_in_image_pool(
+        count_white_pixels, source, thresholds, stored_regions(doc.get('regions')), bool(doc.get('sample_scale'))
+    )
+    return {
+        'white_pixel_count': pixel_data['white_pixel_count'],
+        'total_pixels': pixel_data['total_pixels'],
+        'percentage': pixel_data['percentage'],
+        'analysis_result': describe_white_pixels(pixel_data['percentage']),
+        'thresholds': pixel_data.get('thresholds'),
+        'regions': pixel_data.get('regions'),
+        'sample_scale': pixel_data.get('sample_scale')
+    }
+
+
+REANALYZERS = {
+    'bonnet': reanalyze_bonnet,
+    'white_pixel': reanalyze_white_pixels
+}
+
+
+def result_changed(analysis_type: str, old: dict, new: dict) -> bool:
+    return any(old.get(field) != new.get(field) for field in RESULT_FIELDS[analysis_type] if field not in VOLATILE_FIELDS)
+
+
+async def reanalyze_doc(analysis_type: str, doc: dict) -> tuple:
+    """(doc, new result or None, error or None) for one stored analysis"""
+    try:
+        source = await load_stored_image(doc['image_digest'])
+        if source is None:
+            return doc, None, "stored image is missing"
+        return doc, await REANALYZERS[analysis_type](doc, source), None
+    except HTTPException as e:
+        return doc, None, str(e.detail)
+    except Exception as e:
+        return doc, None, str(e)
+
+
+def reanalysis_update(analysis_type: str, version: str, doc: dict, result: dict, now: datetime) -> UpdateOne:
+    """Replace the result, keeping the old one, unless the analysis changed meanwhile"""
+    update = {"$set": {**result, "analysis_version": version, "reanalyzed_at": now}}
+    if result_changed(analysis_type, doc, result):
+        previous = {field: doc.get(field) for field in RESULT_FIELDS[analysis_type]}
+        previous.update(analysis_version=doc.get('analysis_version'), replaced_at=now)
+        update["$push"] = {"previous_versions": {"$each": [previous], "$slice": -MAX_PREVIOUS_VERSIONS}}
+    return UpdateOne({"_id": doc['_id'], "analysis_version": doc.get('analysis_version')}, update)
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+async def reanalyze(analysis_type: str, batch_size: int, concurrency: int, limit: int = None,
+                    force: bool = False, restart: bool = False, dry_run: bool = False):
+    """Re-analyze stored images of `analysis_type` analyses from older versions.
+
+    `concurrency` analyses run at once. Results that come out the same only
+    have their version bumped; changed ones push the old result onto
+    `previous_versions` and are moved between rollup buckets. Failures
+    (missing image, model error) are logged and skipped.
+    """
+    version = VERSIONS[analysis_type]
+    task = f"reanalyze-{analysis_type}-{version}" + ("-force" if force else "")
+    checkpoint = {} if restart or dry_run else await load_checkpoint(task)
+    if checkpoint.get('completed'):
+        logger.info(f"Re-analysis {task} already finished, use --restart to run it again")
+        return
+    last_id = checkpoint.get('last_id')
+    counts = {key: checkpoint.get(key, 0) for key in ('changed', 'unchanged', 'failed', 'skipped')}
+    
+    base_query = {
+        "analysis_type": analysis_type,
+        "image_digest": {"$type": "string"},
+        "status": {"$in": ["completed", None]}
+    }
+    if not force:
+        base_query["analysis_version"] = {"$ne": version}
+    
+    def batch_query():
+        query = dict(base_query)
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        return query
+    
+    remaining = await db.analyses.count_documents(batch_query())
+    total = min(remaining, limit) if limit else remaining
+    if last_id is not None:
+        logger.info(f"Resuming re-analysis after {last_id} ({sum(counts.values())} done so far)")
+    logger.info(f"Re-analyzing {total} {analysis_type} analyses to version {version}")
+    if dry_run or not total:
+        return
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def bounded(doc):
+        async with semaphore:
+            return await reanalyze_doc(analysis_type, doc)
+    
+    projection = ["_id", "id", "image_name", "image_digest", "analysis_type", "analysis_version", "timestamp",
+                  *RESULT_FIELDS[analysis_type]]
+    done = 0
+    started = time.monotonic()
+    while done < total:
+        size = min(batch_size, total - done)
+        batch = await db.analyses.find(batch_query(), projection).sort("_id", 1).limit(size).to_list(size)
+        if not batch:
+            break
+        
+        now = datetime.now(timezone.utc)
+        operations, replaced, replacements = [], [], []
+        for doc, result, error in await asyncio.gather(*(bounded(doc) for doc in batch)):
+            if error:
+                logger.error(f"Error re-analyzing {doc['id']}: {error}")
+                counts['failed'] += 1
+                continue
+            operations.append(reanalysis_update(analysis_type, version, doc, result, now))
+            if result_changed(analysis_type, doc, result):
+                replaced.append(doc)
+                replacements.append({**doc, **result})
+        
+        if operations:
+            written = await db.analyses.bulk_write(operations, ordered=False)
+            # Analyses rewritten or deleted while they were being re-analyzed keep their newer state
+            counts['skipped'] += len(operations) - written.matched_count
+            counts['changed'] += len(replaced)
+            counts['unchanged'] += written.matched_count - len(replaced)
+            if replaced and written.matched_count == len(operations):
+                try:
+                    await update_rollups(replaced, sign=-1)
+                    await update_rollups(replacements)
+                except Exception as e:
+                    logger.error(f"Error updating analysis rollups, run rebuild-rollups: {str(e)}")
+            elif replaced:
+                logger.warning("Some analyses changed during re-analysis, run rebuild-rollups afterwards")
+        
+        last_id = batch[-1]['_id']
+        done += len(batch)
+        await save_checkpoint(task, last_id=last_id, **counts)
+        
+        elapsed = time.monotonic() - started
+        rate = done / elapsed if elapsed else 0
+        eta = format_duration((total - done) / rate) if rate else "unknown"
+        logger.info(
+            f"Re-analyzed {done}/{total} ({rate:.2f}/s, ETA {eta}): {counts['changed']} changed, "
+            f"{counts['unchanged']} unchanged, {counts['failed']} failed, {counts['skipped']} skipped"
+        )
+    
+    # A run cut short by --limit leaves the rest for the next one
+    await save_checkpoint(task, completed=done >= remaining or not batch, **counts)
+    logger.info(
+        f"Re-analysis finished in {format_duration(time.monotonic() - started)}: {counts['changed']} changed, "
+        f"{counts['unchanged']} unchanged, {counts['failed']} failed, {counts['skipped']} skipped"
+    )
+
+
+async def run(args):
+    # Model calls get their own, smaller share of the quota than the live API
+    server.llm_scheduler = server.LlmScheduler(
+        max_concurrency=args.concurrency,
+        max_queue=args.batch_size,
+        queue_timeout=server.LLM_TIMEOUT_SECONDS * (server.LLM_MAX_RETRIES + 1),
+        rate_per_second=args.rate,
+        burst=args.concurrency,
+        timeout=server.LLM_TIMEOUT_SECONDS,
+        max_retries=server.LLM_MAX_RETRIES,
+        retry_base=server.LLM_RETRY_BASE_SECONDS
+    )
+    server.open_llm_session()
+    try:
+        await reanalyze(args.type, args.batch_size, args.concurrency, args.limit, args.force, args.restart, args.dry_run)
+    finally:
+        await server.close_llm_session()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('type', choices=sorted(VERSIONS), help='analysis type to re-run')
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=2, help='analyses re-run at once')
+    parser.add_argument('--rate', type=float, default=1, help='model calls per second, 0 for no limit')
+    parser.add_argument('--limit', type=int, help='stop after this many analyses')
+    parser.add_argument('--force', action='store_true', help='also re-run analyses from the current version')
+    parser.add_argument('--restart', action='store_true', help='ignore the saved checkpoint')
+    parser.add_argument('--dry-run', action='store_true', help='only count the analyses that would be re-run')
+    
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    finally:
+        client.close()
+        server.image_executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == '__main__':
+    main()
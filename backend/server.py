@@ -1,329 +1,3977 @@
-from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException
+from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional
 import uuid
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
+import re
 import base64
-from io import BytesIO
-from PIL import Image
+import copy
+import csv
+import hashlib
+import json
+import mmap
+import random
+import shutil
+import struct
+import sys
+import threading
+import tempfile
+import time
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from io import BytesIO, StringIO
+import httpx
+import numpy as np
+from PIL import Image, ImageChops, ImageOps
+from jsonschema import Draft202012Validator
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+# Parquet export is optional, it needs pyarrow installed
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 import asyncio
+import multiprocessing
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
 
+# emergentintegrations sends its model calls through litellm, which can be
+# handed one shared HTTP client instead of opening connections per call
+try:
+    import litellm
+except ImportError:
+    litellm = None
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ.get('DB_NAME', 'test_database')]
+# MongoDB connection, one pooled client shared by every request. Motor
+# connects lazily; the lifespan handler pings the server before serving
+mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 10))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 5 * 60 * 1000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+client = AsyncIOMotorClient(
+    mongo_url,
+    tz_aware=True,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS
+)
+db = client[os.environ.get('DB_NAME', 'test_database')]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open and warm the shared resources before serving, drain them on shutdown"""
+    await start_resources()
+    try:
+        yield
+    finally:
+        await stop_resources()
+
+
+# Create the main app without a prefix
+app = FastAPI(lifespan=lifespan)
+
+# Create a router with the /api prefix
+api_router = APIRouter(prefix="/api", default_response_class=ORJSONResponse)
+
+# Get API Key
+API_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# A pixel counts as white when its R, G and B values are all above this
+WHITE_THRESHOLD = 240
+
+# Recorded on white pixel analyses, changes with the white pixel rule
+WHITE_PIXEL_ANALYSIS_VERSION = hashlib.sha256(f"white>{WHITE_THRESHOLD}".encode('utf-8')).hexdigest()[:12]
+
+# Bounded worker pool for CPU-bound image work, keeps the event loop responsive
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', min(4, os.cpu_count() or 1)))
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='image-worker')
+
+
+# Limits on multi-threshold / per-region white pixel requests
+MAX_THRESHOLDS = 64
+MAX_REGIONS = 1024
+
+# Upload limits, enforced while the upload is read rather than after
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 25 * 1024 * 1024))
+MAX_ARCHIVE_BYTES = int(os.environ.get('MAX_ARCHIVE_BYTES', 512 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 50_000_000))
+UPLOAD_CHUNK_BYTES = 64 * 1024
+UPLOAD_HEADER_BYTES = 1024 * 1024
+
+# White pixel counting works in strips, so it accepts far larger images.
+# Uploads above SPOOL_UPLOAD_BYTES go to a temporary file instead of memory
+MAX_TILED_UPLOAD_BYTES = int(os.environ.get('MAX_TILED_UPLOAD_BYTES', 1024 * 1024 * 1024))
+MAX_TILED_IMAGE_PIXELS = int(os.environ.get('MAX_TILED_IMAGE_PIXELS', 1_000_000_000))
+SPOOL_UPLOAD_BYTES = int(os.environ.get('SPOOL_UPLOAD_BYTES', 32 * 1024 * 1024))
+TILE_MEMORY_BUDGET_BYTES = int(os.environ.get('TILE_MEMORY_BUDGET_BYTES', 256 * 1024 * 1024))
+
+# Working memory per pixel of a strip: raw rows, decoded strip, RGB copy,
+# three bands and the channel minimum
+STRIP_BYTES_PER_PIXEL = 16
+
+# PNGs too large to decode whole are inflated strip by strip. Row filters
+# work on whole pixels, so a strip is unfiltered by PIL as an 8-bit image
+# with the same bytes per pixel: (color type, mode) by bytes per pixel
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+PNG_BYTE_VIEWS = {1: (0, 'L'), 2: (4, 'LA'), 3: (2, 'RGB'), 4: (6, 'RGBA')}
+PNG_READ_BYTES = 1024 * 1024
+
+# JPEGs too large to decode whole can be counted at 1/2, 1/4 or 1/8 scale
+JPEG_SAMPLE_SCALES = (2, 4, 8)
+
+# PIL's decompression-bomb guard keeps its default; paths that accept more
+# pixels raise it while opening an image, see pil_pixel_limit
+PIL_MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS
+pil_pixel_limits = Counter()
+pil_pixel_limits_lock = threading.Lock()
+
+# Magic numbers of the formats we accept, checked on the first chunk
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'BM', 'BMP'),
+    (b'II*\x00', 'TIFF'),
+    (b'MM\x00*', 'TIFF'),
+    (b'PK\x03\x04', 'ZIP'),
+]
+IMAGE_FORMATS = {'JPEG', 'PNG', 'GIF', 'BMP', 'TIFF', 'WEBP'}
+
+# Analyses older than this are removed by a TTL index, 0 keeps them forever
+ANALYSIS_RETENTION_DAYS = int(os.environ.get('ANALYSIS_RETENTION_DAYS', 0))
+RETENTION_INDEX_NAME = 'analyses_retention'
+
+# Analyzed uploads are kept once per content digest, with a thumbnail, in
+# IMAGE_STORE: 'disk' (under IMAGE_STORE_DIR), 'gridfs' or 'none'
+IMAGE_STORE = os.environ.get('IMAGE_STORE', 'disk')
+IMAGE_STORE_DIR = Path(os.environ.get('IMAGE_STORE_DIR', ROOT_DIR / 'image_store'))
+IMAGE_STORE_BUCKET = 'images'
+IMAGE_REFS_COLLECTION = 'image_refs'
+IMAGE_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+IMAGE_CHUNK_BYTES = 256 * 1024
+IMAGE_CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+    'BMP': 'image/bmp',
+    'TIFF': 'image/tiff',
+    'WEBP': 'image/webp'
+}
+THUMBNAIL_EDGE = int(os.environ.get('THUMBNAIL_EDGE', 256))
+THUMBNAIL_QUALITY = 80
+
+# Stored images are content-addressed and never change
+IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Images no analysis refers to any more (deleted, or expired by the retention
+# index) are removed by a periodic sweep once unreferenced for the grace period
+IMAGE_GC_INTERVAL_SECONDS = int(os.environ.get('IMAGE_GC_INTERVAL_SECONDS', 60 * 60))
+IMAGE_GC_GRACE_SECONDS = int(os.environ.get('IMAGE_GC_GRACE_SECONDS', 60 * 60))
+# Uploads of an image the sweep is deleting wait up to IMAGE_GC_WAIT_SECONDS
+# for it to finish; a claim left by a sweep that died expires after this long
+IMAGE_GC_CLAIM_SECONDS = 60
+IMAGE_GC_WAIT_SECONDS = 5
+
+# Per-day rollups of analysis outcomes, maintained on every write
+ROLLUPS_COLLECTION = 'analysis_rollups'
+ROLLUP_COUNTERS = [
+    'count', 'good', 'bad', 'unknown_condition', 'wash', 'repaint', 'unknown_action',
+    'bad_and_repaint', 'percentage_sum'
+]
+GOOD_CONDITION = re.compile(r'^\s*good', re.IGNORECASE)
+BAD_CONDITION = re.compile(r'^\s*bad', re.IGNORECASE)
+WASH = re.compile(r'^\s*wash', re.IGNORECASE)
+REPAINT = re.compile(r'repaint', re.IGNORECASE)
+
+# Background bonnet analysis jobs
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_RETRY_DELAY_SECONDS = float(os.environ.get('JOB_RETRY_DELAY_SECONDS', 10))
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 300))
+JOB_UPLOADS_BUCKET = 'job_uploads'
+ACTIVE_JOB_STATUSES = ['pending', 'processing']
+
+# History page size
+HISTORY_DEFAULT_LIMIT = 100
+HISTORY_MAX_LIMIT = 500
+
+# ?fields= selections on the detail and history routes
+MAX_SELECTED_FIELDS = 32
+FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Bulk export reads analyses in cursor batches of this size
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet')
+}
+EXPORT_COLUMNS = [
+    'id', 'analysis_type', 'image_name', 'timestamp', 'status',
+    'white_pixel_count', 'total_pixels', 'percentage',
+    'car_color', 'condition', 'wash_or_repaint', 'issues', 'recommendations', 'detailed_report',
+    'panel', 'vehicle_id', 'panel_ids', 'phash', 'duplicate_of', 'image_digest', 'error',
+    'thresholds', 'regions', 'sample_scale', 'preprocessing'
+]
+
+# Only the fields needed to build history summaries
+HISTORY_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "analysis_type": 1,
+    "image_name": 1,
+    "timestamp": 1,
+    "percentage": 1,
+    "car_color": 1,
+    "condition": 1,
+    "wash_or_repaint": 1,
+    "panel_ids": 1,
+    "status": 1
+}
+
+# Process pool for batch analysis, one worker per core by default. Spawned
+# rather than forked so workers never inherit the event loop or driver threads
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', os.cpu_count() or 1))
+BATCH_MAX_IMAGES = int(os.environ.get('BATCH_MAX_IMAGES', 500))
+# Bytes of image data accepted per batch request, after unpacking archives
+MAX_BATCH_BYTES = int(os.environ.get('MAX_BATCH_BYTES', 512 * 1024 * 1024))
+# Images inflated ahead of the workers, bounds what a batch holds in memory
+BATCH_READ_AHEAD = BATCH_WORKERS * 2
+
+
+def create_batch_executor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=BATCH_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+batch_executor = create_batch_executor()
+
+
+# Vision model and prompt used for bonnet analysis
+BONNET_MODEL_PROVIDER = os.environ.get('BONNET_MODEL_PROVIDER', 'openai')
+BONNET_MODEL = os.environ.get('BONNET_MODEL', 'gpt-4o')
+BONNET_SYSTEM_MESSAGE = "You are an expert automotive inspector specializing in car condition assessment. Provide detailed, professional analysis."
+# The model answers with one JSON object validated against this schema
+BONNET_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "car_color": {"type": "string", "minLength": 1},
+        "condition": {"enum": ["Good", "Bad"]},
+        "wash_or_repaint": {"enum": ["Wash", "Repaint"]},
+        "issues": {"type": "array", "items": {"type": "string"}},
+        "recommendations": {"type": "array", "items": {"type": "string"}},
+        "detailed_report": {"type": "string"}
+    },
+    "required": ["car_color", "condition", "wash_or_repaint", "issues", "recommendations", "detailed_report"]
+}
+bonnet_response_validator = Draft202012Validator(BONNET_RESPONSE_SCHEMA)
+
+BONNET_PROMPT = """Analyze this car bonnet image and provide:
+1. Car Color: Identify the primary color of the car
+2. Condition: Assess if the condition is 'Good' or 'Bad'
+3. Wash or Repaint: Recommend whether the car needs 'Wash' or 'Repaint'
+4. Issues: List any visible issues (scratches, dents, rust, paint damage, dirt accumulation, etc.)
+5. Recommendations: Provide specific recommendations for maintenance or repair
+6. Detailed Report: A comprehensive diagnostic report with action items
+
+Respond with a single JSON object and nothing else, no markdown fences or
+commentary. It must match this JSON schema:
+""" + json.dumps(BONNET_RESPONSE_SCHEMA, indent=2)
+
+# Multi-view vehicle inspections send every panel in a single model call
+VEHICLE_MAX_PANELS = int(os.environ.get('VEHICLE_MAX_PANELS', 8))
+VEHICLE_PANEL_SCHEMA = copy.deepcopy(BONNET_RESPONSE_SCHEMA)
+VEHICLE_PANEL_SCHEMA['properties']['panel'] = {"type": "string"}
+VEHICLE_PANEL_SCHEMA['required'].insert(0, 'panel')
+VEHICLE_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "panels": {"type": "array", "items": VEHICLE_PANEL_SCHEMA},
+        "vehicle": BONNET_RESPONSE_SCHEMA
+    },
+    "required": ["panels", "vehicle"]
+}
+vehicle_response_validator = Draft202012Validator(VEHICLE_RESPONSE_SCHEMA)
+
+VEHICLE_PROMPT = """These images are photos of different panels of the same car, in this order:
+{panels}
+
+For each panel, in the same order:
+1. Car Color: Identify the primary color of the panel
+2. Condition: Assess if the condition is 'Good' or 'Bad'
+3. Wash or Repaint: Recommend whether the panel needs 'Wash' or 'Repaint'
+4. Issues: List any visible issues (scratches, dents, rust, paint damage, dirt accumulation, etc.)
+5. Recommendations: Provide specific recommendations for maintenance or repair
+6. Detailed Report: A diagnostic report with action items
+
+Then give the same assessment for the vehicle as a whole. Its condition is
+'Bad' if any panel is, and it needs 'Repaint' if any panel does; its
+detailed report should summarize the work needed across all panels.
+
+Respond with a single JSON object and nothing else, no markdown fences or
+commentary. It must match this JSON schema:
+""" + json.dumps(VEHICLE_RESPONSE_SCHEMA, indent=2)
+
+# Which vision backend analyzes bonnets: 'remote' (the LLM above), 'local'
+# (pixel heuristics, no network) or 'tiered' (local first, escalating to
+# remote when the local confidence is below LOCAL_CONFIDENCE_THRESHOLD)
+VISION_PROVIDER = os.environ.get('VISION_PROVIDER', 'remote').lower()
+LOCAL_CONFIDENCE_THRESHOLD = float(os.environ.get('LOCAL_CONFIDENCE_THRESHOLD', 0.75))
+LOCAL_HEURISTIC_VERSION = 2
+LOCAL_ANALYSIS_EDGE = 256
+# Smaller images leave too few pixels in the center crop for the 8x8
+# brightness grid, so they are reported as Unknown with no confidence
+LOCAL_MIN_EDGE = 16
+
+# Uploads are downscaled and re-encoded before they are sent to the vision model
+MODEL_IMAGE_MAX_EDGE = int(os.environ.get('MODEL_IMAGE_MAX_EDGE', 1536))
+MODEL_IMAGE_FORMAT = os.environ.get('MODEL_IMAGE_FORMAT', 'JPEG').upper()
+MODEL_IMAGE_QUALITY = int(os.environ.get('MODEL_IMAGE_QUALITY', 85))
+
+# Changes whenever the model, prompt, provider or preprocessing changes, so cached
+# results never outlive them
+BONNET_ANALYSIS_VERSION = hashlib.sha256(
+    f"{BONNET_MODEL_PROVIDER}|{BONNET_MODEL}|{BONNET_SYSTEM_MESSAGE}|{BONNET_PROMPT}|"
+    f"{MODEL_IMAGE_MAX_EDGE}|{MODEL_IMAGE_FORMAT}|{MODEL_IMAGE_QUALITY}|"
+    f"{VISION_PROVIDER}|{LOCAL_CONFIDENCE_THRESHOLD}|{LOCAL_HEURISTIC_VERSION}".encode('utf-8')
+).hexdigest()[:12]
+VEHICLE_ANALYSIS_VERSION = hashlib.sha256(
+    f"{BONNET_ANALYSIS_VERSION}|{VEHICLE_PROMPT}".encode('utf-8')
+).hexdigest()[:12]
+
+# Bonnet uploads whose perceptual hash is within this many bits of an earlier
+# analysis reuse its result instead of calling the model (-1, the default, disables)
+PHASH_MAX_DISTANCE = int(os.environ.get('PHASH_MAX_DISTANCE', -1))
+# Hashes with fewer set (or unset) bits than this come from flat, featureless
+# images that all hash alike, so they are never indexed or matched
+PHASH_MIN_BITS = int(os.environ.get('PHASH_MIN_BITS', 8))
+
+# Limits on upstream vision model calls
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 8))
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', 64))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('LLM_QUEUE_TIMEOUT_SECONDS', 30))
+LLM_RATE_PER_SECOND = float(os.environ.get('LLM_RATE_PER_SECOND', 0))  # 0 disables rate limiting
+LLM_BURST = int(os.environ.get('LLM_BURST', LLM_MAX_CONCURRENCY))
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', 60))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))
+LLM_RETRY_BASE_SECONDS = float(os.environ.get('LLM_RETRY_BASE_SECONDS', 1))
+# Idle upstream connections are kept open this long for the next call
+LLM_KEEPALIVE_SECONDS = float(os.environ.get('LLM_KEEPALIVE_SECONDS', 60))
+
+# Upstream HTTP statuses worth retrying: rate limits and overload
+RETRYABLE_LLM_STATUSES = {429, 500, 502, 503, 504}
+# Transient network failures, raised without a status
+TRANSIENT_LLM_ERRORS = (ConnectionError, TimeoutError, httpx.TransportError)
+
+# Bonnet result cache limits
+BONNET_CACHE_MAX_ENTRIES = int(os.environ.get('BONNET_CACHE_MAX_ENTRIES', 1024))
+BONNET_CACHE_MAX_BYTES = int(os.environ.get('BONNET_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+BONNET_CACHE_TTL_SECONDS = int(os.environ.get('BONNET_CACHE_TTL_SECONDS', 24 * 60 * 60))
+
+# The sampling profiler endpoints are only served when explicitly enabled
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 120))
+
+# Startup warms the codecs and worker pools; shutdown waits this long for
+# analyses in progress before closing connections and pools
+STARTUP_WARMUP = os.environ.get('STARTUP_WARMUP', 'true').lower() in ('1', 'true', 'yes')
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get('SHUTDOWN_DRAIN_SECONDS', 30))
+READY_PING_TIMEOUT_SECONDS = float(os.environ.get('READY_PING_TIMEOUT_SECONDS', 2))
+
+# Prometheus metrics, served at /metrics
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency', ['method', 'route', 'status'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests being served', ['route'])
+STAGE_SECONDS = Histogram(
+    'analysis_stage_duration_seconds', 'Time spent in each stage of an analysis', ['stage'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+ANALYSES_IN_FLIGHT = Gauge('analyses_in_flight', 'Analyses currently being processed', ['analysis_type'])
+
+
+class ServiceLifecycle:
+    """Startup phase and analyses in progress, for readiness and graceful shutdown.
+
+    The phase moves from `starting` to `ready` once the lifespan handler has
+    opened and warmed every resource, and to `draining` on shutdown. While
+    draining no new analysis is started and shutdown waits for the ones
+    still running before closing the connections they use.
+    """
+    
+    def __init__(self):
+        self.phase = 'starting'
+        self.started_at = None
+        self.in_flight = 0
+        self.warmup = {}
+        self.tasks = []  # background loops cancelled on shutdown
+    
+    @contextmanager
+    def analysis(self, analysis_type: str):
+        if self.phase == 'draining':
+            raise HTTPException(status_code=503, detail="Service is shutting down, retry shortly")
+        
+        gauge = ANALYSES_IN_FLIGHT.labels(analysis_type)
+        self.in_flight += 1
+        gauge.inc()
+        try:
+            yield
+        finally:
+            gauge.dec()
+            self.in_flight -= 1
+    
+    async def drain(self, timeout: float) -> bool:
+        """Stop taking analyses and wait up to `timeout` seconds for running ones"""
+        self.phase = 'draining'
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return self.in_flight == 0
+    
+    def stats(self) -> dict:
+        return {
+            'phase': self.phase,
+            'uptime_seconds': round(time.monotonic() - self.started_at, 1) if self.started_at else 0,
+            'in_flight': self.in_flight,
+            **self.warmup
+        }
+
+
+lifecycle = ServiceLifecycle()
+
+
+@dataclass
+class IngestedUpload:
+    """An upload read within the configured limits.
+
+    Small uploads are held in `data`; uploads spooled to disk have `path`
+    set instead and the caller removes the file with discard().
+    """
+    filename: str
+    data: Optional[bytearray]
+    digest: str
+    format: str
+    size: Optional[tuple] = None  # (width, height), None for archives
+    path: Optional[str] = None
+    
+    @property
+    def source(self):
+        """The upload as accepted by white_pixel_stats: bytes or a file path"""
+        return self.path if self.path else self.data
+    
+    def discard(self):
+        if self.path:
+            os.unlink(self.path)
+            self.path = None
+
+
+async def run_in_image_pool(func, *args):
+    """Run a blocking image function on the image worker pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(image_executor, func, *args)
+
+
+# Define Models
+class ThresholdCount(BaseModel):
+    threshold: int
+    white_pixel_count: int
+    percentage: float
+
+
+class RegionStats(BaseModel):
+    region: str
+    box: List[int]  # left, top, right, bottom
+    total_pixels: int
+    counts: List[ThresholdCount]
+
+
+class WhitePixelAnalysis(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    analysis_type: str = "white_pixel"
+    image_name: str
+    white_pixel_count: int
+    total_pixels: int
+    percentage: float
+    analysis_result: str
+    thresholds: Optional[List[ThresholdCount]] = None
+    regions: Optional[List[RegionStats]] = None
+    sample_scale: Optional[int] = None  # set when counted on a 1/N scale decode, counts are estimates
+    image_digest: Optional[str] = None  # sha256 of the upload in the image store
+    analysis_version: Optional[str] = WHITE_PIXEL_ANALYSIS_VERSION
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class BonnetAnalysis(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    analysis_type: str = "bonnet"
+    image_name: str
+    car_color: str
+    condition: str  # good or bad
+    wash_or_repaint: str
+    issues: List[str]
+    recommendations: List[str]
+    detailed_report: str
+    preprocessing: Optional[dict] = None
+    phash: Optional[str] = None  # 64-bit dHash as hex
+    duplicate_of: Optional[str] = None  # id of the analysis whose result was reused
+    provider: Optional[str] = None  # vision tier that produced the result: local or remote
+    confidence: Optional[float] = None  # local heuristic confidence, 0-1
+    image_digest: Optional[str] = None  # sha256 of the upload in the image store
+    # Version of the model setup that produced the result, None when unknown
+    analysis_version: Optional[str] = BONNET_ANALYSIS_VERSION
+    status: str = "completed"
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class PanelAnalysis(BonnetAnalysis):
+    analysis_type: str = "panel"
+    analysis_version: Optional[str] = VEHICLE_ANALYSIS_VERSION
+    panel: str
+    vehicle_id: str
+
+
+class VehicleAnalysis(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    analysis_type: str = "vehicle"
+    image_name: str
+    car_color: str
+    condition: str  # good or bad, bad if any panel is
+    wash_or_repaint: str
+    issues: List[str]
+    recommendations: List[str]
+    detailed_report: str
+    panels: List[PanelAnalysis]
+    provider: Optional[str] = None
+    analysis_version: Optional[str] = VEHICLE_ANALYSIS_VERSION
+    status: str = "completed"
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class BatchItemError(BaseModel):
+    image_name: str
+    detail: str
+
+
+class WhitePixelBatchAnalysis(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
+    batch_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    image_count: int
+    failed_count: int
+    total_white_pixels: int
+    total_pixels: int
+    overall_percentage: float
+    mean_percentage: float
+    min_percentage: float
+    max_percentage: float
+    results: List[WhitePixelAnalysis]
+    errors: List[BatchItemError]
+
+
+class AnalysisHistory(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
+    id: str
+    analysis_type: str
+    image_name: str
+    timestamp: datetime
+    summary: str
+
+
+HISTORY_FIELDS = list(AnalysisHistory.model_fields)
+
+# Fields a detail request can select: those of the analysis models, the
+# panel ids vehicles are stored with, job state and re-analysis history
+ANALYSIS_FIELDS = sorted(
+    {
+        field
+        for model in (WhitePixelAnalysis, BonnetAnalysis, PanelAnalysis, VehicleAnalysis)
+        for field in model.model_fields if field != 'panels'
+    } | {
+        'panel_ids', 'attempts', 'error', 'started_at', 'finished_at', 'next_attempt_at',
+        'reanalyzed_at', 'previous_versions'
+    }
+)
+
+
+def min_channel_image(image: Image.Image) -> Image.Image:
+    """Per-pixel minimum of the R, G and B bands as a single 'L' band"""
+    r, g, b = image.split()
+    return ImageChops.darker(ImageChops.darker(r, g), b)
+
+
+def parse_thresholds(value: Optional[str]) -> Optional[List[int]]:
+    """Parse a comma separated list of thresholds such as '200,220,240'"""
+    if not value:
+        return None
+    try:
+        thresholds = sorted({int(part) for part in value.split(',') if part.strip()})
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Thresholds must be integers")
+    if not thresholds or len(thresholds) > MAX_THRESHOLDS or not all(0 <= t <= 254 for t in thresholds):
+        raise HTTPException(status_code=400, detail=f"Give 1-{MAX_THRESHOLDS} thresholds between 0 and 254")
+    return thresholds
+
+
+def parse_regions(grid: Optional[str], roi: Optional[str]) -> Optional[dict]:
+    """Parse a grid ('3x4', rows x columns) or ROI ('x,y,w,h;x,y,w,h') spec"""
+    if grid and roi:
+        raise HTTPException(status_code=400, detail="Give either grid or roi, not both")
+    try:
+        if grid:
+            rows, cols = (int(part) for part in grid.lower().split('x'))
+            if rows < 1 or cols < 1 or rows * cols > MAX_REGIONS:
+                raise ValueError
+            return {'grid': [rows, cols]}
+        if roi:
+            boxes = [[int(part) for part in box.split(',')] for box in roi.split(';') if box.strip()]
+            if not boxes or len(boxes) > MAX_REGIONS or any(len(b) != 4 or b[2] < 1 or b[3] < 1 for b in boxes):
+                raise ValueError
+            return {'roi': boxes}
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid region spec, use grid=ROWSxCOLS or roi=x,y,w,h;... (at most {MAX_REGIONS} regions)"
+        )
+    return None
+
+
+def region_boxes(regions: dict, width: int, height: int) -> List[tuple]:
+    """(name, (left, top, right, bottom)) for every region, clipped to the image"""
+    if 'grid' in regions:
+        rows, cols = regions['grid']
+        return [
+            (f"r{row}c{col}", (col * width // cols, row * height // rows, (col + 1) * width // cols, (row + 1) * height // rows))
+            for row in range(rows) for col in range(cols)
+        ]
+    
+    boxes = []
+    for index, (x, y, w, h) in enumerate(regions['roi']):
+        left, top = min(max(x, 0), width), min(max(y, 0), height)
+        boxes.append((f"roi{index}", (left, top, max(left, min(x + w, width)), max(top, min(y + h, height)))))
+    return boxes
+
+
+def threshold_counts(histogram: List[int], thresholds: List[int], total_pixels: int) -> List[dict]:
+    """White pixel counts for many thresholds from one channel-minimum histogram"""
+    # above[v] is the number of pixels whose darkest channel is >= v
+    above = [0] * 257
+    for value in range(255, -1, -1):
+        above[value] = above[value + 1] + histogram[value]
+    
+    return [
+        {
+            'threshold': threshold,
+            'white_pixel_count': above[threshold + 1],
+            'percentage': round(above[threshold + 1] / total_pixels * 100, 2) if total_pixels else 0.0
+        }
+        for threshold in thresholds
+    ]
+
+
+class ImageTooLargeError(ValueError):
+    """The image cannot be processed within the configured limits"""
+
+
+def raw_strip_layout(image: Image.Image) -> Optional[List[tuple]]:
+    """(box, offset, rawmode, stride, ystep) per tile if the pixels are stored
+    uncompressed, so strips can be read straight from the encoded buffer"""
+    if not image.tile:
+        return None
+    layout = []
+    for decoder, box, offset, args in image.tile:
+        if decoder != 'raw':
+            return None
+        if isinstance(args, str):
+            args = (args,)
+        rawmode, stride, ystep = (tuple(args) + (0, 1))[:3]
+        width = box[2] - box[0]
+        if not stride:
+            try:
+                stride = len(Image.new(image.mode, (width, 1)).tobytes('raw', rawmode))
+            except Exception:
+                return None
+        layout.append((box, offset, rawmode, stride, ystep))
+    
+    # Planar layouts store each band as its own tile over the same box
+    if len({entry[0] for entry in layout}) != len(layout):
+        return None
+    return layout
+
+
+def raw_strips(image: Image.Image, buffer, layout: List[tuple], rows: int):
+    """Yield (left, top, channel-minimum strip) read directly from raw tiles"""
+    palette = image.getpalette() if image.mode == 'P' else None
+    for box, offset, rawmode, stride, ystep in layout:
+        width, height = box[2] - box[0], box[3] - box[1]
+        for first in range(0, height, rows):
+            last = min(height, first + rows)
+            data = bytes(buffer[offset + first * stride:offset + last * stride])
+            strip = Image.frombytes(image.mode, (width, last - first), data, 'raw', rawmode, stride, ystep)
+            if palette:
+                strip.putpalette(palette)
+            if strip.mode != 'RGB':
+                strip = strip.convert('RGB')
+            # Bottom-up layouts store the last image row first
+            top = box[1] + (height - last if ystep < 0 else first)
+            yield box[0], top, min_channel_image(strip)
+
+
+def decoded_strips(image: Image.Image, rows: int):
+    """Yield (left, top, channel-minimum strip) from an image decoded once"""
+    image.load()
+    for top in range(0, image.height, rows):
+        strip = image.crop((0, top, image.width, min(image.height, top + rows)))
+        if strip.mode != 'RGB':
+            strip = strip.convert('RGB')
+        yield 0, top, min_channel_image(strip)
+
+
+def png_layout(fp) -> Optional[tuple]:
+    """(row bytes, bytes per pixel) of a PNG that can be inflated strip by
+    strip, None if it is interlaced or its pixels have no 8-bit byte view"""
+    fp.seek(len(PNG_SIGNATURE))
+    length, chunk_type = struct.unpack('>I4s', fp.read(8))
+    if chunk_type != b'IHDR' or length != 13:
+        return None
+    width, _, depth, color, _, _, interlace = struct.unpack('>IIBBBBB', fp.read(13))
+    if interlace or color not in PNG_CHANNELS:
+        return None
+    bits = width * PNG_CHANNELS[color] * depth
+    pixel_bytes = max(1, bits // width // 8)
+    if pixel_bytes not in PNG_BYTE_VIEWS:
+        return None
+    return (bits + 7) // 8, pixel_bytes
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def png_image_data(fp):
+    """Yield the compressed image data of a PNG in pieces of at most PNG_READ_BYTES"""
+    fp.seek(len(PNG_SIGNATURE))
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IEND':
+            return
+        if chunk_type != b'IDAT':
+            fp.seek(length + 4, os.SEEK_CUR)
+            continue
+        while length:
+            piece = fp.read(min(length, PNG_READ_BYTES))
+            if not piece:
+                return
+            length -= len(piece)
+            yield piece
+        fp.seek(4, os.SEEK_CUR)  # CRC
+
+
+def png_strips(image: Image.Image, fp, layout: tuple, rows: int):
+    """Yield (left, top, channel-minimum strip) from a PNG inflated `rows` rows at a time.
+
+    Each strip's filtered rows are wrapped in a PNG of their own, as the
+    8-bit byte view of the same pixel size and headed by the previous
+    strip's last row (unfiltered), so PIL can undo filters referring to
+    the row above. The raw rows it returns are unpacked in the real mode.
+    """
+    stride, pixel_bytes = layout
+    view_color, _ = PNG_BYTE_VIEWS[pixel_bytes]
+    rawmode = image.tile[0][3]
+    if isinstance(rawmode, tuple):
+        rawmode = rawmode[0]
+    palette = image.getpalette() if image.mode == 'P' else None
+    
+    pieces = png_image_data(fp)
+    inflater = zlib.decompressobj()
+    pending = bytearray()
+    previous = None
+    for top in range(0, image.height, rows):
+        count = min(rows, image.height - top)
+        needed = count * (stride + 1)
+        # Inflate no more than the strip needs, whatever the compression ratio
+        while len(pending) < needed:
+            data = inflater.unconsumed_tail or next(pieces, None)
+            if data is None or inflater.eof:
+                raise ValueError("PNG image data is truncated")
+            pending += inflater.decompress(data, needed - len(pending))
+        filtered = bytes(pending[:needed])
+        del pending[:needed]
+        
+        if previous is not None:
+            filtered = b'\x00' + previous + filtered
+        header = struct.pack('>IIBBBBB', stride // pixel_bytes, len(filtered) // (stride + 1), 8, view_color, 0, 0, 0)
+        wrapped = (
+            PNG_SIGNATURE + png_chunk(b'IHDR', header) + png_chunk(b'IDAT', zlib.compress(filtered, 0)) +
+            png_chunk(b'IEND', b'')
+        )
+        with Image.open(BytesIO(wrapped)) as view:
+            raw = view.tobytes()
+        if previous is not None:
+            raw = raw[stride:]
+        previous = raw[-stride:]
+        
+        strip = Image.frombytes(image.mode, (image.width, count), raw, 'raw', rawmode)
+        if palette:
+            strip.putpalette(palette)
+        if strip.mode != 'RGB':
+            strip = strip.convert('RGB')
+        yield 0, top, min_channel_image(strip)
+
+
+@contextmanager
+def pil_pixel_limit(max_pixels: int):
+    """Let PIL open images of up to `max_pixels` within the block.
+
+    The guard is process-wide, so while blocks overlap it stays at the
+    highest limit any of them asked for. Our own pixel checks still apply.
+    """
+    with pil_pixel_limits_lock:
+        pil_pixel_limits[max_pixels] += 1
+        Image.MAX_IMAGE_PIXELS = max([PIL_MAX_IMAGE_PIXELS, *pil_pixel_limits])
+    try:
+        yield
+    finally:
+        with pil_pixel_limits_lock:
+            pil_pixel_limits[max_pixels] -= 1
+            if not pil_pixel_limits[max_pixels]:
+                del pil_pixel_limits[max_pixels]
+            Image.MAX_IMAGE_PIXELS = max([PIL_MAX_IMAGE_PIXELS, *pil_pixel_limits])
+
+
+def draft_to_budget(image: Image.Image) -> Optional[int]:
+    """Set a JPEG to decode at the first 1/N scale whose frame fits half the budget, returns N"""
+    for scale in JPEG_SAMPLE_SCALES:
+        size = (-(-image.width // scale), -(-image.height // scale))
+        if size[0] * size[1] * 4 <= TILE_MEMORY_BUDGET_BYTES // 2:
+            image.draft(image.mode, size)
+            return scale
+    return None
+
+
+def draft_to_fit(image: Image.Image, edge: int):
+    """Let a JPEG decode at the smallest 1/N scale that still covers the image fitted within edge x edge.
+
+    A square (edge, edge) draft request would rule out any scale that takes
+    the short side below `edge`, though only the long side is fitted to it.
+    """
+    longest = max(image.size)
+    if image.format == 'JPEG' and longest > edge:
+        image.draft('RGB', (-(-image.width * edge // longest), -(-image.height * edge // longest)))
+
+
+def scale_box(box: tuple, size: tuple, sample_size: tuple) -> tuple:
+    """A box in full image coordinates mapped onto a reduced decode"""
+    left, top, right, bottom = box
+    return (
+        left * sample_size[0] // size[0], top * sample_size[1] // size[1],
+        right * sample_size[0] // size[0], bottom * sample_size[1] // size[1]
+    )
+
+
+def rescale_counts(counts: List[dict], sample_pixels: int, total_pixels: int) -> List[dict]:
+    """Counts taken on a reduced decode, estimated for the full image"""
+    if sample_pixels != total_pixels:
+        for count in counts:
+            count['white_pixel_count'] = round(count['white_pixel_count'] * total_pixels / sample_pixels) if sample_pixels else 0
+    return counts
+
+
+def add_histogram(total: List[int], histogram: List[int]):
+    for value, count in enumerate(histogram):
+        total[value] += count
+
+
+def white_pixel_stats(source, thresholds: Optional[List[int]] = None, regions: Optional[dict] = None,
+                      approximate: bool = False) -> dict:
+    """Compute white pixel statistics for encoded image bytes or an image file.
+
+    The image is processed in horizontal strips sized to stay within
+    TILE_MEMORY_BUDGET_BYTES. Uncompressed BMP and TIFF strips are read
+    straight from the (memory-mapped) encoded bytes, so memory does not grow
+    with image size. Other formats are decoded once and then counted strip
+    by strip; the decoded frame and the strips each get half the budget.
+    When the decoded frame does not fit in its half, PNGs are
+    inflated strip by strip instead; with `approximate`, JPEGs are decoded
+    at reduced scale and the counts estimated (`sample_scale` is set);
+    anything else is rejected.
+
+    Besides the default threshold, counts for any number of `thresholds`
+    and `regions` come from the same decode: each region costs one
+    histogram per strip, and each threshold a lookup in its cumulative sum.
+    """
+    with open(source, 'rb') if isinstance(source, str) else BytesIO(source) as fp:
+        with pil_pixel_limit(MAX_TILED_IMAGE_PIXELS):
+            image = Image.open(fp)
+        width, height = image.size
+        total_pixels = width * height
+        if total_pixels > MAX_TILED_IMAGE_PIXELS:
+            raise ImageTooLargeError(f"Image is {width}x{height} pixels, the limit is {MAX_TILED_IMAGE_PIXELS} pixels")
+        
+        rows = max(1, TILE_MEMORY_BUDGET_BYTES // (width * STRIP_BYTES_PER_PIXEL))
+        scan_started = time.perf_counter()
+        sample_scale = None
+        buffer = None
+        layout = raw_strip_layout(image)
+        if layout is not None:
+            buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if isinstance(source, str) else memoryview(source)
+            strips = raw_strips(image, buffer, layout, rows)
+        else:
+            decoded_bytes = total_pixels * (1 if image.mode in ('1', 'L', 'P') else 4)
+            frame_budget = TILE_MEMORY_BUDGET_BYTES // 2
+            png = png_layout(fp) if decoded_bytes > frame_budget and image.format == 'PNG' else None
+            if decoded_bytes <= frame_budget:
+                strips = decoded_strips(image, max(1, rows // 2))
+            elif png is not None:
+                # The filtered rows and their byte view add to every strip
+                rows = max(1, TILE_MEMORY_BUDGET_BYTES // (width * (STRIP_BYTES_PER_PIXEL + 3 * png[1])))
+                strips = png_strips(image, fp, png, rows)
+            elif image.format == 'JPEG' and approximate and (sample_scale := draft_to_budget(image)):
+                strips = decoded_strips(image, max(1, rows // 2))
+            else:
+                hint = "pass approximate=true to count it at reduced scale, or " if image.format == 'JPEG' else ""
+                raise ImageTooLargeError(
+                    f"Decoding this {image.format} image needs {decoded_bytes} bytes, over half of the "
+                    f"{TILE_MEMORY_BUDGET_BYTES} byte budget; {hint}upload it as uncompressed BMP or TIFF"
+                )
+        
+        boxes = region_boxes(regions, width, height) if regions else []
+        sample_size = image.size
+        sample_boxes = [scale_box(box, (width, height), sample_size) for _, box in boxes]
+        histogram = [0] * 256
+        region_histograms = [[0] * 256 for _ in boxes]
+        
+        try:
+            # A pixel is white when its darkest channel is above the threshold,
+            # so histograms of the channel minimum give every count in C
+            for left, top, strip in strips:
+                add_histogram(histogram, strip.histogram())
+                bottom, right = top + strip.height, left + strip.width
+                for index, box in enumerate(sample_boxes):
+                    x0, y0 = max(box[0], left), max(box[1], top)
+                    x1, y1 = min(box[2], right), min(box[3], bottom)
+                    if x0 < x1 and y0 < y1:
+                        region = strip.crop((x0 - left, y0 - top, x1 - left, y1 - top))
+                        add_histogram(region_histograms[index], region.histogram())
+        finally:
+            if isinstance(buffer, mmap.mmap):
+                buffer.close()
+    
+    # Decoding and histogramming are interleaved strip by strip, so they are timed together
+    STAGE_SECONDS.labels('white_pixel_scan').observe(time.perf_counter() - scan_started)
+    
+    # Counts from a reduced decode are scaled up to the full image
+    sample_pixels = sample_size[0] * sample_size[1]
+    white = rescale_counts(threshold_counts(histogram, [WHITE_THRESHOLD], sample_pixels), sample_pixels, total_pixels)[0]
+    
+    result = {
+        'white_pixel_count': white['white_pixel_count'],
+        'total_pixels': total_pixels,
+        'percentage': white['percentage']
+    }
+    if sample_scale:
+        result['sample_scale'] = sample_scale
+    
+    if thresholds:
+        result['thresholds'] = rescale_counts(threshold_counts(histogram, thresholds, sample_pixels), sample_pixels, total_pixels)
+    
+    if regions:
+        result['regions'] = []
+        for (name, box), sample_box, region_histogram in zip(boxes, sample_boxes, region_histograms):
+            area = (box[2] - box[0]) * (box[3] - box[1])
+            sample_area = (sample_box[2] - sample_box[0]) * (sample_box[3] - sample_box[1])
+            counts = threshold_counts(region_histogram, thresholds or [WHITE_THRESHOLD], sample_area)
+            result['regions'].append({
+                'region': name,
+                'box': list(box),
+                'total_pixels': area,
+                'counts': rescale_counts(counts, sample_area, area)
+            })
+    
+    return result
+
+
+def count_white_pixels(source, thresholds: Optional[List[int]] = None, regions: Optional[dict] = None,
+                       approximate: bool = False) -> dict:
+    """Count white pixels in an image (bytes or a file path)"""
+    try:
+        return white_pixel_stats(source, thresholds, regions, approximate)
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error counting white pixels: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+
+
+def make_thumbnail(source) -> Optional[bytes]:
+    """Small upright JPEG preview of an image (bytes or file path).
+
+    None for images too large to decode whole; those are still stored and
+    served, just without a preview.
+    """
+    # Stored uploads include the large images white pixel analysis accepts
+    with pil_pixel_limit(MAX_TILED_IMAGE_PIXELS):
+        image = Image.open(source if isinstance(source, str) else BytesIO(source))
+    with image:
+        if image.width * image.height > MAX_IMAGE_PIXELS:
+            return None
+        
+        # Let JPEG decode at reduced scale, the thumbnail needs a fraction of the pixels
+        draft_to_fit(image, THUMBNAIL_EDGE)
+        
+        preview = ImageOps.exif_transpose(image)
+        if preview.mode not in ('RGB', 'L'):
+            preview = preview.convert('RGB')
+        preview.thumbnail((THUMBNAIL_EDGE, THUMBNAIL_EDGE), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        
+        buffer = BytesIO()
+        preview.save(buffer, format='JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+        return buffer.getvalue()
+
+
+def count_white_pixels_batch_item(image_name: str, image_data: bytes, keep_image: bool = False) -> tuple:
+    """Batch worker entry point, returns (image_name, stats, error, image).
+
+    With `keep_image` the worker also hashes the image and renders its
+    thumbnail, so `image` is (digest, thumbnail) for the image store.
+    """
+    try:
+        stats = white_pixel_stats(image_data)
+    except Exception as e:
+        return image_name, None, f"Error processing image: {str(e)}", None
+    
+    if not keep_image:
+        return image_name, stats, None, None
+    try:
+        thumbnail = make_thumbnail(image_data)
+    except Exception:
+        thumbnail = None
+    return image_name, stats, None, (hashlib.sha256(image_data).hexdigest(), thumbnail)
+
+
+def detect_image_format(header: bytes) -> Optional[str]:
+    """Identify an upload's format from its leading bytes"""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'WEBP'
+    for signature, image_format in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return image_format
+    return None
+
+
+def read_image_header(header, max_pixels: int = MAX_IMAGE_PIXELS) -> Optional[tuple]:
+    """Image dimensions from a partial upload (or spooled file), None until enough has arrived"""
+    try:
+        # Image.open only parses the header, no pixel data is decoded
+        with pil_pixel_limit(max_pixels), Image.open(header if isinstance(header, str) else BytesIO(header)) as image:
+            return image.size
+    except Image.DecompressionBombError:
+        raise
+    except Exception:
+        return None
+
+
+def check_image_pixels(size: tuple, max_pixels: int = MAX_IMAGE_PIXELS):
+    """Reject images whose pixel count is over the limit"""
+    if size[0] * size[1] > max_pixels:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image is {size[0]}x{size[1]} pixels, the limit is {max_pixels} pixels"
+        )
+
+
+async def ingest_upload(file: UploadFile, allowed_formats=IMAGE_FORMATS, max_bytes: int = MAX_UPLOAD_BYTES,
+                        max_pixels: int = MAX_IMAGE_PIXELS, spool_bytes: Optional[int] = None,
+                        archive_max_bytes: Optional[int] = None) -> IngestedUpload:
+    """Read an upload in chunks, enforcing size, format and pixel limits early.
+
+    With `spool_bytes` set, uploads that grow beyond it are written to a
+    temporary file rather than kept in memory. Zip archives may grow to
+    `archive_max_bytes` rather than `max_bytes`.
+    """
+    # The larger limit applies until the first chunk tells the format
+    limit = max(max_bytes, archive_max_bytes or 0)
+    if file.size is not None and file.size > limit:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {limit} bytes")
+    
+    data = bytearray()
+    hasher = hashlib.sha256()
+    image_format = None
+    size = None
+    spool = None
+    received = 0
+    
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            
+            received += len(chunk)
+            if received > limit:
+                raise HTTPException(status_code=413, detail=f"Upload exceeds {limit} bytes")
+            hasher.update(chunk)
+            
+            # Once spooled, only the header window is kept in memory
+            if spool is not None:
+                spool.write(chunk)
+            else:
+                data += chunk
+                if spool_bytes is not None and len(data) > spool_bytes:
+                    spool = tempfile.NamedTemporaryFile(prefix='upload-', delete=False)
+                    spool.write(data)
+                    del data[UPLOAD_HEADER_BYTES:]
+            
+            if image_format is None and len(data) >= 12:
+                image_format = detect_image_format(bytes(data[:12]))
+                if image_format not in allowed_formats:
+                    raise HTTPException(status_code=415, detail="Unsupported file type")
+                limit = archive_max_bytes if image_format == 'ZIP' and archive_max_bytes is not None else max_bytes
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=f"Upload exceeds {limit} bytes")
+            
+            # Check dimensions as soon as the header has arrived
+            if image_format in IMAGE_FORMATS and size is None and received <= UPLOAD_HEADER_BYTES:
+                try:
+                    size = read_image_header(bytes(data), max_pixels)
+                except Image.DecompressionBombError as e:
+                    raise HTTPException(status_code=413, detail=str(e))
+                if size is not None:
+                    check_image_pixels(size, max_pixels)
+        
+        if image_format is None:
+            raise HTTPException(status_code=415, detail="Unsupported file type")
+        
+        if spool is not None:
+            spool.close()
+        
+        # Headers larger than the sniffing window are checked once at the end
+        if image_format in IMAGE_FORMATS and size is None:
+            try:
+                size = read_image_header(spool.name if spool is not None else bytes(data), max_pixels)
+            except Image.DecompressionBombError as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            if size is None:
+                raise HTTPException(status_code=400, detail="Could not read image header")
+            check_image_pixels(size, max_pixels)
+    except BaseException:
+        if spool is not None:
+            spool.close()
+            os.unlink(spool.name)
+        raise
+    
+    return IngestedUpload(
+        filename=file.filename,
+        data=data if spool is None else None,
+        digest=hasher.hexdigest(),
+        format=image_format,
+        size=size,
+        path=spool.name if spool is not None else None
+    )
+
+
+def batch_item_error(data: bytes) -> Optional[str]:
+    """Why an unpacked batch image is refused, from the same header checks as direct uploads"""
+    if detect_image_format(bytes(data[:12])) not in IMAGE_FORMATS:
+        return "Unsupported file type"
+    try:
+        size = read_image_header(data)
+    except Image.DecompressionBombError as e:
+        return str(e)
+    if size is None:
+        return "Could not read image header"
+    try:
+        check_image_pixels(size)
+    except HTTPException as e:
+        return e.detail
+    return None
+
+
+def describe_white_pixels(percentage: float) -> str:
+    """Human readable verdict for a white pixel percentage"""
+    if percentage > 50:
+        return f"High white pixel concentration ({percentage}%). Image appears to be predominantly white or overexposed."
+    elif percentage > 20:
+        return f"Moderate white pixel concentration ({percentage}%). Image contains significant white areas."
+    elif percentage > 5:
+        return f"Low white pixel concentration ({percentage}%). Image has some white areas."
+    else:
+        return f"Minimal white pixel concentration ({percentage}%). Image has very few white areas."
+
+
+def timestamp_key(value: datetime) -> datetime:
+    """The stored representation of a timestamp, for queries against `timestamp`"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def encode_cursor(analysis: dict) -> str:
+    """Opaque keyset cursor pointing just past an analysis"""
+    timestamp = analysis['timestamp']
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp_key(timestamp).isoformat()
+    raw = json.dumps({'t': timestamp, 'id': analysis['id']}).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """(timestamp, id) from a cursor made by encode_cursor"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return timestamp_key(datetime.fromisoformat(data['t'])), data['id']
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def build_history_query(analysis_type: Optional[str], start: Optional[datetime], end: Optional[datetime], cursor: Optional[str]) -> dict:
+    """MongoDB filter for a page of history, newest first"""
+    conditions = []
+    if analysis_type:
+        conditions.append({"analysis_type": analysis_type})
+    if start:
+        conditions.append({"timestamp": {"$gte": timestamp_key(start)}})
+    if end:
+        conditions.append({"timestamp": {"$lt": timestamp_key(end)}})
+    if cursor:
+        timestamp, analysis_id = decode_cursor(cursor)
+        conditions.append({"$or": [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "id": {"$lt": analysis_id}}
+        ]})
+    
+    if not conditions:
+        return {}
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+def parse_fields(value: Optional[str], allowed: Optional[List[str]] = None) -> Optional[List[str]]:
+    """Parse a ?fields= selection such as 'condition,issues', None selects everything"""
+    if not value:
+        return None
+    fields = list(dict.fromkeys(part.strip() for part in value.split(',') if part.strip()))
+    if not fields or len(fields) > MAX_SELECTED_FIELDS or not all(FIELD_NAME.match(field) for field in fields):
+        raise HTTPException(status_code=400, detail=f"Give 1-{MAX_SELECTED_FIELDS} comma separated top-level field names")
+    if allowed is not None:
+        unknown = [field for field in fields if field not in allowed]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown fields {', '.join(unknown)}, choose from {', '.join(allowed)}"
+            )
+    return fields
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header covers `etag` (weak comparison)"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+
+
+def cacheable_response(request: Request, content, headers: Optional[dict] = None) -> Response:
+    """orjson response with an ETag of its body, or 304 when the client already has it.
+
+    Analyses rarely change once written (only a finishing job updates one),
+    so clients revalidate on every load and pay for the body only when it
+    actually differs.
+    """
+    response = ORJSONResponse(content, headers=headers)
+    etag = f'"{hashlib.blake2b(response.body, digest_size=16).hexdigest()}"'
+    cache_headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers={**(headers or {}), **cache_headers})
+    response.headers.update(cache_headers)
+    return response
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[tuple]:
+    """(start, end) of a single byte range request, inclusive; None sends the whole body.
+
+    Multi-range and malformed headers are ignored, which HTTP allows;
+    ranges that start past the end raise 416.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    
+    first, _, last = spec.strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    
+    if first and end < start and start < size:
+        return None
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={'Content-Range': f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+
+async def serve_stored_image(request: Request, kind: str, digest: str, media_type: str) -> Response:
+    """A stored image with immutable caching, conditional requests and byte ranges.
+
+    Whole files on disk go out as a FileResponse, which servers supporting
+    the ASGI pathsend extension send without copying through Python.
+    """
+    etag = f'"{digest}"' if kind == 'originals' else f'"{digest}-thumbnail"'
+    headers = {'ETag': etag, 'Cache-Control': IMAGE_CACHE_CONTROL, 'Accept-Ranges': 'bytes'}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    
+    stored = await image_store.open(kind, digest)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    # A range only applies to the version the client names in If-Range
+    byte_range = None
+    if_range = request.headers.get('if-range')
+    if if_range is None or if_range.strip() == etag:
+        byte_range = parse_range(request.headers.get('range'), stored.size)
+    
+    if byte_range is None:
+        if stored.path:
+            return FileResponse(stored.path, media_type=media_type, headers=headers)
+        start, end, status_code = 0, stored.size - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers['Content-Range'] = f"bytes {start}-{end}/{stored.size}"
+    headers['Content-Length'] = str(end - start + 1)
+    return StreamingResponse(
+        image_store.read(stored, start, end), status_code=status_code, media_type=media_type, headers=headers
+    )
+
+
+def build_export_query(analysis_type: Optional[str], start: Optional[datetime], end: datetime,
+                       after_timestamp: Optional[datetime], after_id: Optional[str]) -> dict:
+    """MongoDB filter for an export, oldest first, resuming after (after_timestamp, after_id)"""
+    conditions = [{"timestamp": {"$lt": timestamp_key(end)}}]
+    if analysis_type:
+        conditions.append({"analysis_type": analysis_type})
+    if start:
+        conditions.append({"timestamp": {"$gte": timestamp_key(start)}})
+    if after_timestamp:
+        after_timestamp = timestamp_key(after_timestamp)
+        conditions.append({"$or": [
+            {"timestamp": {"$gt": after_timestamp}},
+            {"timestamp": after_timestamp, "id": {"$gt": after_id}}
+        ]})
+    return {"$and": conditions}
+
+
+def export_row(doc: dict) -> dict:
+    """Flat export record: scalars as they are, lists and sub-documents as JSON"""
+    row = {}
+    for column in EXPORT_COLUMNS:
+        value = doc.get(column)
+        if column == 'timestamp' and isinstance(value, datetime):
+            value = timestamp_key(value)
+        elif column in ('issues', 'recommendations') and isinstance(value, list):
+            value = ' | '.join(value)
+        elif isinstance(value, (list, dict)):
+            value = json.dumps(value, default=str)
+        row[column] = value
+    return row
+
+
+class ExportSink:
+    """Write-only file object collecting encoded output until it is drained"""
+    
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+    
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+    
+    def tell(self) -> int:
+        # Parquet writers record offsets, so count everything ever written
+        return self._position
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.closed = True
+    
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def export_json_default(value):
+    if isinstance(value, datetime):
+        return timestamp_key(value).isoformat()
+    return str(value)
+
+
+class NdjsonEncoder:
+    def encode(self, docs: List[dict]) -> bytes:
+        return ''.join(json.dumps(doc, default=export_json_default) + '\n' for doc in docs).encode('utf-8')
+    
+    def finish(self) -> bytes:
+        return b''
+
+
+class CsvEncoder:
+    def __init__(self):
+        self._header = True
+    
+    def encode(self, docs: List[dict]) -> bytes:
+        buffer = StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+        if self._header:
+            writer.writeheader()
+            self._header = False
+        for doc in docs:
+            row = export_row(doc)
+            if isinstance(row['timestamp'], datetime):
+                row['timestamp'] = row['timestamp'].isoformat()
+            writer.writerow(row)
+        return buffer.getvalue().encode('utf-8')
+    
+    def finish(self) -> bytes:
+        return b''
+
+
+class ParquetEncoder:
+    """Writes each batch as a Parquet row group, emitting bytes as they are produced"""
+    
+    def __init__(self):
+        fields = [pyarrow.field(column, pyarrow.string()) for column in EXPORT_COLUMNS]
+        fields[EXPORT_COLUMNS.index('timestamp')] = pyarrow.field('timestamp', pyarrow.timestamp('ms', tz='UTC'))
+        for column in ('white_pixel_count', 'total_pixels', 'sample_scale'):
+            fields[EXPORT_COLUMNS.index(column)] = pyarrow.field(column, pyarrow.int64())
+        fields[EXPORT_COLUMNS.index('percentage')] = pyarrow.field('percentage', pyarrow.float64())
+        self.schema = pyarrow.schema(fields)
+        self._sink = ExportSink()
+        self._writer = pyarrow.parquet.ParquetWriter(self._sink, self.schema, compression='snappy')
+    
+    def encode(self, docs: List[dict]) -> bytes:
+        rows = [export_row(doc) for doc in docs]
+        for row in rows:
+            # Legacy string timestamps can't go into a timestamp column
+            if not isinstance(row['timestamp'], datetime):
+                row['timestamp'] = None
+        self._writer.write_table(pyarrow.Table.from_pylist(rows, schema=self.schema))
+        return self._sink.drain()
+    
+    def finish(self) -> bytes:
+        self._writer.close()
+        return self._sink.drain()
+
+
+async def stream_export(query: dict, encoder, compress: bool):
+    """Encode matching analyses batch by batch, gzipping on the fly if asked"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    cursor = db.analyses.find(query, {"_id": 0}).sort([("timestamp", 1), ("id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+    
+    def emit(data: bytes) -> bytes:
+        return compressor.compress(data) if compressor else data
+    
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            chunk = emit(encoder.encode(batch))
+            batch = []
+            if chunk:
+                yield chunk
+    
+    if batch:
+        yield emit(encoder.encode(batch))
+    tail = emit(encoder.finish())
+    if compressor:
+        tail += compressor.flush()
+    if tail:
+        yield tail
+
+
+def build_summary(analysis: dict) -> str:
+    """One line summary of an analysis for the history list"""
+    status = analysis.get('status', 'completed')
+    if status != 'completed':
+        return f"Status: {status.capitalize()}"
+    if analysis['analysis_type'] == 'white_pixel':
+        return f"White Pixels: {analysis['percentage']}%"
+    if analysis['analysis_type'] == 'vehicle':
+        return (
+            f"Vehicle ({len(analysis.get('panel_ids') or [])} panels) | Color: {analysis['car_color']} | "
+            f"Condition: {analysis['condition']} | {analysis['wash_or_repaint']}"
+        )
+    return f"Color: {analysis['car_color']} | Condition: {analysis['condition']} | {analysis['wash_or_repaint']}"
+
+
+def rollup_key(doc: dict) -> tuple:
+    """(day, analysis_type, car_color) bucket an analysis document counts towards"""
+    timestamp = doc['timestamp']
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    color = (doc.get('car_color') or '').strip().lower()
+    return timestamp_key(timestamp).strftime('%Y-%m-%d'), doc['analysis_type'], color
+
+
+def rollup_increments(doc: dict) -> dict:
+    """Counter increments an analysis document contributes to its bucket"""
+    if doc['analysis_type'] == 'white_pixel':
+        return {'count': 1, 'percentage_sum': doc['percentage']}
+    
+    # Results the model left unclear ('Unknown', empty) count as neither
+    condition = doc.get('condition') or ''
+    action = doc.get('wash_or_repaint') or ''
+    good = bool(GOOD_CONDITION.match(condition))
+    bad = bool(BAD_CONDITION.match(condition))
+    repaint = bool(REPAINT.search(action))
+    wash = bool(WASH.match(action)) and not repaint
+    return {
+        'count': 1,
+        'good': int(good),
+        'bad': int(bad),
+        'unknown_condition': int(not (good or bad)),
+        'wash': int(wash),
+        'repaint': int(repaint),
+        'unknown_action': int(not (wash or repaint)),
+        'bad_and_repaint': int(bad and repaint)
+    }
+
+
+async def update_rollups(docs: List[dict], sign: int = 1):
+    """Fold newly written analyses into their per-day rollup documents.
+
+    With `sign=-1` the analyses are taken back out, for results that were
+    replaced by a re-analysis.
+    """
+    buckets = {}
+    for doc in docs:
+        key = rollup_key(doc)
+        totals = buckets.setdefault(key, {})
+        for counter, value in rollup_increments(doc).items():
+            totals[counter] = totals.get(counter, 0) + sign * value
+    
+    operations = [
+        UpdateOne(
+            {"_id": "|".join(key)},
+            {
+                "$set": {"day": key[0], "analysis_type": key[1], "car_color": key[2]},
+                "$inc": totals
+            },
+            upsert=True
+        )
+        for key, totals in buckets.items()
+    ]
+    await db[ROLLUPS_COLLECTION].bulk_write(operations, ordered=False)
+
+
+@dataclass
+class StoredImage:
+    """An original or thumbnail in the image store, ready to be served"""
+    size: int
+    path: Optional[str] = None  # disk store
+    grid_out: Optional[object] = None  # GridFS store
+
+
+class DiskImageStore:
+    """Images as files under a directory, sharded by the leading digest characters.
+
+    Files are written under a temporary name and renamed into place, so a
+    reader never sees a partial image. Writes run on the image pool next to
+    the thumbnail work; reads run on the default executor so serving never
+    waits behind image processing.
+    """
+    
+    name = 'disk'
+    
+    def __init__(self, root: Path):
+        self.root = root
+    
+    def path(self, kind: str, digest: str) -> Path:
+        return self.root / kind / digest[:2] / digest[2:4] / digest
+    
+    def _write(self, kind: str, digest: str, source) -> bool:
+        target = self.path(kind, digest)
+        if target.exists():
+            return False
+        
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=target.parent, prefix='.incoming-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                if not isinstance(source, str):
+                    out.write(source)
+            # Spooled uploads are copied file to file (sendfile on Linux)
+            if isinstance(source, str):
+                shutil.copyfile(source, temp_path)
+            os.replace(temp_path, target)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return True
+    
+    async def put(self, kind: str, digest: str, source) -> bool:
+        """Store bytes or a file under (kind, digest), False if it was already stored"""
+        return await run_in_image_pool(self._write, kind, digest, source)
+    
+    async def open(self, kind: str, digest: str) -> Optional[StoredImage]:
+        path = self.path(kind, digest)
+        try:
+            stat_result = await asyncio.to_thread(os.stat, path)
+        except FileNotFoundError:
+            return None
+        return StoredImage(size=stat_result.st_size, path=str(path))
+    
+    async def read(self, image: StoredImage, start: int, end: int):
+        """Yield bytes start..end (inclusive) of a stored image"""
+        with open(image.path, 'rb') as file:
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(file.read, min(IMAGE_CHUNK_BYTES, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    
+    def _delete(self, digest: str):
+        for kind in ('originals', 'thumbnails'):
+            self.path(kind, digest).unlink(missing_ok=True)
+    
+    async def delete(self, digest: str):
+        await run_in_image_pool(self._delete, digest)
+
+
+class GridFSImageStore:
+    """Images in a GridFS bucket, one file per original or thumbnail with id 'kind/digest'"""
+    
+    name = 'gridfs'
+    
+    def bucket(self) -> AsyncIOMotorGridFSBucket:
+        return AsyncIOMotorGridFSBucket(db, bucket_name=IMAGE_STORE_BUCKET)
+    
+    async def put(self, kind: str, digest: str, source) -> bool:
+        """Store bytes or a file under (kind, digest), False if it was already stored"""
+        file_id = f"{kind}/{digest}"
+        if await db[f"{IMAGE_STORE_BUCKET}.files"].find_one({"_id": file_id}, {"_id": 1}):
+            return False
+        
+        try:
+            if not isinstance(source, str):
+                await self.bucket().upload_from_stream_with_id(file_id, digest, bytes(source))
+                return True
+            
+            # Spooled uploads are streamed in chunks, read off the event loop
+            grid_in = self.bucket().open_upload_stream_with_id(file_id, digest)
+            try:
+                with open(source, 'rb') as file:
+                    while chunk := await asyncio.to_thread(file.read, IMAGE_CHUNK_BYTES):
+                        await grid_in.write(chunk)
+                await grid_in.close()
+            except BaseException:
+                await grid_in.abort()
+                raise
+        except DuplicateKeyError:
+            # Another request stored the same image meanwhile
+            return False
+        return True
+    
+    async def open(self, kind: str, digest: str) -> Optional[StoredImage]:
+        try:
+            grid_out = await self.bucket().open_download_stream(f"{kind}/{digest}")
+        except NoFile:
+            return None
+        return StoredImage(size=grid_out.length, grid_out=grid_out)
+    
+    async def read(self, image: StoredImage, start: int, end: int):
+        """Yield bytes start..end (inclusive) of a stored image"""
+        image.grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await image.grid_out.read(min(IMAGE_CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    
+    async def delete(self, digest: str):
+        for kind in ('originals', 'thumbnails'):
+            try:
+                await self.bucket().delete(f"{kind}/{digest}")
+            except NoFile:
+                pass
+
+
+def create_image_store():
+    if IMAGE_STORE == 'none':
+        return None
+    if IMAGE_STORE == 'gridfs':
+        return GridFSImageStore()
+    if IMAGE_STORE != 'disk':
+        raise ValueError(f"IMAGE_STORE must be disk, gridfs or none, got {IMAGE_STORE!r}")
+    return DiskImageStore(IMAGE_STORE_DIR)
+
+
+image_store = create_image_store()
+image_store_stats = Counter()
+
+
+async def store_image(upload: IngestedUpload, thumbnail: Optional[bytes]) -> Optional[str]:
+    """Keep an analyzed upload and its thumbnail, returns the digest to record on the analysis.
+
+    The reference document is written first, so anything in the store is
+    known to the garbage collector even if the analysis is never saved. An
+    image the collector is deleting is waited for and then written again;
+    files missing from the store are always re-created. Storage is best
+    effort: a failure is logged and the analysis goes on without an image.
+    """
+    if image_store is None:
+        return None
+    try:
+        deadline = time.monotonic() + IMAGE_GC_WAIT_SECONDS
+        while True:
+            now = datetime.now(timezone.utc)
+            stale = datetime.fromtimestamp(now.timestamp() - IMAGE_GC_CLAIM_SECONDS, timezone.utc)
+            try:
+                await db[IMAGE_REFS_COLLECTION].update_one(
+                    {"_id": upload.digest, "collecting_at": {"$not": {"$gt": stale}}},
+                    {
+                        "$setOnInsert": {
+                            "refs": 0,
+                            "format": upload.format,
+                            "bytes": os.path.getsize(upload.path) if upload.path else len(upload.data),
+                            "size": list(upload.size) if upload.size else None,
+                            "created_at": now
+                        },
+                        "$set": {"thumbnail": thumbnail is not None, "last_referenced_at": now},
+                        "$unset": {"collecting_at": ""}
+                    },
+                    upsert=True
+                )
+                break
+            except DuplicateKeyError:
+                # The reference exists but is claimed by a running collection
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+        with STAGE_SECONDS.labels('image_store').time():
+            if await image_store.put('originals', upload.digest, upload.source):
+                image_store_stats['stored'] += 1
+            else:
+                image_store_stats['deduplicated'] += 1
+            if thumbnail is not None:
+                await image_store.put('thumbnails', upload.digest, thumbnail)
+        return upload.digest
+    except Exception as e:
+        image_store_stats['failed'] += 1
+        logger.error(f"Error storing image {upload.filename}: {str(e)}")
+        return None
+
+
+async def load_stored_image(digest: str):
+    """An original from the image store: a file path (disk store) or bytes, None if missing"""
+    stored = await image_store.open('originals', digest) if image_store is not None else None
+    if stored is None:
+        return None
+    if stored.path:
+        return stored.path
+    return b''.join([chunk async for chunk in image_store.read(stored, 0, stored.size - 1)])
+
+
+async def store_upload(upload: IngestedUpload) -> Optional[str]:
+    """Render the thumbnail off the event loop, then store the upload with it"""
+    if image_store is None:
+        return None
+    try:
+        with STAGE_SECONDS.labels('thumbnail').time():
+            thumbnail = await run_in_image_pool(make_thumbnail, upload.source)
+    except Exception as e:
+        logger.error(f"Error creating thumbnail of {upload.filename}: {str(e)}")
+        thumbnail = None
+    return await store_image(upload, thumbnail)
+
+
+async def add_image_refs(docs: List[dict]):
+    """Count new analyses towards the stored images they show"""
+    digests = Counter(doc['image_digest'] for doc in docs if doc.get('image_digest'))
+    if not digests:
+        return
+    now = datetime.now(timezone.utc)
+    await db[IMAGE_REFS_COLLECTION].bulk_write([
+        UpdateOne({"_id": digest}, {"$inc": {"refs": count}, "$set": {"last_referenced_at": now}})
+        for digest, count in digests.items()
+    ], ordered=False)
+
+
+async def collect_images(grace_seconds: int = IMAGE_GC_GRACE_SECONDS, dry_run: bool = False) -> dict:
+    """Recount image references from `analyses` and delete images nothing refers to.
+
+    Analyses removed outside the API (the retention TTL index, manual
+    deletes) never decrement their counts, so every sweep recounts from
+    the analyses themselves. Counts are only replaced if they did not change
+    meanwhile, and an image is deleted only once it has been unreferenced
+    for `grace_seconds`, which covers uploads still being analyzed.
+    """
+    refs = db[IMAGE_REFS_COLLECTION]
+    counts = {}
+    async for row in db.analyses.aggregate([
+        {"$match": {"image_digest": {"$type": "string"}}},
+        {"$group": {"_id": "$image_digest", "refs": {"$sum": 1}}}
+    ]):
+        counts[row['_id']] = row['refs']
+    
+    cutoff = datetime.fromtimestamp(datetime.now(timezone.utc).timestamp() - grace_seconds, timezone.utc)
+    operations = []
+    unreferenced = []
+    async for ref in refs.find({}, {"refs": 1, "bytes": 1, "last_referenced_at": 1}):
+        actual = counts.get(ref['_id'], 0)
+        if ref.get('refs') != actual:
+            operations.append(UpdateOne({"_id": ref['_id'], "refs": ref.get('refs')}, {"$set": {"refs": actual}}))
+        if actual == 0 and ref['last_referenced_at'] < cutoff:
+            unreferenced.append(ref)
+    
+    if dry_run:
+        return {
+            'recounted': len(operations),
+            'deleted': len(unreferenced),
+            'freed_bytes': sum(ref.get('bytes') or 0 for ref in unreferenced)
+        }
+    if operations:
+        await refs.bulk_write(operations, ordered=False)
+    
+    deleted = 0
+    freed = 0
+    for ref in unreferenced:
+        # Only images nothing referenced since the scan are claimed. Uploads
+        # of a claimed image wait in store_image until the reference is gone,
+        # then store the files again
+        unchanged = {"_id": ref['_id'], "refs": 0, "last_referenced_at": ref['last_referenced_at']}
+        claim = await refs.update_one(unchanged, {"$set": {"collecting_at": datetime.now(timezone.utc)}})
+        if not claim.modified_count:
+            continue
+        if image_store is not None:
+            await image_store.delete(ref['_id'])
+        if (await refs.delete_one(unchanged)).deleted_count:
+            deleted += 1
+            freed += ref.get('bytes') or 0
+    
+    image_store_stats['collected'] += deleted
+    return {'recounted': len(operations), 'deleted': deleted, 'freed_bytes': freed}
+
+
+async def save_analyses(docs: List[dict]):
+    """Persist analysis documents and update the rollups they count towards"""
+    with STAGE_SECONDS.labels('db_insert').time():
+        if len(docs) == 1:
+            await db.analyses.insert_one(docs[0])
+        else:
+            await db.analyses.insert_many(docs)
+    phash_index.add_docs(docs)
+    
+    try:
+        await add_image_refs(docs)
+    except Exception as e:
+        logger.error(f"Error counting image references: {str(e)}")
+    
+    # Rollups are derived data and can be rebuilt, never fail the request on them
+    try:
+        with STAGE_SECONDS.labels('db_rollups').time():
+            await update_rollups(docs)
+    except Exception as e:
+        logger.error(f"Error updating analysis rollups: {str(e)}")
+
+
+def analysis_to_doc(analysis: BaseModel) -> dict:
+    """Convert an analysis model into a MongoDB document"""
+    # Timestamps are stored as native BSON dates
+    return analysis.model_dump()
+
+
+def vehicle_to_docs(vehicle: VehicleAnalysis) -> List[dict]:
+    """The vehicle document followed by one document per panel"""
+    doc = analysis_to_doc(vehicle)
+    # Panels are stored as their own analyses and referenced by id
+    doc['panel_ids'] = [panel['id'] for panel in doc.pop('panels')]
+    return [doc] + [analysis_to_doc(panel) for panel in vehicle.panels]
+
+
+def batch_upload_members(upload: IngestedUpload) -> List[zipfile.ZipInfo]:
+    """The image members of a zip archive, checked by their declared sizes before anything is inflated"""
+    try:
+        with zipfile.ZipFile(BytesIO(upload.data)) as archive:
+            infos = archive.infolist()
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail=f"{upload.filename} is not a valid zip archive")
+    
+    members = []
+    for info in infos:
+        # Skip directories and macOS resource forks
+        if info.is_dir() or info.filename.startswith('__MACOSX/'):
+            continue
+        if info.file_size > MAX_UPLOAD_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"{info.filename} exceeds {MAX_UPLOAD_BYTES} bytes"
+            )
+        members.append(info)
+    return members
+
+
+def expand_batch_upload(upload: IngestedUpload, members: List[zipfile.ZipInfo]):
+    """Yield the (name, bytes, error) items of a batch upload, inflating one archive member at a time"""
+    if upload.format != 'ZIP':
+        yield upload.filename, upload.data, None
+        return
+    
+    with zipfile.ZipFile(BytesIO(upload.data)) as archive:
+        for info in members:
+            # Reads stop at the declared size, so the checks above hold. A
+            # corrupt, encrypted or unsupported member only fails itself
+            try:
+                yield info.filename, archive.read(info), None
+            except (zipfile.BadZipFile, zlib.error, RuntimeError, NotImplementedError) as e:
+                yield info.filename, None, f"Could not extract image from archive: {str(e)}"
+
+
+def replace_batch_executor(broken: ProcessPoolExecutor):
+    """Swap in a new process pool after a worker died, unless another request already did"""
+    global batch_executor
+    if batch_executor is broken:
+        logger.error("Batch worker process died, starting a new process pool")
+        batch_executor = create_batch_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+
+class LlmScheduler:
+    """Admission control for upstream model calls.
+
+    At most `max_concurrency` calls run at once, optionally paced by a token
+    bucket. Callers beyond that wait in a bounded queue; when the queue is
+    full, or a caller waits longer than `queue_timeout`, the request fails
+    fast with a 503 instead of piling up. Each call has a deadline and
+    retryable errors are retried with full-jitter exponential backoff.
+    """
+    
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float, rate_per_second: float,
+                 burst: int, timeout: float, max_retries: int, retry_base: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.retries = 0
+    
+    async def _take_token(self):
+        """Wait for a token from the rate limiting bucket"""
+        if self.rate_per_second <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate_per_second)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate_per_second)
+    
+    def _reject(self, detail: str):
+        self.rejected += 1
+        raise HTTPException(
+            status_code=503,
+            detail=detail,
+            headers={"Retry-After": str(max(1, int(self.queue_timeout)))}
+        )
+    
+    async def run(self, call):
+        """Run `call()` (a coroutine factory) under the scheduler's limits"""
+        if self.waiting >= self.max_queue:
+            self._reject(f"Vision model queue is full ({self.waiting} waiting), retry shortly")
+        
+        self.waiting += 1
+        queued_at = time.perf_counter()
+        acquired = False
+        try:
+            try:
+                async with asyncio.timeout(self.queue_timeout):
+                    acquired = await self._semaphore.acquire()
+            except TimeoutError:
+                self._reject("Timed out waiting for the vision model, retry shortly")
+            finally:
+                self.waiting -= 1
+                STAGE_SECONDS.labels('llm_queue').observe(time.perf_counter() - queued_at)
+            
+            self.in_flight += 1
+            try:
+                return await self._call_with_retries(call)
+            finally:
+                self.in_flight -= 1
+        finally:
+            # A caller cancelled or timed out in the queue never held a permit
+            if acquired:
+                self._semaphore.release()
+    
+    @staticmethod
+    def _retry_status(error: Exception) -> Optional[int]:
+        """Status to report if `error` is worth retrying, None if it is not.
+
+        Errors raised by the model client are classified by type and by the
+        HTTP status they carry, following wrapped causes; our own
+        HTTPExceptions are never retried.
+        """
+        if isinstance(error, HTTPException):
+            return None
+        seen = set()
+        while error is not None and id(error) not in seen:
+            seen.add(id(error))
+            if isinstance(error, TRANSIENT_LLM_ERRORS):
+                return 502
+            status = getattr(error, 'status_code', None) or getattr(error, 'status', None)
+            if isinstance(status, int):
+                return (429 if status == 429 else 502) if status in RETRYABLE_LLM_STATUSES else None
+            error = error.__cause__ or error.__context__
+        return None
+    
+    async def _call_with_retries(self, call):
+        """Await `call()` with a deadline, retrying transient errors with backoff"""
+        attempt = 0
+        while True:
+            await self._take_token()
+            try:
+                with STAGE_SECONDS.labels('llm_request').time():
+                    result = await asyncio.wait_for(call(), timeout=self.timeout)
+                self.completed += 1
+                return result
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                error = f"Vision model did not respond within {self.timeout}s"
+                status_code = 504
+            except Exception as e:
+                status_code = self._retry_status(e)
+                if status_code is None:
+                    self.failed += 1
+                    raise
+                error = str(e)
+            
+            attempt += 1
+            if attempt > self.max_retries:
+                self.failed += 1
+                raise HTTPException(status_code=status_code, detail=error)
+            
+            self.retries += 1
+            logger.error(f"Retrying vision model call (attempt {attempt + 1}): {error}")
+            await asyncio.sleep(random.uniform(0, self.retry_base * 2 ** (attempt - 1)))
+    
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.waiting,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'max_concurrency': self.max_concurrency,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'retries': self.retries
+        }
+
+
+llm_scheduler = LlmScheduler(
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    max_queue=LLM_MAX_QUEUE,
+    queue_timeout=LLM_QUEUE_TIMEOUT_SECONDS,
+    rate_per_second=LLM_RATE_PER_SECOND,
+    burst=LLM_BURST,
+    timeout=LLM_TIMEOUT_SECONDS,
+    max_retries=LLM_MAX_RETRIES,
+    retry_base=LLM_RETRY_BASE_SECONDS
+)
+
+
+def difference_hash(image: Image.Image) -> str:
+    """64-bit dHash of an image as 16 hex digits.
+
+    Each bit records whether a pixel of a 9x8 grayscale thumbnail is darker
+    than its right neighbour, which survives rescaling and recompression.
+    """
+    pixels = image.convert('L').resize((9, 8), Image.Resampling.LANCZOS).tobytes()
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] < pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+def prepare_image_for_model(image_data: bytes) -> tuple:
+    """Decode, orient, downscale and re-encode an upload for the vision model"""
+    started = time.perf_counter()
+    with pil_pixel_limit(MAX_IMAGE_PIXELS):
+        image = Image.open(BytesIO(image_data))
+    source_size = image.size
+    source_format = image.format
+    oriented = image.getexif().get(0x0112, 1) != 1
+    
+    # JPEG can decode straight to 1/2, 1/4 or 1/8 scale, far cheaper than
+    # decoding at full size and resizing afterwards
+    draft_to_fit(image, MODEL_IMAGE_MAX_EDGE)
+    
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.thumbnail((MODEL_IMAGE_MAX_EDGE, MODEL_IMAGE_MAX_EDGE), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    phash = difference_hash(image)
+    decoded = time.perf_counter()
+    
+    buffer = BytesIO()
+    image.save(buffer, format=MODEL_IMAGE_FORMAT, quality=MODEL_IMAGE_QUALITY)
+    payload = buffer.getvalue()
+    encoded = time.perf_counter()
+    
+    # Small, upright uploads in a model-friendly format are sent untouched
+    # when re-encoding would not make them any smaller
+    untouched = image.size == source_size and not oriented
+    if untouched and source_format in ('JPEG', 'PNG', 'WEBP') and len(payload) >= len(image_data):
+        payload = image_data
+    
+    return payload, {
+        'source_bytes': len(image_data),
+        'source_size': list(source_size),
+        'payload_bytes': len(payload),
+        'payload_size': list(image.size),
+        'payload_format': MODEL_IMAGE_FORMAT if payload is not image_data else source_format,
+        'phash': phash,
+        'decode_ms': round((decoded - started) * 1000, 2),
+        'encode_ms': round((encoded - decoded) * 1000, 2)
+    }
+
+
+# Named colors for the local heuristic: achromatic classes by brightness,
+# the rest by hue (upper bound in degrees)
+ACHROMATIC_COLORS = ['Black', 'Grey', 'Silver', 'White']
+HUE_BOUNDS = [15, 40, 70, 170, 260, 300, 345]
+HUE_COLORS = ['Red', 'Orange', 'Yellow', 'Green', 'Blue', 'Purple', 'Pink', 'Red']
+
+# Local heuristic limits: pixel-to-pixel gray step counted as an edge, and the
+# shares of edge and rust-colored pixels above which a panel counts as damaged
+LOCAL_EDGE_STEP = 40
+LOCAL_DAMAGE_EDGE_SHARE = 0.08
+LOCAL_DAMAGE_RUST_SHARE = 0.03
+LOCAL_DIRT_UNEVENNESS = 0.05
+
+
+def local_bonnet_assessment(payload: bytes) -> dict:
+    """Deterministic color and condition estimate computed from the pixels alone.
+
+    Color is the most common named color in the middle of the frame, where
+    the panel usually is. Damage is inferred from the share of sharp edges
+    (scratches, chips, dents) and of rust-colored pixels, dirt from uneven
+    brightness. Confidence is low near the decision thresholds and when no
+    single color dominates, and zero for images under LOCAL_MIN_EDGE.
+    """
+    image = Image.open(BytesIO(payload))
+    if image.format == 'JPEG':
+        image.draft('RGB', (LOCAL_ANALYSIS_EDGE, LOCAL_ANALYSIS_EDGE))
+    image = image.convert('RGB')
+    image.thumbnail((LOCAL_ANALYSIS_EDGE, LOCAL_ANALYSIS_EDGE))
+    width, height = image.size
+    if min(width, height) < LOCAL_MIN_EDGE:
+        return {
+            **unknown_bonnet_result(
+                f"Local heuristic assessment (no vision model): the {width}x{height} image is too small "
+                f"to assess, at least {LOCAL_MIN_EDGE}x{LOCAL_MIN_EDGE} pixels are needed."
+            ),
+            'confidence': 0.0
+        }
+    center = image.crop((width // 5, height // 5, width - width // 5, height - height // 5))
+    
+    hsv = np.asarray(center.convert('HSV'), dtype=np.float32) / 255.0
+    hue, saturation, value = hsv[..., 0] * 360, hsv[..., 1], hsv[..., 2]
+    
+    # Dominant named color
+    achromatic = (saturation < 0.2) | (value < 0.2)
+    brightness_class = np.select([value < 0.25, value < 0.55, value < 0.8], [0, 1, 2], 3)
+    hue_class = np.searchsorted(HUE_BOUNDS, hue, side='right')
+    shares = Counter()
+    for index, count in enumerate(np.bincount(brightness_class[achromatic], minlength=4)):
+        shares[ACHROMATIC_COLORS[index]] += int(count)
+    for index, count in enumerate(np.bincount(hue_class[~achromatic], minlength=len(HUE_COLORS))):
+        shares[HUE_COLORS[index]] += int(count)
+    color, color_pixels = shares.most_common(1)[0]
+    color_share = color_pixels / hue.size
+    
+    # Surface damage and dirt
+    gray = np.asarray(center.convert('L'), dtype=np.float32)
+    steps = np.abs(np.diff(gray, axis=1))[:-1, :] + np.abs(np.diff(gray, axis=0))[:, :-1]
+    edge_share = float((steps > LOCAL_EDGE_STEP).mean())
+    rust = (hue >= 10) & (hue < 40) & (saturation > 0.4) & (value > 0.15) & (value < 0.6)
+    rust_share = float(rust.mean()) if color not in ('Orange', 'Red') else 0.0
+    rows, cols = value.shape[0] // 8 * 8, value.shape[1] // 8 * 8
+    blocks = value[:rows, :cols].reshape(8, rows // 8, 8, cols // 8).mean(axis=(1, 3))
+    unevenness = float(blocks.std())
+    
+    damage = max(edge_share / LOCAL_DAMAGE_EDGE_SHARE, rust_share / LOCAL_DAMAGE_RUST_SHARE)
+    bad = damage >= 1
+    condition_confidence = 0.5 + 0.5 * (min(1.0, damage - 1) if bad else 1 - damage)
+    confidence = round(min(condition_confidence, color_share), 3)
+    
+    issues = []
+    recommendations = []
+    if rust_share > LOCAL_DAMAGE_RUST_SHARE:
+        issues.append(f"Possible rust or corrosion ({rust_share * 100:.1f}% of the panel)")
+        recommendations.append("Treat the corrosion and repaint the affected area")
+    if edge_share > LOCAL_DAMAGE_EDGE_SHARE:
+        issues.append("Scratches, chips or dents suggested by the surface texture")
+        recommendations.append("Inspect closely and repair the paint damage")
+    if unevenness > LOCAL_DIRT_UNEVENNESS:
+        issues.append("Uneven finish, likely dirt accumulation")
+        recommendations.append("Wash and re-inspect the finish once clean")
+    if not recommendations:
+        recommendations.append("Regular washing recommended")
+    
+    return {
+        'car_color': color,
+        'condition': 'Bad' if bad else 'Good',
+        'wash_or_repaint': 'Repaint' if bad else 'Wash',
+        'issues': issues,
+        'recommendations': recommendations,
+        'detailed_report': (
+            f"Local heuristic assessment (no vision model). Dominant color {color} "
+            f"({color_share * 100:.0f}% of the panel), edge share {edge_share * 100:.1f}%, "
+            f"rust-colored share {rust_share * 100:.1f}%, brightness unevenness {unevenness:.3f}. "
+            f"Confidence {confidence:.2f}."
+        ),
+        'confidence': confidence
+    }
+
+
+def combine_panel_results(panels: List[str], results: List[dict]) -> dict:
+    """Vehicle verdict from per-panel results: bad if any panel is, repaint if any panel needs it"""
+    bad = [panel for panel, result in zip(panels, results) if result['condition'] == 'Bad']
+    repaint = any(result['wash_or_repaint'] == 'Repaint' for result in results)
+    colors = Counter(result['car_color'] for result in results)
+    return {
+        'car_color': colors.most_common(1)[0][0],
+        'condition': 'Bad' if bad else 'Good',
+        'wash_or_repaint': 'Repaint' if repaint else 'Wash',
+        'issues': [f"{panel}: {issue}" for panel, result in zip(panels, results) for issue in result['issues']],
+        'recommendations': list(dict.fromkeys(r for result in results for r in result['recommendations'])),
+        'detailed_report': (
+            f"{len(bad)} of {len(panels)} panels need work" + (f" ({', '.join(bad)})." if bad else ".")
+        ),
+        'confidence': min((result.get('confidence') or 0.0) for result in results)
+    }
+
+
+class VisionStats:
+    """Per-tier call counts and latency, and which tier answered each request"""
+    
+    tiers = ('local', 'remote')
+    
+    def __init__(self):
+        self.calls = Counter()
+        self.seconds = Counter()
+        self.answered = Counter()
+        self.escalations = 0
+    
+    async def timed(self, tier: str, call):
+        started = time.perf_counter()
+        try:
+            return await call
+        finally:
+            elapsed = time.perf_counter() - started
+            self.calls[tier] += 1
+            self.seconds[tier] += elapsed
+            STAGE_SECONDS.labels(f'vision_{tier}').observe(elapsed)
+    
+    def stats(self) -> dict:
+        total = sum(self.answered.values())
+        stats = {'provider': VISION_PROVIDER, 'escalations': self.escalations}
+        for tier in self.tiers:
+            stats[f'{tier}_calls'] = self.calls[tier]
+            stats[f'{tier}_mean_ms'] = round(self.seconds[tier] / self.calls[tier] * 1000, 2) if self.calls[tier] else 0.0
+            stats[f'{tier}_share'] = round(self.answered[tier] / total, 4) if total else 0.0
+        return stats
+
+
+vision_stats = VisionStats()
+
+
+class RemoteVisionProvider:
+    """The configured LLM, called through the scheduler"""
+    
+    name = 'remote'
+    
+    async def _send(self, text: str, payloads: List[bytes]) -> str:
+        with STAGE_SECONDS.labels('bonnet_base64').time():
+            images = [ImageContent(image_base64=base64.b64encode(payload).decode('utf-8')) for payload in payloads]
+        
+        # Create user message with the images
+        user_message = UserMessage(text=text, file_contents=images)
+        
+        async def send():
+            # Fresh chat instance per attempt so retries don't replay history
+            chat = LlmChat(
+                api_key=API_KEY,
+                session_id=str(uuid.uuid4()),
+                system_message=BONNET_SYSTEM_MESSAGE
+            ).with_model(BONNET_MODEL_PROVIDER, BONNET_MODEL)
+            return await chat.send_message(user_message)
+        
+        # Send message through the scheduler and get response
+        with STAGE_SECONDS.labels('llm_call').time():
+            return await llm_scheduler.run(send)
+    
+    async def analyze(self, payload: bytes) -> dict:
+        response = await self._send(BONNET_PROMPT, [payload])
+        with STAGE_SECONDS.labels('bonnet_parse').time():
+            return parse_gpt4_response(response)
+    
+    async def analyze_vehicle(self, payloads: List[bytes], panels: List[str], filenames: List[str]) -> tuple:
+        # One message carrying every panel, labelled in the prompt by position
+        panel_list = '\n'.join(
+            f"Image {index}: {panel} ({filename})"
+            for index, (panel, filename) in enumerate(zip(panels, filenames), start=1)
+        )
+        response = await self._send(VEHICLE_PROMPT.replace('{panels}', panel_list), payloads)
+        with STAGE_SECONDS.labels('vehicle_parse').time():
+            return parse_vehicle_response(response, len(payloads))
+
+
+class LocalVisionProvider:
+    """Pixel heuristics computed on the image pool, no network needed"""
+    
+    name = 'local'
+    
+    async def analyze(self, payload: bytes) -> dict:
+        return await run_in_image_pool(local_bonnet_assessment, payload)
+    
+    async def analyze_vehicle(self, payloads: List[bytes], panels: List[str], filenames: List[str]) -> tuple:
+        results = await asyncio.gather(*[self.analyze(payload) for payload in payloads])
+        return combine_panel_results(panels, results), list(results)
+
+
+class VisionRouter:
+    """Routes analyses to the configured provider(s) and records per-tier stats.
+
+    In 'tiered' mode every image is assessed locally first and only sent to
+    the remote model when the local confidence is below the threshold.
+    """
+    
+    def __init__(self, mode: str, threshold: float):
+        if mode not in ('remote', 'local', 'tiered'):
+            raise ValueError(f"Unknown VISION_PROVIDER {mode!r}, use remote, local or tiered")
+        self.mode = mode
+        self.threshold = threshold
+        self.local = LocalVisionProvider()
+        self.remote = RemoteVisionProvider()
+    
+    async def _route(self, method: str, confidence, *args):
+        if self.mode != 'remote':
+            result = await vision_stats.timed('local', getattr(self.local, method)(*args))
+            if self.mode == 'local' or confidence(result) >= self.threshold:
+                vision_stats.answered['local'] += 1
+                return 'local', result
+            vision_stats.escalations += 1
+        
+        result = await vision_stats.timed('remote', getattr(self.remote, method)(*args))
+        vision_stats.answered['remote'] += 1
+        return 'remote', result
+    
+    async def analyze(self, payload: bytes) -> dict:
+        tier, result = await self._route('analyze', lambda r: r['confidence'], payload)
+        result['provider'] = tier
+        return result
+    
+    async def analyze_vehicle(self, payloads: List[bytes], panels: List[str], filenames: List[str]) -> tuple:
+        # Escalate the whole vehicle when any panel is uncertain
+        tier, (vehicle, results) = await self._route(
+            'analyze_vehicle', lambda r: min(panel['confidence'] for panel in r[1]), payloads, panels, filenames
+        )
+        for result in [vehicle] + results:
+            result['provider'] = tier
+        return vehicle, results
+
+
+vision_router = VisionRouter(VISION_PROVIDER, LOCAL_CONFIDENCE_THRESHOLD)
+
+
+async def analyze_bonnet_with_gpt4(image_data: bytes, filename: str, prepared: Optional[tuple] = None) -> dict:
+    """Analyze car bonnet with the configured vision provider.
+
+    `prepared` is the output of prepare_image_for_model when the caller
+    already has it.
+    """
+    try:
+        # Shrink the upload off the event loop
+        if prepared is None:
+            prepared = await run_in_image_pool(prepare_image_for_model, image_data)
+        payload, preprocessing = prepared
+        STAGE_SECONDS.labels('bonnet_decode').observe(preprocessing['decode_ms'] / 1000)
+        STAGE_SECONDS.labels('bonnet_encode').observe(preprocessing['encode_ms'] / 1000)
+        logger.info(
+            f"Prepared {filename} for vision model: {preprocessing['source_bytes']} -> "
+            f"{preprocessing['payload_bytes']} bytes, decode {preprocessing['decode_ms']}ms, "
+            f"encode {preprocessing['encode_ms']}ms"
+        )
+        
+        result = await vision_router.analyze(payload)
+        result['phash'] = preprocessing['phash']
+        result['preprocessing'] = preprocessing
+        return result
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error analyzing bonnet with GPT-4: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error analyzing image: {str(e)}")
+
+
+# Keys of the legacy line format, as written by models that ignore the JSON
+# instructions, mapped to result fields
+LEGACY_RESPONSE_KEYS = {
+    'COLOR': 'car_color',
+    'CAR COLOR': 'car_color',
+    'CONDITION': 'condition',
+    'RECOMMENDATION': 'wash_or_repaint',
+    'WASH OR REPAINT': 'wash_or_repaint',
+    'ISSUES': 'issues',
+    'RECOMMENDATIONS': 'recommendations',
+    'DETAILED REPORT': 'detailed_report'
+}
+LEGACY_KEY_LINE = re.compile(
+    r'^[\s>#*_`-]*(?:\d+\.[\s*_`]*)?(' + '|'.join(k.replace(' ', '[ _]') for k in LEGACY_RESPONSE_KEYS) + r')'
+    r'[*_`\s]*:[*_`\s]*(.*)$',
+    re.IGNORECASE
+)
+JSON_FENCE = re.compile(r'```(?:json)?\s*(.*?)```', re.DOTALL | re.IGNORECASE)
+
+# How model responses were parsed: 'structured' (valid JSON), 'salvaged'
+# (JSON missing the schema), 'fallback' (line format) or 'failed' (no
+# condition found)
+bonnet_parse_stats = Counter()
+
+
+def unknown_bonnet_result(response: str) -> dict:
+    return {
+        'car_color': 'Unknown',
+        'condition': 'Unknown',
+        'wash_or_repaint': 'Unknown',
+        'issues': [],
+        'recommendations': [],
+        'detailed_report': response
+    }
+
+
+def normalize_choice(value: str, choices: tuple) -> str:
+    """Map free text like '**bad**' or 'Repaint recommended' onto one of `choices`"""
+    text = value.strip(' *_`[]."\'').lower()
+    for choice in choices:
+        if text == choice.lower():
+            return choice
+    for choice in choices:
+        if re.search(rf'\b{choice.lower()}\b', text):
+            return choice
+    return 'Unknown'
+
+
+def split_items(text: str) -> List[str]:
+    """Items from a '|'-separated line or a bulleted/numbered list"""
+    items = []
+    for line in text.splitlines():
+        line = re.sub(r'^\s*(?:[-*•]|\d+[.)])\s+', '', line).strip().strip('[]')
+        items.extend(item.strip() for item in line.split('|'))
+    return [item for item in items if item and item.lower() not in ('none', 'n/a')]
+
+
+def json_objects(response: str) -> List[dict]:
+    """JSON objects in the response: all of it, fenced blocks or the outermost braces"""
+    candidates = [response.strip()] + [match.strip() for match in JSON_FENCE.findall(response)]
+    start, end = response.find('{'), response.rfind('}')
+    if 0 <= start < end:
+        candidates.append(response[start:end + 1])
+    
+    objects = []
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            objects.append(data)
+    return objects
+
+
+def parse_structured_response(response: str, validator: Draft202012Validator = bonnet_response_validator) -> Optional[dict]:
+    """The response as a schema-valid dict, or None if it is not valid JSON output"""
+    for data in json_objects(response):
+        if validator.is_valid(data):
+            return data
+    return None
+
+
+def salvage_bonnet_fields(data: dict) -> dict:
+    """The usable fields of a JSON assessment that misses the schema.
+
+    Keys may be spelled like the line format ('Car Color'), choices in any
+    case or wording ('good', 'Wash and polish') and lists as plain text.
+    """
+    fields = {}
+    for key, value in data.items():
+        # The line format's keys cover the schema's field names too
+        field = LEGACY_RESPONSE_KEYS.get(re.sub(r'[ _]+', ' ', str(key).strip().upper()))
+        if field == 'condition' and isinstance(value, str):
+            value = normalize_choice(value, ('Good', 'Bad'))
+        elif field == 'wash_or_repaint' and isinstance(value, str):
+            value = normalize_choice(value, ('Wash', 'Repaint'))
+        elif field in ('issues', 'recommendations') and isinstance(value, (str, list)):
+            if isinstance(value, list):
+                value = '\n'.join(item for item in value if isinstance(item, str))
+            fields[field] = split_items(value)
+            continue
+        elif field in ('car_color', 'detailed_report') and isinstance(value, str):
+            value = value.strip()
+        else:
+            continue
+        if value and value != 'Unknown':
+            fields[field] = value
+    return fields
+
+
+def structured_bonnet_result(data: dict) -> dict:
+    """Result fields from a schema-valid assessment"""
+    result = {field: data[field] for field in BONNET_RESPONSE_SCHEMA['required']}
+    result['issues'] = [i.strip() for i in result['issues'] if i.strip()]
+    result['recommendations'] = [r.strip() for r in result['recommendations'] if r.strip()]
+    return result
+
+
+def parse_legacy_response(response: str) -> dict:
+    """Parse the 'KEY: value' line format, tolerating markdown and multi-line values"""
+    result = unknown_bonnet_result(response)
+    sections = {}
+    current = None
+    
+    for line in response.splitlines():
+        match = LEGACY_KEY_LINE.match(line)
+        if match:
+            current = LEGACY_RESPONSE_KEYS[re.sub(r'[ _]+', ' ', match.group(1).upper())]
+            sections[current] = [match.group(2)]
+        elif current is not None:
+            # Continuation lines belong to the last key seen
+            sections[current].append(line)
+    
+    for field, lines in sections.items():
+        text = '\n'.join(lines).strip()
+        if field == 'condition':
+            result[field] = normalize_choice(text, ('Good', 'Bad'))
+        elif field == 'wash_or_repaint':
+            result[field] = normalize_choice(text, ('Wash', 'Repaint'))
+        elif field in ('issues', 'recommendations'):
+            result[field] = split_items(text)
+        elif text:
+            result[field] = text.strip(' *_`[]')
+    
+    return result
+
+
+def parse_gpt4_response(response: str) -> dict:
+    """Parse GPT-4 response into structured data.
+
+    Schema-valid JSON is used as is; anything else goes through the tolerant
+    line parser. Outcomes are counted in bonnet_parse_stats.
+    """
+    try:
+        data = parse_structured_response(response)
+        if data is not None:
+            bonnet_parse_stats['structured'] += 1
+            return structured_bonnet_result(data)
+        
+        # Fields of JSON that misses the schema are kept, the line parser
+        # only fills in the ones it lacks
+        result = parse_legacy_response(response)
+        decoded = json_objects(response)
+        salvaged = salvage_bonnet_fields(decoded[0]) if decoded else {}
+        result.update(salvaged)
+        if result['condition'] == 'Unknown':
+            bonnet_parse_stats['failed'] += 1
+            logger.warning(f"Could not parse vision model response: {response[:200]!r}")
+        else:
+            bonnet_parse_stats['salvaged' if salvaged else 'fallback'] += 1
+        return result
+        
+    except Exception as e:
+        bonnet_parse_stats['failed'] += 1
+        logger.error(f"Error parsing GPT-4 response: {str(e)}")
+        result = unknown_bonnet_result(response)
+        result['issues'] = ['Error parsing analysis']
+        result['recommendations'] = ['Please try again']
+        return result
+
+
+def parse_vehicle_response(response: str, panel_count: int) -> tuple:
+    """(vehicle result, panel results) from a multi-view response.
+
+    Panels are matched by position. JSON that misses the schema keeps the
+    fields it has; panels the model left out, and fields it got wrong,
+    come back as 'Unknown'.
+    """
+    data = parse_structured_response(response, vehicle_response_validator)
+    if data is not None:
+        bonnet_parse_stats['structured'] += 1
+        panels = [structured_bonnet_result(panel) for panel in data['panels'][:panel_count]]
+        panels += [unknown_bonnet_result('') for _ in range(panel_count - len(panels))]
+        return structured_bonnet_result(data['vehicle']), panels
+    
+    decoded = next((d for d in json_objects(response) if isinstance(d.get('vehicle'), dict)), None)
+    if decoded is None:
+        bonnet_parse_stats['failed'] += 1
+        logger.warning(f"Could not parse vision model response: {response[:200]!r}")
+        return unknown_bonnet_result(response), [unknown_bonnet_result('') for _ in range(panel_count)]
+    
+    bonnet_parse_stats['salvaged'] += 1
+    vehicle = {**unknown_bonnet_result(response), **salvage_bonnet_fields(decoded['vehicle'])}
+    panels = [
+        {**unknown_bonnet_result(''), **salvage_bonnet_fields(panel)}
+        for panel in (decoded.get('panels') if isinstance(decoded.get('panels'), list) else [])[:panel_count]
+        if isinstance(panel, dict)
+    ]
+    panels += [unknown_bonnet_result('') for _ in range(panel_count - len(panels))]
+    return vehicle, panels
+
+
+def bonnet_parser_stats() -> dict:
+    """Parse outcome counters for /api/system/stats"""
+    total = sum(bonnet_parse_stats.values())
+    return {
+        'structured': bonnet_parse_stats['structured'],
+        'salvaged': bonnet_parse_stats['salvaged'],
+        'fallback': bonnet_parse_stats['fallback'],
+        'failed': bonnet_parse_stats['failed'],
+        'success_rate': round((total - bonnet_parse_stats['failed']) / total, 4) if total else None
+    }
+
+
+async def analyze_vehicle_with_gpt4(uploads: List[IngestedUpload], panels: List[str]) -> tuple:
+    """Analyze several panels of one vehicle with a single vision provider call"""
+    try:
+        # Shrink every upload in parallel off the event loop
+        prepared = await asyncio.gather(*[
+            run_in_image_pool(prepare_image_for_model, upload.data) for upload in uploads
+        ])
+        
+        vehicle, panel_results = await vision_router.analyze_vehicle(
+            [payload for payload, _ in prepared], panels, [upload.filename for upload in uploads]
+        )
+        for result, (_, preprocessing) in zip(panel_results, prepared):
+            result['phash'] = preprocessing['phash']
+            result['preprocessing'] = preprocessing
+        return vehicle, panel_results
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error analyzing vehicle with GPT-4: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error analyzing images: {str(e)}")
+
+
+class BonnetResultCache:
+    """Content-addressed cache of parsed bonnet analyses.
+
+    Results live in an in-process LRU tier bounded by entry count, total size
+    and TTL, backed by the `bonnet_cache` collection so they survive restarts
+    and are shared between workers. Keys combine the image digest with
+    BONNET_ANALYSIS_VERSION.
+    """
+    
+    collection_name = 'bonnet_cache'
+    
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, size, result)
+        self._bytes = 0
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    @staticmethod
+    def key(digest: str) -> str:
+        return f"{BONNET_ANALYSIS_VERSION}:{digest}"
+    
+    def _pop(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+    
+    def _put_memory(self, key: str, result: dict, expires_at: float):
+        size = len(json.dumps(result, default=str))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._pop(key)
+        self._entries[key] = (expires_at, size, result)
+        self._bytes += size
+        
+        # Evict least recently used entries until within both limits
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._pop(next(iter(self._entries)))
+            self.evictions += 1
+    
+    async def get(self, key: str) -> Optional[dict]:
+        """Return a cached result, checking memory first and then MongoDB"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, _, result = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(result)
+            self._pop(key)
+            self.expirations += 1
+        
+        try:
+            doc = await db[self.collection_name].find_one({
+                "_id": key,
+                "expires_at": {"$gt": datetime.now(timezone.utc)}
+            })
+        except Exception as e:
+            logger.error(f"Error reading bonnet cache: {str(e)}")
+            doc = None
+        
+        if doc is None:
+            self.misses += 1
+            return None
+        
+        # Promote to the memory tier for the remaining lifetime
+        expires_at = doc['expires_at']
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        self._put_memory(key, doc['result'], expires_at.timestamp())
+        self.persistent_hits += 1
+        return copy.deepcopy(doc['result'])
+    
+    async def set(self, key: str, result: dict):
+        """Store a result in both tiers"""
+        expires_at = time.time() + self.ttl_seconds
+        self._put_memory(key, copy.deepcopy(result), expires_at)
+        try:
+            await db[self.collection_name].update_one(
+                {"_id": key},
+                {"$set": {
+                    "result": result,
+                    "created_at": datetime.now(timezone.utc),
+                    "expires_at": datetime.fromtimestamp(expires_at, timezone.utc)
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error writing bonnet cache: {str(e)}")
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.persistent_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'persistent_hits': self.persistent_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': round((self.hits + self.persistent_hits) / lookups, 4) if lookups else 0.0
+        }
+
+
+bonnet_cache = BonnetResultCache(
+    max_entries=BONNET_CACHE_MAX_ENTRIES,
+    max_bytes=BONNET_CACHE_MAX_BYTES,
+    ttl_seconds=BONNET_CACHE_TTL_SECONDS
+)
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one in-flight call"""
+    
+    def __init__(self):
+        self._calls = {}  # key -> asyncio.Task
+        self.leaders = 0
+        self.coalesced = 0
+    
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception as retrieved even if every waiter went away
+        if not task.cancelled():
+            task.exception()
+    
+    async def do(self, key: str, func) -> dict:
+        """Await func() once per key, sharing the result with concurrent callers"""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        
+        # Shielded so a disconnecting client doesn't cancel the shared call
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result)
+    
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced
+        }
+
+
+bonnet_flights = SingleFlight()
+
+
+class PerceptualHashIndex:
+    """In-memory BK-tree over the perceptual hashes of stored analyses.
+
+    Finds earlier analyses of near-identical photos (re-shot, rescaled or
+    recompressed) by Hamming distance, which the byte-hash cache misses.
+    The tree is rebuilt from `db.analyses` at startup and extended as
+    analyses are saved; only analyses of the current version are indexed,
+    and those that were themselves duplicates, could not be parsed or have
+    a low-entropy hash are left out.
+    """
+    
+    result_fields = ('car_color', 'condition', 'wash_or_repaint', 'issues', 'recommendations', 'detailed_report')
+    
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        # Nodes are [hash, analysis ids, {distance: child node}]
+        self._root = None
+        self.size = 0
+        self.lookups = 0
+        self.duplicates = 0
+    
+    @staticmethod
+    def informative(phash: str) -> bool:
+        """Whether a hash has enough set and unset bits to tell photos apart"""
+        return PHASH_MIN_BITS <= bin(int(phash, 16)).count('1') <= 64 - PHASH_MIN_BITS
+    
+    def indexable(self, doc: dict) -> bool:
+        return (
+            bool(doc.get('phash')) and not doc.get('duplicate_of') and doc.get('condition') not in (None, 'Unknown')
+            and doc.get('analysis_version') == BONNET_ANALYSIS_VERSION and self.informative(doc['phash'])
+        )
+    
+    def add(self, phash: str, analysis_id: str):
+        value = int(phash, 16)
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [analysis_id], {}]
+            return
+        
+        node = self._root
+        while True:
+            distance = bin(value ^ node[0]).count('1')
+            if distance == 0:
+                node[1].append(analysis_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [analysis_id], {}]
+                return
+            node = child
+    
+    def add_docs(self, docs: List[dict]):
+        if self.max_distance < 0:
+            return
+        for doc in docs:
+            if self.indexable(doc):
+                self.add(doc['phash'], doc['id'])
+    
+    def search(self, phash: str, max_distance: int) -> List[tuple]:
+        """(distance, analysis id) of every indexed hash within max_distance, nearest first"""
+        if self._root is None:
+            return []
+        value = int(phash, 16)
+        matches = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            distance = bin(value ^ node[0]).count('1')
+            if distance <= max_distance:
+                matches.extend((distance, analysis_id) for analysis_id in node[1])
+            # Triangle inequality: only children within the radius can match
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches)
+    
+    async def rebuild(self):
+        """Reload every indexable hash from the analyses collection"""
+        self._root = None
+        self.size = 0
+        if self.max_distance < 0:
+            return
+        query = {
+            "phash": {"$type": "string"}, "duplicate_of": None, "condition": {"$ne": "Unknown"},
+            "analysis_version": BONNET_ANALYSIS_VERSION
+        }
+        async for doc in db.analyses.find(query, {"_id": 0, "id": 1, "phash": 1, "condition": 1}):
+            if self.informative(doc['phash']):
+                self.add(doc['phash'], doc['id'])
+        logger.info(f"Perceptual hash index loaded with {self.size} analyses")
+    
+    async def find_duplicate(self, phash: str) -> Optional[dict]:
+        """Result of the nearest earlier analysis within max_distance, if any"""
+        if self.max_distance < 0 or self._root is None or not self.informative(phash):
+            return None
+        
+        self.lookups += 1
+        projection = {"_id": 0, "id": 1, **{field: 1 for field in self.result_fields}}
+        for distance, analysis_id in self.search(phash, self.max_distance):
+            # Analyses may have expired, been deleted or re-analyzed since they were indexed
+            doc = await db.analyses.find_one({"id": analysis_id, "analysis_version": BONNET_ANALYSIS_VERSION}, projection)
+            if doc is None:
+                continue
+            self.duplicates += 1
+            result = {field: doc[field] for field in self.result_fields}
+            result.update(phash=phash, duplicate_of=analysis_id, phash_distance=distance)
+            return result
+        return None
+    
+    def stats(self) -> dict:
+        return {
+            'size': self.size,
+            'max_distance': self.max_distance,
+            'lookups': self.lookups,
+            'duplicates': self.duplicates
+        }
+
+
+phash_index = PerceptualHashIndex(PHASH_MAX_DISTANCE)
+
+
+async def get_bonnet_analysis(upload: IngestedUpload) -> dict:
+    """Bonnet analysis for an upload, served from the cache when possible.
+
+    Byte-identical uploads hit the result cache; near-identical photos reuse
+    the nearest earlier analysis found by perceptual hash.
+    """
+    key = bonnet_cache.key(upload.digest)
+    
+    cached = await bonnet_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    async def analyze_and_cache():
+        # One decode yields both the model payload and the perceptual hash
+        prepared = await run_in_image_pool(prepare_image_for_model, upload.data)
+        result = await phash_index.find_duplicate(prepared[1]['phash'])
+        if result is not None:
+            logger.info(
+                f"{upload.filename} is a near duplicate of analysis {result['duplicate_of']} "
+                f"(distance {result['phash_distance']}), skipping the model call"
+            )
+            result['preprocessing'] = prepared[1]
+        else:
+            result = await analyze_bonnet_with_gpt4(upload.data, upload.filename, prepared)
+        # Don't pin responses the parser could not make sense of. Cache hits
+        # skip preprocessing, so its timings are not cached either
+        if result['condition'] != 'Unknown':
+            await bonnet_cache.set(key, {k: v for k, v in result.items() if k != 'preprocessing'})
+        return result
+    
+    # Identical uploads arriving together share one model call
+    return await bonnet_flights.do(key, analyze_and_cache)
+
+
+def bonnet_analysis_from_result(image_name: str, result: dict, model_class=BonnetAnalysis, **fields) -> BonnetAnalysis:
+    """Build a bonnet (or panel) analysis record from a parsed model result"""
+    if 'analysis_version' in result:
+        fields.setdefault('analysis_version', result['analysis_version'])
+    return model_class(
+        image_name=image_name,
+        car_color=result['car_color'],
+        condition=result['condition'],
+        wash_or_repaint=result['wash_or_repaint'],
+        issues=result['issues'],
+        recommendations=result['recommendations'],
+        detailed_report=result['detailed_report'],
+        preprocessing=result.get('preprocessing'),
+        phash=result.get('phash'),
+        duplicate_of=result.get('duplicate_of'),
+        provider=result.get('provider'),
+        confidence=result.get('confidence'),
+        **fields
+    )
+
+
+def job_uploads() -> AsyncIOMotorGridFSBucket:
+    """GridFS bucket holding uploads of queued jobs that could not go to the image store"""
+    return AsyncIOMotorGridFSBucket(db, bucket_name=JOB_UPLOADS_BUCKET)
+
+
+class AnalysisJobQueue:
+    """In-process worker queue for asynchronous bonnet analyses.
+
+    The pending analysis document and its upload (in the image store, or in
+    GridFS when it is switched off) are the source of truth; the in-memory
+    queue only holds analysis ids. Workers claim a
+    job atomically, so a job is only ever processed once even if it is queued
+    twice, and jobs left `processing` by a dead worker become claimable again
+    after JOB_STALE_SECONDS and are picked up by the periodic sweep.
+    """
+    
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._queue = None
+        self._tasks = []
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+    
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweeper()))
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    def enqueue(self, analysis_id: str):
+        self._queue.put_nowait(analysis_id)
+    
+    @staticmethod
+    def _claimable(delayed: bool = False) -> list:
+        """Conditions of a job that is due: pending past its retry delay, or abandoned by its worker.
+
+        With `delayed` pending jobs qualify before their retry delay has passed,
+        for the enqueue scheduled at the end of it, which may fire a little early.
+        """
+        now = datetime.now(timezone.utc)
+        stale = datetime.fromtimestamp(now.timestamp() - JOB_STALE_SECONDS, timezone.utc)
+        pending = {"status": "pending"} if delayed else {"status": "pending", "next_attempt_at": {"$not": {"$gt": now}}}
+        return [pending, {"status": "processing", "started_at": {"$lt": stale}}]
+    
+    async def recover(self) -> int:
+        """Queue every job that is due, failing those that used up their attempts"""
+        exhausted = await db.analyses.find(
+            {"$or": self._claimable(), "attempts": {"$gte": JOB_MAX_ATTEMPTS}}, {"_id": 0, "id": 1}
+        ).to_list(None)
+        for job in exhausted:
+            result = await db.analyses.update_one(
+                {"id": job['id'], "$or": self._claimable()},
+                {"$set": {
+                    "status": "failed",
+                    "error": f"Gave up after {JOB_MAX_ATTEMPTS} attempts",
+                    "finished_at": datetime.now(timezone.utc)
+                }}
+            )
+            if result.modified_count:
+                self.failed += 1
+                await self._discard_upload(job['id'])
+        
+        jobs = await db.analyses.find(
+            {"$or": self._claimable(), "attempts": {"$lt": JOB_MAX_ATTEMPTS}}, {"_id": 0, "id": 1}
+        ).to_list(None)
+        for job in jobs:
+            self.enqueue(job['id'])
+        return len(jobs)
+    
+    async def _sweeper(self):
+        while True:
+            try:
+                recovered = await self.recover()
+                if recovered:
+                    logger.info(f"Queued {recovered} pending analysis jobs")
+            except Exception as e:
+                logger.error(f"Error recovering analysis jobs: {str(e)}")
+            await asyncio.sleep(JOB_STALE_SECONDS / 2)
+    
+    async def _claim(self, analysis_id: str) -> Optional[dict]:
+        return await db.analyses.find_one_and_update(
+            {"id": analysis_id, "$or": self._claimable(delayed=True), "attempts": {"$lt": JOB_MAX_ATTEMPTS}},
+            {
+                "$set": {"status": "processing", "started_at": datetime.now(timezone.utc)},
+                "$unset": {"next_attempt_at": ""},
+                "$inc": {"attempts": 1}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def _worker(self):
+        while True:
+            analysis_id = await self._queue.get()
+            if lifecycle.phase == 'draining':
+                # Left pending in the database, picked up again after the restart
+                self._queue.task_done()
+                continue
+            
+            self.active += 1
+            try:
+                with lifecycle.analysis('bonnet_job'):
+                    await self._process(analysis_id)
+            except Exception as e:
+                logger.error(f"Error processing analysis job {analysis_id}: {str(e)}")
+            finally:
+                self.active -= 1
+                self._queue.task_done()
+    
+    async def _process(self, analysis_id: str):
+        job = await self._claim(analysis_id)
+        if job is None:
+            return
+        
+        try:
+            upload = await self._load_upload(job)
+            result = await get_bonnet_analysis(upload)
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            transient = isinstance(e, HTTPException) and e.status_code in (429, 502, 503, 504)
+            if transient and job['attempts'] < JOB_MAX_ATTEMPTS:
+                # Hand the job back and try again once the pressure is off;
+                # the sweep leaves it alone until then
+                self.retried += 1
+                next_attempt_at = datetime.fromtimestamp(time.time() + JOB_RETRY_DELAY_SECONDS, timezone.utc)
+                await db.analyses.update_one(
+                    {"id": analysis_id},
+                    {"$set": {"status": "pending", "error": detail, "next_attempt_at": next_attempt_at}}
+                )
+                asyncio.get_running_loop().call_later(JOB_RETRY_DELAY_SECONDS, self.enqueue, analysis_id)
+                return
+            
+            self.failed += 1
+            await db.analyses.update_one(
+                {"id": analysis_id},
+                {"$set": {"status": "failed", "error": detail, "finished_at": datetime.now(timezone.utc)}}
+            )
+            await self._discard_upload(analysis_id)
+            return
+        
+        analysis = bonnet_analysis_from_result(
+            job['image_name'], result, id=analysis_id, timestamp=job['timestamp'], image_digest=job.get('image_digest')
+        )
+        doc = analysis_to_doc(analysis)
+        with STAGE_SECONDS.labels('db_update').time():
+            await db.analyses.update_one(
+                {"id": analysis_id},
+                {"$set": {**doc, "finished_at": datetime.now(timezone.utc)}, "$unset": {"error": ""}}
+            )
+        self.completed += 1
+        phash_index.add_docs([doc])
+        
+        try:
+            await update_rollups([doc])
+        except Exception as e:
+            logger.error(f"Error updating analysis rollups: {str(e)}")
+        await self._discard_upload(analysis_id)
+    
+    async def _load_upload(self, job: dict) -> IngestedUpload:
+        """The job's image, read back from wherever submit_bonnet_job kept it"""
+        if job.get('image_digest'):
+            source = await load_stored_image(job['image_digest'])
+            if source is None:
+                raise HTTPException(status_code=410, detail="Stored image is missing")
+            data = await asyncio.to_thread(Path(source).read_bytes) if isinstance(source, str) else source
+            return IngestedUpload(
+                filename=job['image_name'],
+                data=data,
+                digest=job['image_digest'],
+                format=detect_image_format(data[:12])
+            )
+        
+        stream = await job_uploads().open_download_stream(job['id'])
+        return IngestedUpload(
+            filename=job['image_name'],
+            data=await stream.read(),
+            digest=stream.metadata['digest'],
+            format=stream.metadata['format']
+        )
+    
+    async def _discard_upload(self, analysis_id: str):
+        """Remove a job bucket copy of the upload, if the job has one"""
+        try:
+            await job_uploads().delete(analysis_id)
+        except NoFile:
+            pass
+        except Exception as e:
+            logger.error(f"Error deleting upload of analysis job {analysis_id}: {str(e)}")
+    
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'queued': self._queue.qsize() if self._queue else 0,
+            'active': self.active,
+            'completed': self.completed,
+            'failed': self.failed,
+            'retried': self.retried
+        }
+
 
-# Create the main app without a prefix
-app = FastAPI()
+analysis_jobs = AnalysisJobQueue(workers=JOB_WORKERS)
 
-# Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
 
-# Get API Key
-API_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
+async def submit_bonnet_job(upload: IngestedUpload) -> dict:
+    """Persist a pending bonnet analysis and queue it for the workers"""
+    analysis_id = str(uuid.uuid4())
+    
+    # Store the image first, so a pending document always has it. The job
+    # bucket only holds uploads the image store could not take
+    image_digest = await store_upload(upload)
+    if image_digest is None:
+        await job_uploads().upload_from_stream_with_id(
+            analysis_id,
+            upload.filename,
+            bytes(upload.data),
+            metadata={"digest": upload.digest, "format": upload.format}
+        )
+    doc = {
+        "id": analysis_id,
+        "analysis_type": "bonnet",
+        "image_name": upload.filename,
+        "image_digest": image_digest,
+        "status": "pending",
+        "attempts": 0,
+        "timestamp": datetime.now(timezone.utc)
+    }
+    await db.analyses.insert_one(doc)
+    await add_image_refs([doc])
+    analysis_jobs.enqueue(analysis_id)
+    
+    return {"id": analysis_id, "status": "pending", "status_url": f"/api/analysis/{analysis_id}"}
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
 
+class SamplingProfiler:
+    """Statistical profiler that samples every thread's stack at an interval.
 
-# Define Models
-class WhitePixelAnalysis(BaseModel):
-    model_config = ConfigDict(extra="ignore")
+    Runs in a background thread while switched on, so it can be started and
+    stopped at runtime under real load. Samples are aggregated as folded
+    stacks ('outer;inner;leaf count'), the input format of flame graph tools.
+    """
     
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    analysis_type: str = "white_pixel"
-    image_name: str
-    white_pixel_count: int
-    total_pixels: int
-    percentage: float
-    analysis_result: str
-    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    def __init__(self, max_seconds: float):
+        self.max_seconds = max_seconds
+        self.interval = 0.01
+        self._stacks = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self.samples = 0
+        self.started_at = None
+    
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self, interval: float):
+        if self.running:
+            raise HTTPException(status_code=409, detail="Profiler is already running")
+        self.interval = interval
+        self._stacks = Counter()
+        self.samples = 0
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+    
+    def _sample(self):
+        own = threading.get_ident()
+        deadline = self.started_at + self.max_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+    
+    def folded(self) -> str:
+        return '\n'.join(f"{stack} {count}" for stack, count in self._stacks.most_common()) + '\n'
+    
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'interval': self.interval,
+            'samples': self.samples,
+            'stacks': len(self._stacks),
+            'max_seconds': self.max_seconds
+        }
 
 
-class BonnetAnalysis(BaseModel):
-    model_config = ConfigDict(extra="ignore")
-    
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    analysis_type: str = "bonnet"
-    image_name: str
-    car_color: str
-    condition: str  # good or bad
-    wash_or_repaint: str
-    issues: List[str]
-    recommendations: List[str]
-    detailed_report: str
-    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+profiler = SamplingProfiler(PROFILE_MAX_SECONDS)
 
 
-class AnalysisHistory(BaseModel):
-    model_config = ConfigDict(extra="ignore")
+def runtime_stats() -> dict:
+    """Counters of the caches, the model scheduler and the worker pools"""
+    return {
+        'bonnet_cache': bonnet_cache.stats(),
+        'bonnet_single_flight': bonnet_flights.stats(),
+        'bonnet_parser': bonnet_parser_stats(),
+        'phash_index': phash_index.stats(),
+        'vision': vision_stats.stats(),
+        'llm': llm_scheduler.stats(),
+        'jobs': analysis_jobs.stats(),
+        'image_store': {'backend': image_store.name if image_store else 'none', **image_store_stats},
+        'lifecycle': lifecycle.stats()
+    }
+
+
+class RuntimeStatsCollector:
+    """Exposes the numeric values of runtime_stats() as Prometheus gauges"""
     
-    id: str
-    analysis_type: str
-    image_name: str
-    timestamp: datetime
-    summary: str
+    def collect(self):
+        for section, values in runtime_stats().items():
+            for name, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                yield GaugeMetricFamily(f"car_analysis_{section}_{name}", f"{section} {name.replace('_', ' ')}", value=value)
 
 
-def count_white_pixels(image_data: bytes) -> dict:
-    """Count white pixels in an image"""
-    try:
-        image = Image.open(BytesIO(image_data))
-        image = image.convert('RGB')
+REGISTRY.register(RuntimeStatsCollector())
+
+
+class RequestMetricsMiddleware:
+    """Request latency histogram and in-flight gauge per route template.
+
+    A plain ASGI middleware rather than `@app.middleware("http")`: it watches
+    the messages the app sends, so streamed exports are timed until their
+    last chunk and FileResponses may still use the pathsend extension.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
         
-        pixels = list(image.getdata())
-        total_pixels = len(pixels)
+        # Before routing only the raw path is known, group unmatched paths together
+        routes = scope['app'].router.routes
+        route = next((r.path for r in routes if r.matches(scope)[0].name == 'FULL'), 'unmatched')
+        in_flight = REQUESTS_IN_FLIGHT.labels(route)
+        in_flight.inc()
+        started = time.perf_counter()
+        status = 500
+        recorded = False
         
-        # Count white pixels (threshold for white: R>240, G>240, B>240)
-        white_pixels = sum(1 for r, g, b in pixels if r > 240 and g > 240 and b > 240)
+        def record():
+            nonlocal recorded
+            if not recorded:
+                recorded = True
+                in_flight.dec()
+                REQUEST_SECONDS.labels(scope['method'], route, str(status)).observe(time.perf_counter() - started)
         
-        percentage = (white_pixels / total_pixels) * 100
+        async def send_and_record(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            try:
+                await send(message)
+            finally:
+                if message['type'] == 'http.response.pathsend' or (
+                    message['type'] == 'http.response.body' and not message.get('more_body', False)
+                ):
+                    record()
         
-        return {
-            'white_pixel_count': white_pixels,
-            'total_pixels': total_pixels,
-            'percentage': round(percentage, 2)
-        }
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            # Requests that failed or were cut off before their last message
+            record()
+
+
+app.add_middleware(RequestMetricsMiddleware)
+
+
+# Routes
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+
+@api_router.get("/")
+async def root():
+    return {"message": "Car Analysis API"}
+
+
+@api_router.get("/ready")
+async def readiness(response: Response):
+    """Readiness probe: 200 once startup finished and MongoDB answers, 503 otherwise"""
+    checks = {'phase': lifecycle.phase, 'in_flight': lifecycle.in_flight}
+    try:
+        await asyncio.wait_for(db.command('ping'), READY_PING_TIMEOUT_SECONDS)
+        checks['mongo'] = 'ok'
     except Exception as e:
-        logger.error(f"Error counting white pixels: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+        checks['mongo'] = f"unavailable: {str(e) or type(e).__name__}"
+    
+    ready = lifecycle.phase == 'ready' and checks['mongo'] == 'ok'
+    if not ready:
+        response.status_code = 503
+    return {'ready': ready, **checks}
+
 
+@api_router.post("/analyze/white-pixels", response_model=WhitePixelAnalysis)
+async def analyze_white_pixels(
+    file: UploadFile = File(...),
+    thresholds: Optional[str] = None,
+    grid: Optional[str] = None,
+    roi: Optional[str] = None,
+    approximate: bool = False
+):
+    """Analyze image for white pixels.
 
-async def analyze_bonnet_with_gpt4(image_data: bytes, filename: str) -> dict:
-    """Analyze car bonnet using GPT-4 Vision"""
+    Optionally also counts for extra `thresholds` ('200,220,240') and per
+    region, either a `grid` ('3x3') or `roi` boxes ('x,y,w,h;x,y,w,h').
+
+    Images are counted within TILE_MEMORY_BUDGET_BYTES. Uncompressed BMP and
+    TIFF, and non-interlaced PNG (except 16-bit color), are read in strips at
+    any size; other formats whose decoded frame exceeds the budget get 413.
+    With `approximate`, such JPEGs are instead decoded at 1/2, 1/4 or 1/8
+    scale and the counts estimated, reported with `sample_scale`.
+    """
     try:
-        # Convert image to base64
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-        
-        # Create chat instance
-        chat = LlmChat(
-            api_key=API_KEY,
-            session_id=str(uuid.uuid4()),
-            system_message="You are an expert automotive inspector specializing in car condition assessment. Provide detailed, professional analysis."
-        ).with_model("openai", "gpt-4o")
+        threshold_list = parse_thresholds(thresholds)
+        region_spec = parse_regions(grid, roi)
         
-        # Create analysis prompt
-        prompt = """Analyze this car bonnet image and provide:
-1. Car Color: Identify the primary color of the car
-2. Condition: Assess if the condition is 'Good' or 'Bad'
-3. Wash or Repaint: Recommend whether the car needs 'Wash' or 'Repaint'
-4. Issues: List any visible issues (scratches, dents, rust, paint damage, dirt accumulation, etc.)
-5. Recommendations: Provide specific recommendations for maintenance or repair
-6. Detailed Report: A comprehensive diagnostic report with action items
-
-Provide your response in this exact format:
-COLOR: [color]
-CONDITION: [Good/Bad]
-RECOMMENDATION: [Wash/Repaint]
-ISSUES: [issue1 | issue2 | issue3]
-RECOMMENDATIONS: [rec1 | rec2 | rec3]
-DETAILED_REPORT: [detailed analysis]"""
-        
-        # Create image content
-        image_content = ImageContent(image_base64=base64_image)
-        
-        # Create user message with image
-        user_message = UserMessage(
-            text=prompt,
-            file_contents=[image_content]
+        # Read image data within the (tiled) upload limits, spooling large files to disk
+        upload = await ingest_upload(
+            file, max_bytes=MAX_TILED_UPLOAD_BYTES, max_pixels=MAX_TILED_IMAGE_PIXELS, spool_bytes=SPOOL_UPLOAD_BYTES
         )
         
-        # Send message and get response
-        response = await chat.send_message(user_message)
+        with lifecycle.analysis('white_pixel'):
+            # Count white pixels off the event loop
+            try:
+                pixel_data = await run_in_image_pool(
+                    count_white_pixels, upload.source, threshold_list, region_spec, approximate
+                )
+                # Keep the image now that it has been analyzed, before the spooled copy goes
+                image_digest = await store_upload(upload)
+            finally:
+                upload.discard()
+            
+            # Generate analysis result
+            analysis_result = describe_white_pixels(pixel_data['percentage'])
+            
+            # Create analysis record
+            analysis = WhitePixelAnalysis(
+                image_name=file.filename,
+                white_pixel_count=pixel_data['white_pixel_count'],
+                total_pixels=pixel_data['total_pixels'],
+                percentage=pixel_data['percentage'],
+                analysis_result=analysis_result,
+                thresholds=pixel_data.get('thresholds'),
+                regions=pixel_data.get('regions'),
+                sample_scale=pixel_data.get('sample_scale'),
+                image_digest=image_digest
+            )
+            
+            # Save to database
+            await save_analyses([analysis_to_doc(analysis)])
         
-        # Parse response
-        result = parse_gpt4_response(response)
-        return result
+        return analysis
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error analyzing bonnet with GPT-4: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error analyzing image: {str(e)}")
+        logger.error(f"Error in white pixel analysis: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 
-def parse_gpt4_response(response: str) -> dict:
-    """Parse GPT-4 response into structured data"""
-    try:
-        lines = response.split('\n')
-        result = {
-            'car_color': 'Unknown',
-            'condition': 'Unknown',
-            'wash_or_repaint': 'Unknown',
-            'issues': [],
-            'recommendations': [],
-            'detailed_report': response
-        }
+@api_router.post("/analyze/white-pixels/batch", response_model=WhitePixelBatchAnalysis)
+async def analyze_white_pixels_batch(files: List[UploadFile] = File(...)):
+    """Analyze many images (or zip archives of images) for white pixels"""
+    try:
+        # Read uploads and list archive members, without inflating any yet.
+        # Uploads share the batch byte budget, images are read within the
+        # single upload limit and archives within the archive limit
+        uploads = []
+        received = 0
+        image_count = 0
+        image_bytes = 0
+        for file in files:
+            remaining = MAX_BATCH_BYTES - received
+            if remaining <= 0:
+                raise HTTPException(status_code=413, detail=f"Batch uploads exceed {MAX_BATCH_BYTES} bytes")
+            upload = await ingest_upload(
+                file, IMAGE_FORMATS | {'ZIP'}, min(MAX_UPLOAD_BYTES, remaining),
+                archive_max_bytes=min(MAX_ARCHIVE_BYTES, remaining)
+            )
+            received += len(upload.data)
+            members = batch_upload_members(upload) if upload.format == 'ZIP' else []
+            uploads.append((upload, members))
+            
+            # Enforce the batch limits on the declared sizes
+            image_count += len(members) if upload.format == 'ZIP' else 1
+            image_bytes += sum(info.file_size for info in members) if upload.format == 'ZIP' else len(upload.data)
+            if image_count > BATCH_MAX_IMAGES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Batch contains more than {BATCH_MAX_IMAGES} images"
+                )
+            if image_bytes > MAX_BATCH_BYTES:
+                raise HTTPException(status_code=413, detail=f"Batch images exceed {MAX_BATCH_BYTES} bytes")
         
-        for line in lines:
-            if line.startswith('COLOR:'):
-                result['car_color'] = line.replace('COLOR:', '').strip()
-            elif line.startswith('CONDITION:'):
-                result['condition'] = line.replace('CONDITION:', '').strip()
-            elif line.startswith('RECOMMENDATION:'):
-                result['wash_or_repaint'] = line.replace('RECOMMENDATION:', '').strip()
-            elif line.startswith('ISSUES:'):
-                issues_str = line.replace('ISSUES:', '').strip()
-                result['issues'] = [i.strip() for i in issues_str.split('|') if i.strip()]
-            elif line.startswith('RECOMMENDATIONS:'):
-                recs_str = line.replace('RECOMMENDATIONS:', '').strip()
-                result['recommendations'] = [r.strip() for r in recs_str.split('|') if r.strip()]
-            elif line.startswith('DETAILED_REPORT:'):
-                result['detailed_report'] = line.replace('DETAILED_REPORT:', '').strip()
+        if not image_count:
+            raise HTTPException(status_code=400, detail="No images found in upload")
         
-        return result
+        loop = asyncio.get_running_loop()
+        keep_images = image_store is not None
+        read_ahead = asyncio.Semaphore(BATCH_READ_AHEAD)
+        
+        async def analyze_item(name: str, data: Optional[bytes], error: Optional[str]) -> tuple:
+            """Count one image on the process pool, then keep it; returns (name, stats, error, digest)"""
+            try:
+                # Archive members get the header and pixel checks uploads got on ingest
+                error = error or batch_item_error(data)
+                if error:
+                    return name, None, error, None
+                executor = batch_executor
+                try:
+                    name, pixel_data, error, image = await loop.run_in_executor(
+                        executor, count_white_pixels_batch_item, name, data, keep_images
+                    )
+                except BrokenProcessPool:
+                    # Images in flight on the dead pool fail, later ones get a new pool
+                    replace_batch_executor(executor)
+                    return name, None, "Image processing worker crashed", None
+                if image is None:
+                    return name, pixel_data, error, None
+                # The worker already hashed the image and rendered its thumbnail
+                digest, thumbnail = image
+                upload = IngestedUpload(filename=name, data=data, digest=digest, format=detect_image_format(data[:12]))
+                return name, pixel_data, error, await store_image(upload, thumbnail)
+            finally:
+                read_ahead.release()
+        
+        with lifecycle.analysis('white_pixel_batch'):
+            # Inflate members one at a time, off the event loop, and hand each to
+            # the process pool straight away; at most BATCH_READ_AHEAD wait in memory
+            tasks = []
+            try:
+                for upload, members in uploads:
+                    items = expand_batch_upload(upload, members)
+                    while True:
+                        await read_ahead.acquire()
+                        item = await asyncio.to_thread(next, items, None)
+                        if item is None:
+                            read_ahead.release()
+                            break
+                        tasks.append(asyncio.create_task(analyze_item(*item)))
+                outcomes = await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+            
+            batch_id = str(uuid.uuid4())
+            results = []
+            errors = []
+            for image_name, pixel_data, error, image_digest in outcomes:
+                if error:
+                    errors.append(BatchItemError(image_name=image_name, detail=error))
+                    continue
+                results.append(WhitePixelAnalysis(
+                    image_name=image_name,
+                    white_pixel_count=pixel_data['white_pixel_count'],
+                    total_pixels=pixel_data['total_pixels'],
+                    percentage=pixel_data['percentage'],
+                    analysis_result=describe_white_pixels(pixel_data['percentage']),
+                    image_digest=image_digest
+                ))
+            
+            # Save every result with a single round trip
+            if results:
+                docs = [analysis_to_doc(analysis) for analysis in results]
+                for doc in docs:
+                    doc['batch_id'] = batch_id
+                await save_analyses(docs)
+        
+        # Aggregate statistics across the successful images
+        total_white = sum(r.white_pixel_count for r in results)
+        total_pixels = sum(r.total_pixels for r in results)
+        percentages = [r.percentage for r in results] or [0.0]
+        
+        return WhitePixelBatchAnalysis(
+            batch_id=batch_id,
+            image_count=len(results),
+            failed_count=len(errors),
+            total_white_pixels=total_white,
+            total_pixels=total_pixels,
+            overall_percentage=round(total_white / total_pixels * 100, 2) if total_pixels else 0.0,
+            mean_percentage=round(sum(percentages) / len(percentages), 2),
+            min_percentage=min(percentages),
+            max_percentage=max(percentages),
+            results=results,
+            errors=errors
+        )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error parsing GPT-4 response: {str(e)}")
-        return {
-            'car_color': 'Unknown',
-            'condition': 'Unknown',
-            'wash_or_repaint': 'Unknown',
-            'issues': ['Error parsing analysis'],
-            'recommendations': ['Please try again'],
-            'detailed_report': response
-        }
-
+        logger.error(f"Error in batch white pixel analysis: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-# Routes
-@api_router.get("/")
-async def root():
-    return {"message": "Car Analysis API"}
 
+@api_router.post("/analyze/bonnet")
+async def analyze_bonnet(
+    response: Response,
+    file: UploadFile = File(...),
+    mode: str = Query('sync', pattern='^(sync|async)$')
+):
+    """Analyze car bonnet image.
 
-@api_router.post("/analyze/white-pixels")
-async def analyze_white_pixels(file: UploadFile = File(...)):
-    """Analyze image for white pixels"""
+    With mode=async the upload is queued and 202 is returned straight away
+    with the analysis id; poll /api/analysis/{id} until its status is
+    `completed` or `failed`.
+    """
     try:
-        # Read image data
-        image_data = await file.read()
+        # Read image data within the upload limits
+        upload = await ingest_upload(file)
         
-        # Count white pixels
-        pixel_data = count_white_pixels(image_data)
+        if mode == 'async':
+            with lifecycle.analysis('bonnet_submit'):
+                job = await submit_bonnet_job(upload)
+            response.status_code = 202
+            return job
         
-        # Generate analysis result
-        percentage = pixel_data['percentage']
-        if percentage > 50:
-            analysis_result = f"High white pixel concentration ({percentage}%). Image appears to be predominantly white or overexposed."
-        elif percentage > 20:
-            analysis_result = f"Moderate white pixel concentration ({percentage}%). Image contains significant white areas."
-        elif percentage > 5:
-            analysis_result = f"Low white pixel concentration ({percentage}%). Image has some white areas."
-        else:
-            analysis_result = f"Minimal white pixel concentration ({percentage}%). Image has very few white areas."
-        
-        # Create analysis record
-        analysis = WhitePixelAnalysis(
-            image_name=file.filename,
-            white_pixel_count=pixel_data['white_pixel_count'],
-            total_pixels=pixel_data['total_pixels'],
-            percentage=pixel_data['percentage'],
-            analysis_result=analysis_result
-        )
-        
-        # Save to database
-        doc = analysis.model_dump()
-        doc['timestamp'] = doc['timestamp'].isoformat()
-        await db.analyses.insert_one(doc)
+        # Analyze with GPT-4 Vision (reusing earlier results for identical images) while the upload is stored
+        with lifecycle.analysis('bonnet'):
+            image_digest, gpt4_result = await asyncio.gather(store_upload(upload), get_bonnet_analysis(upload))
+            
+            # Create analysis record
+            analysis = bonnet_analysis_from_result(file.filename, gpt4_result, image_digest=image_digest)
+            
+            # Save to database
+            await save_analyses([analysis_to_doc(analysis)])
         
         return analysis
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in white pixel analysis: {str(e)}")
+        logger.error(f"Error in bonnet analysis: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@api_router.post("/analyze/bonnet")
-async def analyze_bonnet(file: UploadFile = File(...)):
-    """Analyze car bonnet image"""
-    try:
-        # Read image data
-        image_data = await file.read()
-        
-        # Analyze with GPT-4 Vision
-        gpt4_result = await analyze_bonnet_with_gpt4(image_data, file.filename)
-        
-        # Create analysis record
-        analysis = BonnetAnalysis(
-            image_name=file.filename,
-            car_color=gpt4_result['car_color'],
-            condition=gpt4_result['condition'],
-            wash_or_repaint=gpt4_result['wash_or_repaint'],
-            issues=gpt4_result['issues'],
-            recommendations=gpt4_result['recommendations'],
-            detailed_report=gpt4_result['detailed_report']
-        )
+@api_router.post("/analyze/vehicle", response_model=VehicleAnalysis)
+async def analyze_vehicle(
+    files: List[UploadFile] = File(...),
+    panels: Optional[str] = None
+):
+    """Analyze several panels of one vehicle in a single model call.
+
+    `panels` optionally names each image in upload order
+    ('bonnet,left door,roof'); by default the file names are used.
+    """
+    try:
+        if len(files) > VEHICLE_MAX_PANELS:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Got {len(files)} images, the limit is {VEHICLE_MAX_PANELS} panels per vehicle"
+            )
+        
+        if panels is not None:
+            panel_names = [name.strip() for name in panels.split(',')]
+            if len(panel_names) != len(files) or not all(panel_names):
+                raise HTTPException(status_code=400, detail="Give one panel name per uploaded image")
+        else:
+            panel_names = [Path(file.filename or f"panel {i}").stem for i, file in enumerate(files, start=1)]
         
-        # Save to database
-        doc = analysis.model_dump()
-        doc['timestamp'] = doc['timestamp'].isoformat()
-        await db.analyses.insert_one(doc)
+        # Read image data within the upload limits
+        uploads = [await ingest_upload(file) for file in files]
         
-        return analysis
+        # Analyze all panels with one GPT-4 Vision call while the uploads are stored
+        with lifecycle.analysis('vehicle'):
+            image_digests, (vehicle_result, panel_results) = await asyncio.gather(
+                asyncio.gather(*[store_upload(upload) for upload in uploads]),
+                analyze_vehicle_with_gpt4(uploads, panel_names)
+            )
+            
+            # Create analysis records, the vehicle first
+            vehicle_id = str(uuid.uuid4())
+            vehicle = VehicleAnalysis(
+                id=vehicle_id,
+                image_name=', '.join(upload.filename for upload in uploads),
+                car_color=vehicle_result['car_color'],
+                condition=vehicle_result['condition'],
+                wash_or_repaint=vehicle_result['wash_or_repaint'],
+                issues=vehicle_result['issues'],
+                recommendations=vehicle_result['recommendations'],
+                detailed_report=vehicle_result['detailed_report'],
+                provider=vehicle_result.get('provider'),
+                panels=[
+                    bonnet_analysis_from_result(
+                        upload.filename, result, PanelAnalysis, panel=panel, vehicle_id=vehicle_id, image_digest=digest
+                    )
+                    for upload, panel, result, digest in zip(uploads, panel_names, panel_results, image_digests)
+                ]
+            )
+            
+            # Save the vehicle and its panels in one write
+            await save_analyses(vehicle_to_docs(vehicle))
         
+        return vehicle
+        
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in bonnet analysis: {str(e)}")
+        logger.error(f"Error in vehicle analysis: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @api_router.get("/analysis/history", response_model=List[AnalysisHistory])
-async def get_analysis_history():
-    """Get analysis history"""
+async def get_analysis_history(
+    request: Request,
+    limit: int = Query(HISTORY_DEFAULT_LIMIT, ge=1, le=HISTORY_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    analysis_type: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    fields: Optional[str] = None
+):
+    """Get analysis history, newest first.
+
+    Pages are keyed on (timestamp, id); when more results exist the
+    X-Next-Cursor response header holds the cursor for the next page.
+    `fields` limits each entry to the given history fields.
+    """
     try:
-        # Fetch all analyses
-        analyses = await db.analyses.find({}, {"_id": 0}).sort("timestamp", -1).to_list(100)
+        selected = parse_fields(fields, HISTORY_FIELDS)
+        query = build_history_query(analysis_type, start, end, cursor)
+        
+        # Fetch one extra document to know whether another page exists
+        analyses = await db.analyses.find(query, HISTORY_PROJECTION).sort(
+            [("timestamp", -1), ("id", -1)]
+        ).limit(limit + 1).to_list(limit + 1)
+        
+        headers = {}
+        if len(analyses) > limit:
+            analyses = analyses[:limit]
+            headers['X-Next-Cursor'] = encode_cursor(analyses[-1])
         
         # Convert to history format
         history = []
         for analysis in analyses:
-            if isinstance(analysis['timestamp'], str):
-                analysis['timestamp'] = datetime.fromisoformat(analysis['timestamp'])
-            
-            if analysis['analysis_type'] == 'white_pixel':
-                summary = f"White Pixels: {analysis['percentage']}%"
-            else:
-                summary = f"Color: {analysis['car_color']} | Condition: {analysis['condition']} | {analysis['wash_or_repaint']}"
-            
             history.append(AnalysisHistory(
                 id=analysis['id'],
                 analysis_type=analysis['analysis_type'],
                 image_name=analysis['image_name'],
                 timestamp=analysis['timestamp'],
-                summary=summary
+                summary=build_summary(analysis)
             ))
         
-        return history
+        # Unchanged pages are answered with 304
+        include = set(selected) if selected else None
+        return cacheable_response(request, [item.model_dump(include=include) for item in history], headers)
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error fetching analysis history: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@api_router.get("/analysis/export")
+async def export_analyses(
+    format: str = Query('ndjson', pattern='^(ndjson|csv|parquet)$'),
+    analysis_type: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    after_timestamp: Optional[datetime] = None,
+    after_id: Optional[str] = None,
+    gzip: bool = True
+):
+    """Stream every matching analysis, oldest first, as NDJSON, CSV or Parquet.
+
+    Memory stays constant: analyses are read in cursor batches and each batch
+    is encoded (and gzipped) as it goes out. An interrupted export resumes by
+    passing the `timestamp` and `id` of the last row received as
+    after_timestamp/after_id, together with the X-Export-End of the first
+    response so the resumed export covers the same snapshot.
+    """
+    if (after_timestamp is None) != (after_id is None):
+        raise HTTPException(status_code=400, detail="Give both after_timestamp and after_id to resume an export")
+    if format == 'parquet' and pyarrow is None:
+        raise HTTPException(status_code=501, detail="Parquet export needs pyarrow installed")
+    
+    try:
+        # Pin the end of the export so rows written meanwhile don't shift it
+        end = timestamp_key(end) if end else datetime.now(timezone.utc)
+        query = build_export_query(analysis_type, start, end, after_timestamp, after_id)
+        
+        encoder = {'ndjson': NdjsonEncoder, 'csv': CsvEncoder, 'parquet': ParquetEncoder}[format]()
+        media_type, extension = EXPORT_FORMATS[format]
+        # Parquet pages are compressed already
+        compress = gzip and format != 'parquet'
+        filename = f"analyses-{end.strftime('%Y%m%dT%H%M%SZ')}.{extension}" + ('.gz' if compress else '')
+        
+        return StreamingResponse(
+            stream_export(query, encoder, compress),
+            media_type='application/gzip' if compress else media_type,
+            headers={
+                'Content-Disposition': f'attachment; filename="{filename}"',
+                'X-Export-End': end.isoformat()
+            }
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error exporting analyses: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@api_router.get("/analysis/stats")
+async def get_analysis_stats(
+    analysis_type: str = 'bonnet',
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    group_by: str = Query('day_color', pattern='^(day|color|day_color|total)$')
+):
+    """Fleet condition statistics read from the per-day rollups"""
+    try:
+        query = {"analysis_type": analysis_type}
+        if start or end:
+            query["day"] = {}
+            if start:
+                query["day"]["$gte"] = start.isoformat()
+            if end:
+                query["day"]["$lte"] = end.isoformat()
+        
+        rollups = await db[ROLLUPS_COLLECTION].find(query, {"_id": 0}).to_list(None)
+        
+        # Merge rollups into the requested grouping
+        buckets = {}
+        for rollup in rollups:
+            key = (
+                rollup['day'] if group_by in ('day', 'day_color') else None,
+                rollup['car_color'] if group_by in ('color', 'day_color') else None
+            )
+            bucket = buckets.setdefault(key, {counter: 0 for counter in ROLLUP_COUNTERS})
+            for counter in ROLLUP_COUNTERS:
+                bucket[counter] += rollup.get(counter, 0)
+        
+        results = []
+        for (day, color), bucket in sorted(buckets.items(), key=lambda item: (item[0][0] or '', item[0][1] or '')):
+            count = bucket['count']
+            entry = {'day': day, 'car_color': color, 'count': count}
+            if analysis_type == 'white_pixel':
+                entry['mean_percentage'] = round(bucket['percentage_sum'] / count, 2) if count else 0.0
+            else:
+                for counter in (
+                    'good', 'bad', 'unknown_condition', 'wash', 'repaint', 'unknown_action', 'bad_and_repaint'
+                ):
+                    entry[counter] = bucket[counter]
+                    entry[f'{counter}_pct'] = round(bucket[counter] / count * 100, 2) if count else 0.0
+            results.append(entry)
+        
+        return {'analysis_type': analysis_type, 'group_by': group_by, 'buckets': results}
+        
+    except Exception as e:
+        logger.error(f"Error fetching analysis stats: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @api_router.get("/analysis/{analysis_id}")
-async def get_analysis_detail(analysis_id: str):
-    """Get detailed analysis by ID"""
+async def get_analysis_detail(analysis_id: str, request: Request, fields: Optional[str] = None):
+    """Get detailed analysis by ID.
+
+    `fields` limits the document to the given fields (`id` is always
+    included), e.g. fields=condition,issues leaves out the detailed report.
+    """
     try:
-        analysis = await db.analyses.find_one({"id": analysis_id}, {"_id": 0})
+        projection = {"_id": 0}
+        selected = parse_fields(fields, ANALYSIS_FIELDS)
+        if selected:
+            projection.update({field: 1 for field in ['id', *selected]})
+        
+        analysis = await db.analyses.find_one({"id": analysis_id}, projection)
         
         if not analysis:
             raise HTTPException(status_code=404, detail="Analysis not found")
         
-        if isinstance(analysis['timestamp'], str):
-            analysis['timestamp'] = datetime.fromisoformat(analysis['timestamp'])
-        
-        return analysis
+        # Serialized straight from the document, 304 when the client's copy is current
+        return cacheable_response(request, analysis)
         
     except HTTPException:
         raise
@@ -332,6 +3980,78 @@ async def get_analysis_detail(analysis_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def require_image(digest: str):
+    if image_store is None or not IMAGE_DIGEST.match(digest):
+        raise HTTPException(status_code=404, detail="Image not found")
+
+
+@api_router.get("/images/{digest}")
+async def get_image(digest: str, request: Request):
+    """The analyzed upload with this sha256 digest, as it was uploaded"""
+    try:
+        require_image(digest)
+        ref = await db[IMAGE_REFS_COLLECTION].find_one({"_id": digest}, {"format": 1})
+        if not ref:
+            raise HTTPException(status_code=404, detail="Image not found")
+        
+        media_type = IMAGE_CONTENT_TYPES.get(ref.get('format'), 'application/octet-stream')
+        return await serve_stored_image(request, 'originals', digest, media_type)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error serving image {digest}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@api_router.get("/images/{digest}/thumbnail")
+async def get_image_thumbnail(digest: str, request: Request):
+    """JPEG thumbnail (THUMBNAIL_EDGE pixels on the long side) of an analyzed upload"""
+    try:
+        require_image(digest)
+        return await serve_stored_image(request, 'thumbnails', digest, 'image/jpeg')
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error serving thumbnail {digest}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@api_router.get("/system/stats")
+async def get_system_stats():
+    """Runtime counters for caches and worker pools"""
+    return runtime_stats()
+
+
+def require_profiling():
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled, set PROFILING_ENABLED=true")
+
+
+@api_router.post("/system/profile/start")
+async def start_profile(interval: float = Query(0.01, ge=0.001, le=1.0)):
+    """Start sampling stacks every `interval` seconds (stops itself after PROFILE_MAX_SECONDS)"""
+    require_profiling()
+    profiler.start(interval)
+    return profiler.stats()
+
+
+@api_router.post("/system/profile/stop")
+async def stop_profile():
+    """Stop the profiler and return the folded stacks it collected"""
+    require_profiling()
+    profiler.stop()
+    return Response(profiler.folded(), media_type="text/plain")
+
+
+@api_router.get("/system/profile")
+async def get_profile():
+    """Folded stacks collected so far, the profiler keeps running"""
+    require_profiling()
+    return Response(profiler.folded(), media_type="text/plain", headers={"X-Profile-Samples": str(profiler.samples)})
+
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -341,9 +4061,158 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Export-End", "ETag"],
 )
 
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+async def ensure_retention_index():
+    """Create, update or drop the TTL index that enforces ANALYSIS_RETENTION_DAYS"""
+    indexes = await db.analyses.index_information()
+    existing = indexes.get(RETENTION_INDEX_NAME)
+    
+    if ANALYSIS_RETENTION_DAYS <= 0:
+        if existing:
+            await db.analyses.drop_index(RETENTION_INDEX_NAME)
+        return
+    
+    expire_after = ANALYSIS_RETENTION_DAYS * 24 * 60 * 60
+    if existing is None:
+        await db.analyses.create_index("timestamp", name=RETENTION_INDEX_NAME, expireAfterSeconds=expire_after)
+    elif existing.get('expireAfterSeconds') != expire_after:
+        await db.command({
+            "collMod": "analyses",
+            "index": {"name": RETENTION_INDEX_NAME, "expireAfterSeconds": expire_after}
+        })
+
+
+async def create_indexes():
+    try:
+        # Detail lookups and keyset pagination of the history
+        await db.analyses.create_index("id", unique=True)
+        await db.analyses.create_index([("timestamp", -1), ("id", -1)])
+        await db.analyses.create_index([("analysis_type", 1), ("timestamp", -1), ("id", -1)])
+        
+        await db.analyses.create_index("status")
+        await db.analyses.create_index("phash", sparse=True)
+        await db.analyses.create_index("image_digest", partialFilterExpression={"image_digest": {"$type": "string"}})
+        await db.analyses.create_index([("analysis_type", 1), ("analysis_version", 1)])
+        await db[ROLLUPS_COLLECTION].create_index([("analysis_type", 1), ("day", 1)])
+        
+        # Expired cache documents are removed by MongoDB itself
+        await db[BonnetResultCache.collection_name].create_index("expires_at", expireAfterSeconds=0)
+        
+        await ensure_retention_index()
+    except Exception as e:
+        logger.error(f"Error creating indexes: {str(e)}")
+
+
+async def sweep_images():
+    """Periodic garbage collection of the image store"""
+    while True:
+        await asyncio.sleep(IMAGE_GC_INTERVAL_SECONDS)
+        try:
+            result = await collect_images()
+            if result['deleted']:
+                logger.info(f"Removed {result['deleted']} unreferenced images ({result['freed_bytes']} bytes)")
+        except Exception as e:
+            logger.error(f"Error collecting unreferenced images: {str(e)}")
+
+
+async def load_phash_index():
+    try:
+        await phash_index.rebuild()
+    except Exception as e:
+        logger.error(f"Error loading perceptual hash index: {str(e)}")
+
+
+def open_llm_session():
+    """Hand litellm one pooled HTTP client so model calls reuse warm connections"""
+    if litellm is None:
+        return
+    litellm.aclient_session = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONCURRENCY * 2,
+            max_keepalive_connections=LLM_MAX_CONCURRENCY,
+            keepalive_expiry=LLM_KEEPALIVE_SECONDS
+        ),
+        timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=10)
+    )
+
+
+async def close_llm_session():
+    if litellm is None or litellm.aclient_session is None:
+        return
+    session, litellm.aclient_session = litellm.aclient_session, None
+    await session.aclose()
+
+
+def warm_image_codecs(_: int = 0) -> int:
+    """Load PIL's format plugins and NumPy by round-tripping a tiny image in every accepted format"""
+    Image.init()
+    image = Image.new('RGB', (16, 16), 'white')
+    for image_format in sorted(IMAGE_FORMATS):
+        buffer = BytesIO()
+        image.save(buffer, format=image_format)
+        with Image.open(BytesIO(buffer.getvalue())) as decoded:
+            np.asarray(decoded.convert('RGB')).min(axis=2)
+    return os.getpid()
+
+
+async def warm_up_pools():
+    """Start every image thread and batch process up front and warm their codecs"""
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        warm_image_codecs()
+        await asyncio.gather(*[run_in_image_pool(warm_image_codecs, i) for i in range(IMAGE_WORKERS)])
+        # Spawned batch workers import this module first, the slowest part of a cold start
+        pids = await asyncio.gather(*[
+            loop.run_in_executor(batch_executor, warm_image_codecs, i) for i in range(BATCH_WORKERS)
+        ])
+        lifecycle.warmup = {
+            'warmup_seconds': round(time.perf_counter() - started, 3),
+            'batch_workers_warmed': len(set(pids))
+        }
+    except Exception as e:
+        logger.error(f"Error warming up worker pools: {str(e)}")
+
+
+async def start_resources():
+    """Connect, create indexes and warm the pools before the service reports ready"""
+    lifecycle.phase = 'starting'
+    lifecycle.started_at = time.monotonic()
+    open_llm_session()
+    
+    # Fail loudly in the logs; /api/ready keeps reporting 503 until MongoDB answers
+    try:
+        await db.command('ping')
+    except Exception as e:
+        logger.error(f"Error connecting to MongoDB: {str(e)}")
+    
+    await create_indexes()
+    await load_phash_index()
+    if STARTUP_WARMUP:
+        await warm_up_pools()
+    
+    # Jobs accepted before a restart are picked up by the first sweep
+    await analysis_jobs.start()
+    if image_store is not None and IMAGE_GC_INTERVAL_SECONDS > 0:
+        lifecycle.tasks.append(asyncio.create_task(sweep_images()))
+    lifecycle.phase = 'ready'
+
+
+async def stop_resources():
+    """Drain analyses in progress, then close connections and worker pools"""
+    if not await lifecycle.drain(SHUTDOWN_DRAIN_SECONDS):
+        logger.warning(f"Shutting down with {lifecycle.in_flight} analyses still in progress")
+    
+    for task in lifecycle.tasks:
+        task.cancel()
+    await asyncio.gather(*lifecycle.tasks, return_exceptions=True)
+    lifecycle.tasks = []
+    
+    await analysis_jobs.stop()
+    await close_llm_session()
+    client.close()
+    image_executor.shutdown(wait=False, cancel_futures=True)
+    batch_executor.shutdown(wait=False, cancel_futures=True)
@@ -95,6 +95,29 @@ const AnalysisDetail = () => {
             </div>
           </div>
 
+          {analysis.image_digest && (
+            <div className="detail-section">
+              <h2 className="section-title">
+                <ImageIcon className="section-icon" />
+                Analyzed Image
+              </h2>
+              <a
+                href={`${API}/images/${analysis.image_digest}`}
+                target="_blank"
+                rel="noopener noreferrer"
+                data-testid="detail-image-link"
+              >
+                <img
+                  className="detail-thumbnail"
+                  src={`${API}/images/${analysis.image_digest}/thumbnail`}
+                  alt={analysis.image_name}
+                  loading="lazy"
+                  data-testid="detail-thumbnail"
+                />
+              </a>
+            </div>
+          )}
+
           {analysis.analysis_type === 'white_pixel' ? (
             <>
               <div className="detail-section">
@@ -0,0 +1,79 @@
+"""Fixtures for the backend tests: the FastAPI app against an in-memory MongoDB."""
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+# Keep stored images in a throwaway directory and the vision tier offline
+os.environ.setdefault('IMAGE_STORE_DIR', tempfile.mkdtemp(prefix='test-images-'))
+os.environ.setdefault('EMERGENT_LLM_KEY', 'test')
+os.environ.setdefault('VISION_PROVIDER', 'local')
+os.environ.setdefault('BATCH_WORKERS', '2')
+
+import httpx
+from mongomock_motor import AsyncMongoMockClient
+
+import maintenance
+import reanalyze
+import server
+from benchmark import StubLlmChat
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = AsyncMongoMockClient(tz_aware=True)['test']
+    # The maintenance scripts import the database handle from server
+    for module in (server, maintenance, reanalyze):
+        monkeypatch.setattr(module, 'db', database)
+    return database
+
+
+@pytest.fixture
+async def client(db):
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+        yield client
+
+
+@pytest.fixture
+def stub_model(monkeypatch, db):
+    """Send bonnet analyses to the remote tier, answered by the benchmark's stub model.
+
+    Starts from an empty result cache; the returned class counts model calls.
+    """
+    monkeypatch.setattr(StubLlmChat, 'calls', 0)
+    monkeypatch.setattr(StubLlmChat, 'latency', 0)
+    monkeypatch.setattr(server, 'LlmChat', StubLlmChat)
+    monkeypatch.setattr(server.vision_router, 'mode', 'remote')
+    monkeypatch.setattr(server, 'bonnet_cache', server.BonnetResultCache(64, 1024 * 1024, 3600))
+    monkeypatch.setattr(server, 'bonnet_flights', server.SingleFlight())
+    return StubLlmChat
+
+
+@pytest.fixture
+def insert_analyses(db):
+    """Insert `count` white pixel analyses, two per timestamp; returns their documents newest first"""
+    async def insert(count: int) -> list:
+        base = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        docs = [
+            server.analysis_to_doc(server.WhitePixelAnalysis(
+                id=f'{index:04d}', image_name=f'{index}.png', white_pixel_count=index, total_pixels=100,
+                percentage=float(index), analysis_result='Low white pixel content',
+                timestamp=base + timedelta(seconds=index // 2)
+            ))
+            for index in range(count)
+        ]
+        await db.analyses.insert_many([dict(doc) for doc in docs])
+        return sorted(docs, key=lambda doc: (doc['timestamp'], doc['id']), reverse=True)
+    
+    return insert
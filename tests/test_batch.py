@@ -0,0 +1,111 @@
+import zipfile
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def png(color, size=(20, 10)) -> bytes:
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def archive(members: dict) -> bytes:
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return buffer.getvalue()
+
+
+async def post_batch(client, *files):
+    return await client.post('/api/analyze/white-pixels/batch', files=[('files', item) for item in files])
+
+
+async def test_images_and_archives(client, db):
+    members = {'a/white.png': png((255, 255, 255)), '__MACOSX/._white.png': b'junk', 'a/': b'', 'notes.txt': b'hi'}
+    response = await post_batch(
+        client,
+        ('black.png', png((0, 0, 0)), 'image/png'),
+        ('photos.zip', archive(members), 'application/zip')
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert sorted((r['image_name'], r['percentage']) for r in body['results']) == [('a/white.png', 100.0), ('black.png', 0.0)]
+    assert [error['image_name'] for error in body['errors']] == ['notes.txt']
+    assert body['total_white_pixels'] == 200
+    assert body['overall_percentage'] == 50.0
+    assert await db.analyses.count_documents({'batch_id': body['batch_id']}) == 2
+
+
+async def test_too_many_images(client, monkeypatch):
+    monkeypatch.setattr(server, 'BATCH_MAX_IMAGES', 2)
+    members = {f'{index}.png': png((index, index, index)) for index in range(3)}
+    response = await post_batch(client, ('photos.zip', archive(members), 'application/zip'))
+    assert response.status_code == 413
+    assert 'more than 2 images' in response.json()['detail']
+
+
+async def test_archive_members_over_the_upload_limit(client, monkeypatch):
+    monkeypatch.setattr(server, 'MAX_UPLOAD_BYTES', 1000)
+    # Highly compressible, so only the declared size gives it away
+    members = {'big.bmp': b'BM' + bytes(100_000)}
+    response = await post_batch(client, ('photos.zip', archive(members), 'application/zip'))
+    assert response.status_code == 413
+    assert response.json()['detail'] == "big.bmp exceeds 1000 bytes"
+
+
+async def test_batch_byte_budget(client, monkeypatch):
+    image = png((255, 255, 255), (200, 200))
+    monkeypatch.setattr(server, 'MAX_BATCH_BYTES', len(image) * 2 - 1)
+    response = await post_batch(client, *[(f'{index}.png', image, 'image/png') for index in range(3)])
+    assert response.status_code == 413
+
+
+async def test_bad_archive(client):
+    response = await post_batch(client, ('photos.zip', b'PK\x03\x04' + bytes(40), 'application/zip'))
+    assert response.status_code == 400
+
+
+async def test_empty_batch(client):
+    response = await post_batch(client, ('photos.zip', archive({'notes/': b''}), 'application/zip'))
+    assert response.status_code == 400
+    assert response.json()['detail'] == "No images found in upload"
+
+
+async def test_corrupt_member_fails_only_itself(client):
+    good, bad = png((255, 255, 255)), png((0, 0, 0), (300, 300))
+    data = bytearray(archive({'good.png': good, 'bad.png': bad}))
+    # Garble the middle of the second member's deflate stream
+    offset = data.index(b'bad.png') + len('bad.png') + 20
+    data[offset:offset + 16] = bytes(16)
+    response = await post_batch(client, ('photos.zip', bytes(data), 'application/zip'))
+    assert response.status_code == 200
+    body = response.json()
+    assert [result['image_name'] for result in body['results']] == ['good.png']
+    assert [error['image_name'] for error in body['errors']] == ['bad.png']
+    assert body['errors'][0]['detail'].startswith("Could not extract image from archive")
+
+
+async def test_broken_process_pool_is_replaced(client, monkeypatch):
+    broken = server.create_batch_executor()
+    broken.submit(int).result()
+    for process in list(broken._processes.values()):
+        process.kill()
+    monkeypatch.setattr(server, 'batch_executor', broken)
+    
+    response = await post_batch(client, ('white.png', png((255, 255, 255)), 'image/png'))
+    assert response.status_code == 200
+    assert response.json()['errors'][0]['detail'] == "Image processing worker crashed"
+    replacement = server.batch_executor
+    assert replacement is not broken
+    try:
+        response = await post_batch(client, ('white.png', png((255, 255, 255)), 'image/png'))
+        assert response.json()['results'][0]['percentage'] == 100.0
+    finally:
+        replacement.shutdown()
@@ -0,0 +1,255 @@
+import asyncio
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def bonnet_photo(color=(30, 60, 200), size=(160, 120)) -> bytes:
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue()
+
+
+async def post_bonnet(client, data: bytes, **params):
+    return await client.post('/api/analyze/bonnet', params=params, files={'file': ('bonnet.jpg', data, 'image/jpeg')})
+
+
+async def test_cache_hit_skips_the_model(client, stub_model):
+    first = await post_bonnet(client, bonnet_photo())
+    second = await post_bonnet(client, bonnet_photo())
+    assert first.status_code == second.status_code == 200
+    assert stub_model.calls == 1
+    assert second.json()['condition'] == first.json()['condition'] == 'Good'
+    assert second.json()['id'] != first.json()['id']
+    assert server.bonnet_cache.stats()['hits'] == 1
+
+
+async def test_persistent_tier_survives_a_restart(client, stub_model, monkeypatch):
+    await post_bonnet(client, bonnet_photo())
+    monkeypatch.setattr(server, 'bonnet_cache', server.BonnetResultCache(64, 1024 * 1024, 3600))
+    await post_bonnet(client, bonnet_photo())
+    assert stub_model.calls == 1
+    assert server.bonnet_cache.stats()['persistent_hits'] == 1
+
+
+async def test_expired_results_are_analyzed_again(client, stub_model, monkeypatch):
+    monkeypatch.setattr(server.bonnet_cache, 'ttl_seconds', 0)
+    await post_bonnet(client, bonnet_photo())
+    await post_bonnet(client, bonnet_photo())
+    assert stub_model.calls == 2
+    assert server.bonnet_cache.stats()['expirations'] == 1
+
+
+async def test_version_change_misses_the_cache(client, stub_model, monkeypatch):
+    await post_bonnet(client, bonnet_photo())
+    monkeypatch.setattr(server, 'BONNET_ANALYSIS_VERSION', 'changed')
+    await post_bonnet(client, bonnet_photo())
+    assert stub_model.calls == 2
+
+
+async def test_unparseable_results_are_not_cached(client, stub_model, monkeypatch):
+    async def gibberish(self, message):
+        stub_model.calls += 1
+        return "I cannot help with that."
+    
+    monkeypatch.setattr(stub_model, 'send_message', gibberish)
+    await post_bonnet(client, bonnet_photo())
+    await post_bonnet(client, bonnet_photo())
+    assert stub_model.calls == 2
+
+
+async def test_concurrent_identical_uploads_share_one_call(client, stub_model, monkeypatch):
+    monkeypatch.setattr(stub_model, 'latency', 0.2)
+    responses = await asyncio.gather(*(post_bonnet(client, bonnet_photo()) for _ in range(8)))
+    assert [response.status_code for response in responses] == [200] * 8
+    assert stub_model.calls == 1
+    assert len({response.json()['id'] for response in responses}) == 8
+    assert server.bonnet_flights.stats() == {'in_flight': 0, 'leaders': 1, 'coalesced': 7}
+
+
+async def test_leader_failure_reaches_every_waiter(client, stub_model, monkeypatch):
+    async def fail(self, message):
+        stub_model.calls += 1
+        await asyncio.sleep(0.2)
+        raise ValueError("model rejected the request")
+    
+    send_message = stub_model.send_message
+    monkeypatch.setattr(stub_model, 'send_message', fail)
+    responses = await asyncio.gather(*(post_bonnet(client, bonnet_photo()) for _ in range(5)))
+    assert [response.status_code for response in responses] == [500] * 5
+    assert all('model rejected the request' in response.json()['detail'] for response in responses)
+    assert stub_model.calls == 1
+    
+    # Nothing was cached, so the next upload asks the model again
+    monkeypatch.setattr(stub_model, 'send_message', send_message)
+    await post_bonnet(client, bonnet_photo())
+    assert stub_model.calls == 2
+
+
+async def test_different_uploads_are_not_coalesced(client, stub_model):
+    await asyncio.gather(post_bonnet(client, bonnet_photo()), post_bonnet(client, bonnet_photo((200, 20, 20))))
+    assert stub_model.calls == 2
+
+
+async def test_memory_tier_evicts_within_the_byte_budget(db):
+    result = {'condition': 'Good', 'detailed_report': 'x' * 100}
+    size = len(server.json.dumps(result))
+    cache = server.BonnetResultCache(max_entries=10, max_bytes=size * 2, ttl_seconds=3600)
+    for key in ('a', 'b', 'c'):
+        await cache.set(key, result)
+    assert cache.stats()['entries'] == 2
+    assert cache.stats()['bytes'] <= size * 2
+    assert cache.evictions == 1
+    
+    # The evicted entry is still served from MongoDB
+    assert await cache.get('a') == result
+    assert cache.persistent_hits == 1
+    
+    await cache.set('huge', {'detailed_report': 'x' * size * 3})
+    assert 'huge' not in cache._entries
+
+
+def analysis_version(**env) -> str:
+    """BONNET_ANALYSIS_VERSION of a fresh import with `env` set"""
+    backend = Path(server.__file__).parent
+    output = subprocess.run(
+        [sys.executable, '-c', 'import server; print(server.BONNET_ANALYSIS_VERSION)'],
+        cwd=backend, env={**os.environ, **env}, capture_output=True, text=True, check=True
+    )
+    return output.stdout.strip().splitlines()[-1]
+
+
+def test_cache_version_follows_model_and_provider():
+    base = analysis_version()
+    assert base == server.BONNET_ANALYSIS_VERSION
+    assert analysis_version(BONNET_MODEL='another-model') != base
+    assert analysis_version(VISION_PROVIDER='remote') != base
+    assert analysis_version(MODEL_IMAGE_MAX_EDGE='512') != base
+
+
+async def test_sync_analysis_with_the_local_provider(client, db):
+    response = await post_bonnet(client, bonnet_photo())
+    assert response.status_code == 200
+    body = response.json()
+    assert (body['car_color'], body['condition'], body['provider']) == ('Blue', 'Good', 'local')
+    assert await db.analyses.count_documents({'id': body['id']}) == 1
+
+
+async def test_tiered_mode_escalates_uncertain_images(client, stub_model, monkeypatch):
+    monkeypatch.setattr(server.vision_router, 'mode', 'tiered')
+    monkeypatch.setattr(server.vision_router, 'threshold', 0.5)
+    escalations = server.vision_stats.escalations
+    
+    assert (await post_bonnet(client, bonnet_photo())).json()['provider'] == 'local'
+    # Too small to assess locally
+    body = (await post_bonnet(client, bonnet_photo(size=(8, 8)))).json()
+    assert (body['provider'], body['car_color']) == ('remote', 'Red')
+    assert (stub_model.calls, server.vision_stats.escalations - escalations) == (1, 1)
+
+
+def test_unknown_provider_is_rejected():
+    with pytest.raises(ValueError):
+        server.VisionRouter('cloud', 0.5)
+
+
+async def test_rejects_non_images(client, db):
+    response = await client.post('/api/analyze/bonnet', files={'file': ('bonnet.txt', b'text', 'text/plain')})
+    assert response.status_code in (400, 415)
+
+
+async def wait_for_job(client, analysis_id: str) -> dict:
+    for _ in range(100):
+        analysis = (await client.get(f'/api/analysis/{analysis_id}')).json()
+        if analysis['status'] in ('completed', 'failed'):
+            break
+        await asyncio.sleep(0.02)
+    return analysis
+
+
+async def test_async_job_completes(client, db):
+    await server.analysis_jobs.start()
+    try:
+        response = await post_bonnet(client, bonnet_photo((200, 20, 20)), mode='async')
+        assert response.status_code == 202
+        analysis = await wait_for_job(client, response.json()['id'])
+        assert analysis['status'] == 'completed'
+        assert analysis['car_color'] == 'Red'
+        # The upload is kept once, in the image store
+        assert await server.image_store.open('originals', analysis['image_digest']) is not None
+    finally:
+        await server.analysis_jobs.stop()
+
+
+async def test_transient_failures_are_retried_after_the_delay(client, db, monkeypatch):
+    get_bonnet_analysis = server.get_bonnet_analysis
+    calls = 0
+    
+    async def fail_once(upload):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise HTTPException(status_code=503, detail="Overloaded")
+        return await get_bonnet_analysis(upload)
+    
+    monkeypatch.setattr(server, 'get_bonnet_analysis', fail_once)
+    monkeypatch.setattr(server, 'JOB_RETRY_DELAY_SECONDS', 0.2)
+    await server.analysis_jobs.start()
+    try:
+        response = await post_bonnet(client, bonnet_photo(), mode='async')
+        analysis_id = response.json()['id']
+        await asyncio.sleep(0.1)
+        job = await db.analyses.find_one({'id': analysis_id})
+        assert (job['status'], job['error'], job['attempts']) == ('pending', 'Overloaded', 1)
+        assert job['next_attempt_at'] > datetime.now(timezone.utc)
+        # Not due yet, so the sweep leaves it alone
+        assert await server.analysis_jobs.recover() == 0
+        
+        analysis = await wait_for_job(client, analysis_id)
+        assert (analysis['status'], analysis['attempts'], calls) == ('completed', 2, 2)
+        assert 'next_attempt_at' not in analysis
+    finally:
+        await server.analysis_jobs.stop()
+
+
+async def test_sweep_queues_due_jobs_and_fails_exhausted_ones(db, monkeypatch):
+    now = datetime.now(timezone.utc)
+    long_ago = now - timedelta(seconds=server.JOB_STALE_SECONDS + 1)
+    await db.analyses.insert_many([
+        {'id': 'new', 'status': 'pending', 'attempts': 0},
+        {'id': 'due', 'status': 'pending', 'attempts': 1, 'next_attempt_at': now - timedelta(seconds=1)},
+        {'id': 'delayed', 'status': 'pending', 'attempts': 1, 'next_attempt_at': now + timedelta(minutes=1)},
+        {'id': 'stale', 'status': 'processing', 'attempts': 1, 'started_at': long_ago},
+        {'id': 'running', 'status': 'processing', 'attempts': 1, 'started_at': now},
+        {'id': 'exhausted', 'status': 'processing', 'attempts': server.JOB_MAX_ATTEMPTS, 'started_at': long_ago},
+    ])
+    jobs = server.AnalysisJobQueue(workers=0)
+    jobs._queue = asyncio.Queue()
+    
+    assert await jobs.recover() == 3
+    assert sorted(jobs._queue.get_nowait() for _ in range(3)) == ['due', 'new', 'stale']
+    exhausted = await db.analyses.find_one({'id': 'exhausted'})
+    assert (exhausted['status'], jobs.failed) == ('failed', 1)
+    assert 'attempts' in exhausted['error']
+    
+    # A job that used up its attempts is never claimed again
+    await db.analyses.update_one({'id': 'exhausted'}, {'$set': {'status': 'pending'}})
+    assert await jobs._claim('exhausted') is None
+    assert (await jobs._claim('delayed'))['attempts'] == 2
+
+
+async def test_async_submissions_are_rejected_while_draining(client, db, monkeypatch):
+    monkeypatch.setattr(server.lifecycle, 'phase', 'draining')
+    response = await post_bonnet(client, bonnet_photo(), mode='async')
+    assert response.status_code == 503
+    assert await db.analyses.count_documents({}) == 0
@@ -0,0 +1,47 @@
+import csv
+import gzip
+import json
+from io import BytesIO, StringIO
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_ndjson_is_gzipped_oldest_first(client, insert_analyses):
+    expected = await insert_analyses(5)
+    response = await client.get('/api/analysis/export')
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/gzip'
+    rows = [json.loads(line) for line in gzip.decompress(response.content).splitlines()]
+    assert [row['id'] for row in rows] == [doc['id'] for doc in reversed(expected)]
+    assert '_id' not in rows[0]
+
+
+async def test_csv_resumes_after_the_last_row(client, insert_analyses):
+    expected = [doc['id'] for doc in reversed(await insert_analyses(6))]
+    first = await client.get('/api/analysis/export', params={'format': 'csv', 'gzip': 'false'})
+    rows = list(csv.DictReader(StringIO(first.text)))
+    assert [row['id'] for row in rows] == expected
+    
+    # Resume after the third row, within the snapshot of the first response
+    last = rows[2]
+    resumed = await client.get('/api/analysis/export', params={
+        'format': 'csv', 'gzip': 'false', 'after_timestamp': last['timestamp'], 'after_id': last['id'],
+        'end': first.headers['x-export-end']
+    })
+    assert [row['id'] for row in csv.DictReader(StringIO(resumed.text))] == expected[3:]
+
+
+async def test_resume_needs_both_keys(client, db):
+    response = await client.get('/api/analysis/export', params={'after_id': 'x'})
+    assert response.status_code == 400
+
+
+async def test_parquet(client, insert_analyses):
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    expected = await insert_analyses(4)
+    response = await client.get('/api/analysis/export', params={'format': 'parquet'})
+    assert response.status_code == 200
+    table = pyarrow_parquet.read_table(BytesIO(response.content))
+    assert table.column('id').to_pylist() == [doc['id'] for doc in reversed(expected)]
@@ -0,0 +1,73 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_pages_cover_every_analysis_once(client, insert_analyses):
+    expected = await insert_analyses(7)
+    seen = []
+    cursor = None
+    while True:
+        params = {'limit': 3, **({'cursor': cursor} if cursor else {})}
+        response = await client.get('/api/analysis/history', params=params)
+        assert response.status_code == 200
+        seen.extend(item['id'] for item in response.json())
+        cursor = response.headers.get('x-next-cursor')
+        if cursor is None:
+            break
+    assert seen == [doc['id'] for doc in expected]
+
+
+async def test_type_and_time_filters(client, insert_analyses):
+    docs = await insert_analyses(6)
+    response = await client.get('/api/analysis/history', params={'analysis_type': 'bonnet'})
+    assert response.json() == []
+    
+    # Timestamps 1s and 2s after the first pair, end exclusive
+    start, end = docs[-3]['timestamp'], docs[0]['timestamp']
+    response = await client.get('/api/analysis/history', params={'start': start.isoformat(), 'end': end.isoformat()})
+    assert [item['id'] for item in response.json()] == ['0003', '0002']
+
+
+async def test_fields(client, insert_analyses):
+    await insert_analyses(2)
+    response = await client.get('/api/analysis/history', params={'fields': 'id,summary'})
+    assert all(set(item) == {'id', 'summary'} for item in response.json())
+    
+    for fields in ('_id', 'id,secret', 'a b'):
+        response = await client.get('/api/analysis/history', params={'fields': fields})
+        assert response.status_code == 400
+
+
+async def test_detail_fields(client, insert_analyses):
+    await insert_analyses(1)
+    response = await client.get('/api/analysis/0000', params={'fields': 'percentage,image_digest'})
+    assert response.json() == {'id': '0000', 'percentage': 0.0, 'image_digest': None}
+    
+    # _id would override the projection's exclusion and fail to serialize
+    for fields in ('_id', 'id,_id', 'percentage,secret'):
+        response = await client.get('/api/analysis/0000', params={'fields': fields})
+        assert response.status_code == 400
+
+
+async def test_unchanged_pages_get_304(client, db, insert_analyses):
+    await insert_analyses(3)
+    response = await client.get('/api/analysis/history')
+    etag = response.headers['etag']
+    
+    again = await client.get('/api/analysis/history', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.headers['etag'] == etag
+    
+    await db.analyses.update_one({'id': '0000'}, {'$set': {'percentage': 50.0}})
+    changed = await client.get('/api/analysis/history', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    
+    detail = await client.get('/api/analysis/0001')
+    again = await client.get('/api/analysis/0001', headers={'If-None-Match': detail.headers['etag']})
+    assert again.status_code == 304
+
+
+async def test_invalid_cursor(client, db):
+    response = await client.get('/api/analysis/history', params={'cursor': 'not-a-cursor'})
+    assert response.status_code == 400
@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def upload(data: bytes) -> server.IngestedUpload:
+    return server.IngestedUpload(
+        filename='bonnet.jpg', data=bytearray(data), digest=hashlib.sha256(data).hexdigest(), format='JPEG', size=(1, 1)
+    )
+
+
+async def age_ref(db, digest, **fields):
+    last_referenced = datetime.now(timezone.utc) - timedelta(hours=2)
+    await db[server.IMAGE_REFS_COLLECTION].update_one(
+        {"_id": digest}, {"$set": {"last_referenced_at": last_referenced, **fields}}
+    )
+
+
+async def test_unreferenced_images_are_collected(db):
+    kept, dropped = upload(b'kept image'), upload(b'dropped image')
+    for item in (kept, dropped):
+        assert await server.store_image(item, b'thumbnail') == item.digest
+        await age_ref(db, item.digest)
+    await db.analyses.insert_one({'id': 'a', 'image_digest': kept.digest})
+    
+    result = await server.collect_images(grace_seconds=3600)
+    assert result['deleted'] == 1
+    assert await server.image_store.open('originals', dropped.digest) is None
+    assert await server.image_store.open('thumbnails', dropped.digest) is None
+    assert await db[server.IMAGE_REFS_COLLECTION].find_one({"_id": dropped.digest}) is None
+    assert await server.image_store.open('originals', kept.digest) is not None
+
+
+async def test_recently_referenced_images_are_kept(db):
+    item = upload(b'fresh image')
+    await server.store_image(item, None)
+    result = await server.collect_images(grace_seconds=3600)
+    assert result['deleted'] == 0
+    assert await server.image_store.open('originals', item.digest) is not None
+
+
+async def test_image_rereferenced_after_the_scan_is_kept(db, monkeypatch):
+    item = upload(b'raced image')
+    await server.store_image(item, None)
+    await age_ref(db, item.digest)
+    
+    # An upload of the same image lands between the scan and the claim
+    refs = db[server.IMAGE_REFS_COLLECTION]
+    update_one = type(refs).update_one
+    
+    async def upload_before_claim(self, filter, update, *args, **kwargs):
+        if 'collecting_at' in update.get('$set', {}):
+            await update_one(self, {"_id": item.digest}, {"$set": {"last_referenced_at": datetime.now(timezone.utc)}})
+        return await update_one(self, filter, update, *args, **kwargs)
+    
+    monkeypatch.setattr(type(refs), 'update_one', upload_before_claim)
+    result = await server.collect_images(grace_seconds=3600)
+    monkeypatch.undo()
+    assert result['deleted'] == 0
+    assert await server.image_store.open('originals', item.digest) is not None
+
+
+async def test_store_waits_for_a_running_collection(db):
+    item = upload(b'claimed image')
+    await server.store_image(item, None)
+    await server.image_store.delete(item.digest)
+    await age_ref(db, item.digest, collecting_at=datetime.now(timezone.utc))
+    
+    store = asyncio.create_task(server.store_image(item, None))
+    await asyncio.sleep(0.2)
+    assert not store.done()
+    
+    # The collection finishes and removes the reference
+    await db[server.IMAGE_REFS_COLLECTION].delete_one({"_id": item.digest})
+    assert await asyncio.wait_for(store, 5) == item.digest
+    assert await server.image_store.open('originals', item.digest) is not None
+    ref = await db[server.IMAGE_REFS_COLLECTION].find_one({"_id": item.digest})
+    assert 'collecting_at' not in ref
+
+
+async def test_stale_claims_are_taken_over(db):
+    item = upload(b'stale claim')
+    await server.store_image(item, None)
+    await age_ref(db, item.digest, collecting_at=datetime.now(timezone.utc) - timedelta(hours=1))
+    assert await server.store_image(item, None) == item.digest
+    ref = await db[server.IMAGE_REFS_COLLECTION].find_one({"_id": item.digest})
+    assert 'collecting_at' not in ref
+
+
+async def test_missing_files_are_recreated(db):
+    item = upload(b'lost image')
+    await server.store_image(item, b'thumbnail')
+    await server.image_store.delete(item.digest)
+    assert await server.store_image(item, b'thumbnail') == item.digest
+    assert await server.image_store.open('originals', item.digest) is not None
+    assert await server.image_store.open('thumbnails', item.digest) is not None
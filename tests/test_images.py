@@ -0,0 +1,75 @@
+import hashlib
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def stored(db):
+    buffer = BytesIO()
+    Image.new('RGB', (64, 48), (200, 10, 10)).save(buffer, 'PNG')
+    data = buffer.getvalue()
+    upload = server.IngestedUpload(
+        filename='red.png', data=bytearray(data), digest=hashlib.sha256(data).hexdigest(), format='PNG', size=(64, 48)
+    )
+    assert await server.store_upload(upload) == upload.digest
+    return upload.digest, data
+
+
+async def test_original_is_served_with_caching_headers(client, stored):
+    digest, data = stored
+    response = await client.get(f'/api/images/{digest}')
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers['content-type'] == 'image/png'
+    assert response.headers['etag'] == f'"{digest}"'
+    assert 'immutable' in response.headers['cache-control']
+    
+    again = await client.get(f'/api/images/{digest}', headers={'If-None-Match': f'W/"{digest}", "other"'})
+    assert again.status_code == 304
+    assert again.content == b''
+
+
+async def test_thumbnail(client, stored):
+    digest, _ = stored
+    response = await client.get(f'/api/images/{digest}/thumbnail')
+    assert response.status_code == 200
+    assert response.headers['etag'] == f'"{digest}-thumbnail"'
+    assert Image.open(BytesIO(response.content)).format == 'JPEG'
+
+
+@pytest.mark.parametrize('header, expected', [('bytes=0-9', (0, 9)), ('bytes=10-', (10, None)), ('bytes=-5', (-5, None))])
+async def test_byte_ranges(client, stored, header, expected):
+    digest, data = stored
+    response = await client.get(f'/api/images/{digest}', headers={'Range': header})
+    assert response.status_code == 206
+    start, end = expected
+    body = data[start:] if end is None else data[start:end + 1]
+    assert response.content == body
+    first = start % len(data)
+    assert response.headers['content-range'] == f'bytes {first}-{first + len(body) - 1}/{len(data)}'
+    assert response.headers['content-length'] == str(len(body))
+
+
+async def test_unsatisfiable_range(client, stored):
+    digest, data = stored
+    response = await client.get(f'/api/images/{digest}', headers={'Range': f'bytes={len(data)}-'})
+    assert response.status_code == 416
+    assert response.headers['content-range'] == f'bytes */{len(data)}'
+
+
+async def test_stale_if_range_gets_the_whole_image(client, stored):
+    digest, data = stored
+    response = await client.get(f'/api/images/{digest}', headers={'Range': 'bytes=0-9', 'If-Range': '"other"'})
+    assert response.status_code == 200
+    assert response.content == data
+
+
+async def test_unknown_and_invalid_digests(client, db):
+    assert (await client.get(f"/api/images/{'0' * 64}")).status_code == 404
+    assert (await client.get('/api/images/not-a-digest')).status_code in (400, 404, 422)
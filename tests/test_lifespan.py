@@ -0,0 +1,83 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import litellm
+import server
+
+
+@pytest.fixture
+def resources(monkeypatch, db):
+    """Fresh pools and lifecycle for one start/stop cycle, so shutting them down leaves other tests alone"""
+    monkeypatch.setattr(server, 'STARTUP_WARMUP', False)
+    monkeypatch.setattr(server, 'lifecycle', server.ServiceLifecycle())
+    monkeypatch.setattr(server, 'image_executor', ThreadPoolExecutor(max_workers=2))
+    monkeypatch.setattr(server, 'batch_executor', server.create_batch_executor())
+    monkeypatch.setattr(server, 'client', db.client)
+    monkeypatch.setattr(server, 'analysis_jobs', server.AnalysisJobQueue(workers=1))
+
+
+def bonnet_photo() -> bytes:
+    buffer = BytesIO()
+    Image.new('RGB', (160, 120), (30, 60, 200)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_lifespan_opens_and_closes_resources(resources):
+    assert server.lifecycle.phase == 'starting'
+    with TestClient(server.app) as client:
+        assert server.lifecycle.phase == 'ready'
+        assert litellm.aclient_session is not None
+        assert server.analysis_jobs.stats()['workers'] == 1 and server.analysis_jobs._tasks
+        response = client.get('/api/ready')
+        assert response.status_code == 200
+        assert response.json()['mongo'] == 'ok'
+    
+    assert server.lifecycle.phase == 'draining'
+    assert litellm.aclient_session is None
+    assert server.analysis_jobs._tasks == []
+    with pytest.raises(RuntimeError):
+        server.image_executor.submit(print)
+
+
+def test_in_flight_analyses_finish_before_shutdown(resources, stub_model, monkeypatch):
+    monkeypatch.setattr(stub_model, 'latency', 0.5)
+    responses = {}
+    
+    with TestClient(server.app) as client:
+        def post(name):
+            responses[name] = client.post('/api/analyze/bonnet', files={'file': ('bonnet.jpg', bonnet_photo(), 'image/jpeg')})
+        
+        analysis = threading.Thread(target=post, args=('running',))
+        analysis.start()
+        wait_until(lambda: server.lifecycle.in_flight == 1)
+        
+        # Shut down while the analysis runs; leaving the block afterwards is then a no-op
+        shutdown = threading.Thread(target=client.__exit__, args=(None, None, None))
+        shutdown.start()
+        wait_until(lambda: server.lifecycle.phase == 'draining')
+        
+        # While draining the service is not ready and takes no new analyses
+        ready = client.get('/api/ready')
+        assert (ready.status_code, ready.json()['in_flight']) == (503, 1)
+        post('rejected')
+        
+        analysis.join()
+        shutdown.join()
+    
+    assert responses['running'].status_code == 200
+    assert responses['rejected'].status_code == 503
+    assert server.lifecycle.in_flight == 0
+    assert stub_model.calls == 1
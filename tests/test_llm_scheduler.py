@@ -0,0 +1,172 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class UpstreamError(Exception):
+    """Error of the model client, carrying the upstream HTTP status"""
+    
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def scheduler(**overrides) -> server.LlmScheduler:
+    settings = dict(
+        max_concurrency=2, max_queue=10, queue_timeout=5, rate_per_second=0, burst=1,
+        timeout=1, max_retries=2, retry_base=0.001
+    )
+    return server.LlmScheduler(**{**settings, **overrides})
+
+
+async def test_concurrency_is_bounded():
+    limiter = scheduler(max_concurrency=2)
+    running = 0
+    peak = 0
+    
+    async def call():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return 'ok'
+    
+    assert await asyncio.gather(*(limiter.run(call) for _ in range(6))) == ['ok'] * 6
+    assert peak == 2
+    assert limiter.stats()['completed'] == 6
+
+
+async def test_full_queue_fails_fast():
+    limiter = scheduler(max_concurrency=1, max_queue=1)
+    release = asyncio.Event()
+    
+    async def call():
+        await release.wait()
+    
+    running = asyncio.create_task(limiter.run(call))
+    await asyncio.sleep(0.01)
+    waiting = asyncio.create_task(limiter.run(call))
+    await asyncio.sleep(0.01)
+    assert limiter.stats()['queue_depth'] == 1
+    with pytest.raises(HTTPException) as error:
+        await limiter.run(call)
+    assert error.value.status_code == 503
+    assert 'Retry-After' in error.value.headers
+    release.set()
+    await asyncio.gather(running, waiting)
+    assert limiter.rejected == 1
+
+
+async def test_retryable_errors_are_retried():
+    limiter = scheduler()
+    attempts = 0
+    
+    async def call():
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            raise UpstreamError("Service Unavailable", 503)
+        return 'ok'
+    
+    assert await limiter.run(call) == 'ok'
+    assert limiter.retries == 2
+
+
+async def test_rate_limits_surface_as_429_after_the_last_retry():
+    limiter = scheduler(max_retries=1)
+    
+    async def call():
+        raise UpstreamError("Rate limit reached", 429)
+    
+    with pytest.raises(HTTPException) as error:
+        await limiter.run(call)
+    assert error.value.status_code == 429
+    assert limiter.failed == 1
+
+
+async def test_other_errors_are_not_retried():
+    limiter = scheduler()
+    
+    async def call():
+        raise ValueError("bad request")
+    
+    with pytest.raises(ValueError):
+        await limiter.run(call)
+    assert limiter.retries == 0
+
+
+async def test_slow_calls_time_out():
+    limiter = scheduler(timeout=0.01, max_retries=0)
+    
+    async def call():
+        await asyncio.sleep(1)
+    
+    with pytest.raises(HTTPException) as error:
+        await limiter.run(call)
+    assert error.value.status_code == 504
+    assert limiter.timeouts == 1
+
+
+async def test_wrapped_and_network_errors_are_retried():
+    limiter = scheduler(max_retries=3)
+    errors = [httpx.ConnectError("connection refused"), ConnectionResetError()]
+    
+    async def call():
+        if errors:
+            raise errors.pop()
+        try:
+            raise UpstreamError("Overloaded", 502)
+        except UpstreamError as e:
+            raise RuntimeError("Failed to generate chat completion") from e
+    
+    with pytest.raises(HTTPException) as error:
+        await limiter.run(call)
+    assert error.value.status_code == 502
+    assert limiter.retries == 3
+
+
+@pytest.mark.parametrize('error', [
+    HTTPException(status_code=500, detail="Error analyzing image: 500 pixels"),
+    UpstreamError("Invalid image", 400),
+    RuntimeError("503 Service Unavailable"),
+])
+async def test_errors_are_classified_by_type_and_status(error):
+    limiter = scheduler()
+    
+    async def call():
+        raise error
+    
+    with pytest.raises(type(error)):
+        await limiter.run(call)
+    assert (limiter.retries, limiter.failed) == (0, 1)
+
+
+async def test_queue_timeout_keeps_permits():
+    limiter = scheduler(max_concurrency=1, queue_timeout=0.01)
+    release = asyncio.Event()
+    
+    async def call():
+        await release.wait()
+        return 'ok'
+    
+    running = asyncio.create_task(limiter.run(call))
+    await asyncio.sleep(0)
+    with pytest.raises(HTTPException) as error:
+        await limiter.run(call)
+    assert error.value.status_code == 503
+    
+    # A cancelled waiter gives back nothing it did not hold
+    waiting = asyncio.create_task(limiter.run(call))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    release.set()
+    assert await running == 'ok'
+    assert limiter._semaphore._value == 1
+    assert (limiter.waiting, limiter.in_flight) == (0, 0)
@@ -0,0 +1,39 @@
+import math
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import server
+
+
+def png(width, height, seed=0):
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('size', [(1, 1), (3, 200), (200, 15)])
+def test_too_small_images_are_unknown(size):
+    result = server.local_bonnet_assessment(png(*size))
+    assert result['condition'] == 'Unknown'
+    assert result['wash_or_repaint'] == 'Unknown'
+    assert result['confidence'] == 0.0
+
+
+@pytest.mark.parametrize('size', [(16, 16), (17, 40), (300, 200)])
+def test_confidence_is_finite(size):
+    result = server.local_bonnet_assessment(png(*size))
+    assert result['condition'] in ('Good', 'Bad')
+    assert math.isfinite(result['confidence'])
+    assert 0 <= result['confidence'] <= 1
+
+
+def test_uniform_panel_is_good():
+    buffer = BytesIO()
+    Image.new('RGB', (120, 80), (30, 60, 200)).save(buffer, 'PNG')
+    result = server.local_bonnet_assessment(buffer.getvalue())
+    assert (result['car_color'], result['condition'], result['wash_or_repaint']) == ('Blue', 'Good', 'Wash')
+    assert result['confidence'] > 0.9
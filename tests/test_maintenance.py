@@ -0,0 +1,82 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import maintenance
+
+pytestmark = pytest.mark.anyio
+
+
+class Interrupted(Exception):
+    pass
+
+
+async def insert_legacy(db):
+    await db.analyses.insert_many([
+        {'_id': 1, 'timestamp': '2026-01-01T10:00:00'},
+        {'_id': 2, 'timestamp': '2026-01-01T10:00:00+02:00'},
+        {'_id': 3, 'timestamp': 'yesterday'},
+        {'_id': 4, 'timestamp': datetime(2026, 1, 2, tzinfo=timezone.utc)},
+        {'_id': 5, 'timestamp': '2026-01-03T00:00:00.123456Z'},
+        {'_id': 6, 'timestamp': '2026-01-04T12:30:00'},
+    ])
+
+
+async def test_timestamps_are_converted(db):
+    await insert_legacy(db)
+    await maintenance.migrate_timestamps(batch_size=2, restart=False)
+    
+    docs = {doc['_id']: doc['timestamp'] async for doc in db.analyses.find()}
+    assert docs[1] == datetime(2026, 1, 1, 10, tzinfo=timezone.utc)
+    assert docs[2] == datetime(2026, 1, 1, 8, tzinfo=timezone.utc)
+    assert docs[3] == 'yesterday'
+    assert docs[5] == datetime(2026, 1, 3, 0, 0, 0, 123000, tzinfo=timezone.utc)
+    checkpoint = await maintenance.load_checkpoint('migrate-timestamps')
+    assert (checkpoint['completed'], checkpoint['converted'], checkpoint['skipped']) == (True, 4, 1)
+
+
+async def test_interrupted_run_resumes_after_the_checkpoint(db, monkeypatch):
+    await insert_legacy(db)
+    info = maintenance.logger.info
+    
+    def interrupt_after_first_batch(message):
+        if message.startswith('Converted'):
+            raise Interrupted
+        info(message)
+    
+    monkeypatch.setattr(maintenance.logger, 'info', interrupt_after_first_batch)
+    with pytest.raises(Interrupted):
+        await maintenance.migrate_timestamps(batch_size=2, restart=False)
+    checkpoint = await maintenance.load_checkpoint('migrate-timestamps')
+    assert (checkpoint['last_id'], checkpoint['converted']) == (2, 2)
+    assert await db.analyses.count_documents({'timestamp': {'$type': 'string'}}) == 3
+    
+    # Resumed, the run only reads documents after the checkpoint
+    monkeypatch.setattr(maintenance.logger, 'info', info)
+    seen = []
+    find = type(db.analyses).find
+    
+    def record_find(self, query, *args, **kwargs):
+        seen.append(query)
+        return find(self, query, *args, **kwargs)
+    
+    monkeypatch.setattr(type(db.analyses), 'find', record_find)
+    await maintenance.migrate_timestamps(batch_size=2, restart=False)
+    assert seen[0]['_id'] == {'$gt': 2}
+    checkpoint = await maintenance.load_checkpoint('migrate-timestamps')
+    assert (checkpoint['completed'], checkpoint['converted'], checkpoint['skipped']) == (True, 4, 1)
+    assert await db.analyses.count_documents({'timestamp': {'$type': 'string'}}) == 1
+
+
+async def test_documents_changed_meanwhile_are_left_alone(db, monkeypatch):
+    await insert_legacy(db)
+    bulk_write = type(db.analyses).bulk_write
+    
+    async def rewrite_first(self, operations, **kwargs):
+        await db.analyses.update_one({'_id': 1}, {'$set': {'timestamp': '2026-02-01T00:00:00'}})
+        return await bulk_write(self, operations, **kwargs)
+    
+    monkeypatch.setattr(type(db.analyses), 'bulk_write', rewrite_first)
+    await maintenance.migrate_timestamps(batch_size=10, restart=True)
+    assert (await db.analyses.find_one({'_id': 1}))['timestamp'] == '2026-02-01T00:00:00'
+    assert (await maintenance.load_checkpoint('migrate-timestamps'))['converted'] == 3
@@ -0,0 +1,59 @@
+import hashlib
+
+import pytest
+from prometheus_client import REGISTRY
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def request_count(route: str, status: str) -> float:
+    labels = {'method': 'GET', 'route': route, 'status': status}
+    return REGISTRY.get_sample_value('http_request_duration_seconds_count', labels) or 0
+
+
+async def call_app(path: str, extensions: dict = None) -> list:
+    """Raw ASGI messages the app sends for a GET request"""
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '', 'headers': [],
+        'server': ('test', 80), 'client': ('127.0.0.1', 1234), 'extensions': extensions or {}
+    }
+    messages = []
+    
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+    
+    async def send(message):
+        messages.append(message)
+    
+    await server.app(scope, receive, send)
+    return messages
+
+
+async def test_requests_are_recorded_per_route(client):
+    before = request_count('/api/', '200')
+    response = await client.get('/api/')
+    assert response.status_code == 200
+    assert request_count('/api/', '200') == before + 1
+    
+    before = request_count('unmatched', '404')
+    assert (await client.get('/nowhere')).status_code == 404
+    assert request_count('unmatched', '404') == before + 1
+
+
+async def test_file_responses_keep_pathsend(db):
+    data = b'stored image bytes'
+    digest = hashlib.sha256(data).hexdigest()
+    await server.image_store.put('originals', digest, data)
+    await db[server.IMAGE_REFS_COLLECTION].insert_one({'_id': digest, 'format': 'JPEG', 'refs': 1})
+    if not (await server.image_store.open('originals', digest)).path:
+        pytest.skip("image store does not serve files from disk")
+    
+    route = '/api/images/{digest}'
+    before = request_count(route, '200')
+    messages = await call_app(f'/api/images/{digest}', {'http.response.pathsend': {}})
+    assert [message['type'] for message in messages] == ['http.response.start', 'http.response.pathsend']
+    assert request_count(route, '200') == before + 1
+    assert REGISTRY.get_sample_value('http_requests_in_flight', {'route': route}) == 0
@@ -0,0 +1,116 @@
+import json
+
+import server
+
+
+def test_structured_response():
+    response = json.dumps({
+        "car_color": "Blue",
+        "condition": "Good",
+        "wash_or_repaint": "Wash",
+        "issues": ["dust", " "],
+        "recommendations": ["wash it"],
+        "detailed_report": "Clean bonnet"
+    })
+    result = server.parse_gpt4_response(f"```json\n{response}\n```")
+    assert result == {
+        'car_color': 'Blue',
+        'condition': 'Good',
+        'wash_or_repaint': 'Wash',
+        'issues': ['dust'],
+        'recommendations': ['wash it'],
+        'detailed_report': 'Clean bonnet'
+    }
+
+
+def test_numbered_bold_keys():
+    response = (
+        "1. **Car Color**: Blue\n"
+        "2. **Condition:** Bad\n"
+        "3. __Wash or Repaint:__ Repaint recommended\n"
+        "4. **Issues:**\n"
+        "- deep scratch\n"
+        "- rust spot\n"
+        "5. `Recommendations`: sand | respray\n"
+        "6. **Detailed Report:** Paint damage near the edge"
+    )
+    result = server.parse_gpt4_response(response)
+    assert result['car_color'] == 'Blue'
+    assert result['condition'] == 'Bad'
+    assert result['wash_or_repaint'] == 'Repaint'
+    assert result['issues'] == ['deep scratch', 'rust spot']
+    assert result['recommendations'] == ['sand', 'respray']
+    assert result['detailed_report'] == 'Paint damage near the edge'
+
+
+def test_plain_legacy_lines():
+    result = server.parse_gpt4_response(
+        "COLOR: Red\nCONDITION: Good\nRECOMMENDATION: Wash\nISSUES: dust | smudge\n"
+        "RECOMMENDATIONS: wash it\nDETAILED_REPORT: fine"
+    )
+    assert (result['car_color'], result['condition'], result['wash_or_repaint']) == ('Red', 'Good', 'Wash')
+    assert result['issues'] == ['dust', 'smudge']
+    assert result['detailed_report'] == 'fine'
+
+
+def test_near_schema_json_is_salvaged():
+    response = json.dumps({
+        "car_color": "silver",
+        "condition": "good",
+        "wash_or_repaint": "Wash and polish",
+        "issues": "none",
+        "recommendations": "Wash | Wax",
+        "detailed_report": "Minor dust only"
+    })
+    stats_before = server.bonnet_parse_stats['salvaged']
+    result = server.parse_gpt4_response(response)
+    assert result == {
+        'car_color': 'silver',
+        'condition': 'Good',
+        'wash_or_repaint': 'Wash',
+        'issues': [],
+        'recommendations': ['Wash', 'Wax'],
+        'detailed_report': 'Minor dust only'
+    }
+    assert server.bonnet_parse_stats['salvaged'] == stats_before + 1
+
+
+def test_salvaged_json_falls_back_only_for_missing_fields():
+    response = json.dumps({"Car Color": "Black", "Condition": "BAD - dented", "issues": ["dent"]})
+    result = server.parse_gpt4_response(response)
+    assert result['car_color'] == 'Black'
+    assert result['condition'] == 'Bad'
+    assert result['issues'] == ['dent']
+    # Fields the JSON lacks stay unknown rather than being invented
+    assert result['wash_or_repaint'] == 'Unknown'
+    assert result['recommendations'] == []
+    assert result['detailed_report'] == response
+
+
+def test_unparseable_response_fails():
+    stats_before = server.bonnet_parse_stats['failed']
+    result = server.parse_gpt4_response("I cannot assess this image.")
+    assert result['condition'] == 'Unknown'
+    assert result['detailed_report'] == "I cannot assess this image."
+    assert server.bonnet_parse_stats['failed'] == stats_before + 1
+
+
+def test_normalize_choice():
+    assert server.normalize_choice('**bad**', ('Good', 'Bad')) == 'Bad'
+    assert server.normalize_choice('Repaint recommended', ('Wash', 'Repaint')) == 'Repaint'
+    assert server.normalize_choice('excellent', ('Good', 'Bad')) == 'Unknown'
+
+
+def test_vehicle_response_salvages_panels():
+    response = json.dumps({
+        "vehicle": {"car_color": "Red", "condition": "bad", "wash_or_repaint": "repaint"},
+        "panels": [
+            {"panel": "bonnet", "car_color": "Red", "condition": "Bad", "issues": "scratch | dent"},
+            {"panel": "roof", "condition": "good"}
+        ]
+    })
+    vehicle, panels = server.parse_vehicle_response(response, 3)
+    assert (vehicle['condition'], vehicle['wash_or_repaint']) == ('Bad', 'Repaint')
+    assert panels[0]['issues'] == ['scratch', 'dent']
+    assert panels[1]['condition'] == 'Good'
+    assert panels[2]['condition'] == 'Unknown'
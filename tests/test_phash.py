@@ -0,0 +1,65 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+HASH = '0f0f0f0f0f0f0f0f'
+NEAR_HASH = '0f0f0f0f0f0f0f0e'
+
+
+def analysis_doc(analysis_id, phash, **fields):
+    return {
+        'id': analysis_id, 'phash': phash, 'condition': 'Good', 'car_color': 'Blue', 'wash_or_repaint': 'Wash',
+        'issues': [], 'recommendations': [], 'detailed_report': 'fine',
+        'analysis_version': server.BONNET_ANALYSIS_VERSION, **fields
+    }
+
+
+async def test_reuse_is_disabled_by_default(db):
+    index = server.PerceptualHashIndex(server.PHASH_MAX_DISTANCE)
+    await db.analyses.insert_one(analysis_doc('a', HASH))
+    index.add_docs([analysis_doc('a', HASH)])
+    assert index.size == 0
+    assert await index.find_duplicate(HASH) is None
+
+
+async def test_near_duplicate_of_current_version(db):
+    index = server.PerceptualHashIndex(4)
+    doc = analysis_doc('a', HASH)
+    await db.analyses.insert_one(dict(doc))
+    index.add_docs([doc])
+    result = await index.find_duplicate(NEAR_HASH)
+    assert result['duplicate_of'] == 'a'
+    assert result['phash_distance'] == 1
+    assert result['condition'] == 'Good'
+
+
+async def test_other_versions_are_not_matched(db):
+    index = server.PerceptualHashIndex(4)
+    old = analysis_doc('old', HASH, analysis_version='0ld')
+    index.add_docs([old])
+    assert index.size == 0
+    
+    # An analysis re-analyzed to another version after it was indexed
+    doc = analysis_doc('a', HASH)
+    index.add_docs([doc])
+    await db.analyses.insert_one({**doc, 'analysis_version': '0ld'})
+    assert await index.find_duplicate(HASH) is None
+    
+    await db.analyses.insert_one(dict(old))
+    await index.rebuild()
+    assert index.size == 0
+
+
+@pytest.mark.parametrize('phash', ['0000000000000000', 'ffffffffffffffff', '0000000000000101'])
+async def test_low_entropy_hashes_are_ignored(db, phash):
+    index = server.PerceptualHashIndex(4)
+    doc = analysis_doc('flat', phash)
+    await db.analyses.insert_one(dict(doc))
+    index.add_docs([doc])
+    assert index.size == 0
+    
+    index.add_docs([analysis_doc('a', HASH)])
+    assert await index.find_duplicate(phash) is None
+    assert index.lookups == 0
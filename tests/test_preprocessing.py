@@ -0,0 +1,90 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, JpegImagePlugin
+
+import server
+
+
+def encode(image: Image.Image, format: str, **params) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format, **params)
+    return buffer.getvalue()
+
+
+def split_image(size=(200, 100)) -> Image.Image:
+    """Red left half, blue right half"""
+    image = Image.new('RGB', size, (0, 0, 255))
+    image.paste((255, 0, 0), (0, 0, size[0] // 2, size[1]))
+    return image
+
+
+def test_exif_orientation_is_applied():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # stored rotated, display turned 90 degrees clockwise
+    data = encode(split_image(), 'JPEG', quality=95, exif=exif)
+    
+    payload, info = server.prepare_image_for_model(data)
+    upright = Image.open(BytesIO(payload))
+    assert upright.size == (100, 200)
+    assert info['source_size'] == [200, 100]
+    assert info['payload_size'] == [100, 200]
+    assert info['payload_format'] == 'JPEG'
+    # The stored left half ends up on top
+    top, bottom = upright.getpixel((50, 20)), upright.getpixel((50, 180))
+    assert top[0] > 200 and top[2] < 60
+    assert bottom[2] > 200 and bottom[0] < 60
+    assert 0x0112 not in upright.getexif()
+
+
+def test_large_jpeg_is_downscaled(monkeypatch):
+    drafts = []
+    draft = JpegImagePlugin.JpegImageFile.draft
+    
+    def record_draft(self, mode, size):
+        result = draft(self, mode, size)
+        drafts.append(self.size)
+        return result
+    
+    monkeypatch.setattr(JpegImagePlugin.JpegImageFile, 'draft', record_draft)
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (30, 40, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels).resize((4000, 3000), Image.Resampling.BICUBIC)
+    data = encode(image, 'JPEG', quality=90)
+    
+    payload, info = server.prepare_image_for_model(data)
+    assert Image.open(BytesIO(payload)).size == (server.MODEL_IMAGE_MAX_EDGE, server.MODEL_IMAGE_MAX_EDGE * 3 // 4)
+    assert info['payload_size'] == [server.MODEL_IMAGE_MAX_EDGE, server.MODEL_IMAGE_MAX_EDGE * 3 // 4]
+    assert info['source_bytes'] == len(data)
+    assert info['payload_bytes'] == len(payload) < len(data)
+    assert info['decode_ms'] >= 0 and info['encode_ms'] >= 0
+    assert len(info['phash']) == 16
+    # Decoded at 1/2 scale rather than in full
+    assert drafts == [(2000, 1500)]
+
+
+def test_small_png_is_sent_as_uploaded():
+    data = encode(split_image((64, 48)).quantize(2), 'PNG')
+    payload, info = server.prepare_image_for_model(data)
+    assert payload == data
+    assert info['payload_format'] == 'PNG'
+    assert info['payload_bytes'] == info['source_bytes']
+    assert info['payload_size'] == info['source_size'] == [64, 48]
+
+
+def test_small_images_are_reencoded_when_that_is_smaller():
+    rng = np.random.default_rng(1)
+    data = encode(Image.fromarray(rng.integers(0, 256, (120, 160, 4), dtype=np.uint8), 'RGBA'), 'PNG')
+    payload, info = server.prepare_image_for_model(data)
+    assert info['payload_format'] == 'JPEG'
+    assert len(payload) < len(data)
+    assert Image.open(BytesIO(payload)).mode == 'RGB'
+
+
+def test_rescaled_copies_hash_alike():
+    rng = np.random.default_rng(2)
+    image = Image.fromarray(rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)).resize((800, 600), Image.Resampling.BICUBIC)
+    _, large = server.prepare_image_for_model(encode(image, 'JPEG', quality=95))
+    _, small = server.prepare_image_for_model(encode(image.resize((400, 300)), 'PNG'))
+    distance = bin(int(large['phash'], 16) ^ int(small['phash'], 16)).count('1')
+    assert distance <= 4
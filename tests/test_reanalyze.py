@@ -0,0 +1,129 @@
+import hashlib
+from datetime import datetime, timezone
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import reanalyze
+import server
+
+pytestmark = pytest.mark.anyio
+
+TASK = f"reanalyze-white_pixel-{server.WHITE_PIXEL_ANALYSIS_VERSION}"
+
+
+def half_white_png(seed: int) -> bytes:
+    image = Image.new('RGB', (40, 20), (0, 0, 0))
+    image.paste((255, 255, 255), (0, 0, 20 + seed, 20))
+    buffer = BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+async def insert_outdated(db, count: int) -> list:
+    """White pixel analyses from an older version whose stored result is wrong"""
+    docs = []
+    for index in range(count):
+        data = half_white_png(index)
+        digest = hashlib.sha256(data).hexdigest()
+        upload = server.IngestedUpload(filename=f'{index}.png', data=bytearray(data), digest=digest, format='PNG', size=(40, 20))
+        assert await server.store_upload(upload) == digest
+        docs.append(server.analysis_to_doc(server.WhitePixelAnalysis(
+            id=f'{index:04d}', image_name=upload.filename, white_pixel_count=720, total_pixels=800, percentage=90.0,
+            analysis_result='High white pixel content', image_digest=digest, analysis_version='old',
+            timestamp=datetime(2026, 1, 1, tzinfo=timezone.utc)
+        )))
+    await db.analyses.insert_many([dict(doc) for doc in docs])
+    await server.update_rollups(docs)
+    return docs
+
+
+def test_update_is_conditional_and_capped(monkeypatch):
+    monkeypatch.setattr(reanalyze, 'MAX_PREVIOUS_VERSIONS', 3)
+    doc = {'_id': 1, 'analysis_version': 'old', 'percentage': 90.0, 'white_pixel_count': 720}
+    now = datetime.now(timezone.utc)
+    
+    update = reanalyze.reanalysis_update('white_pixel', 'new', doc, {**doc, 'percentage': 50.0}, now)
+    assert update._filter == {'_id': 1, 'analysis_version': 'old'}
+    assert update._doc['$set']['analysis_version'] == 'new'
+    assert update._doc['$push']['previous_versions']['$slice'] == -3
+    previous = update._doc['$push']['previous_versions']['$each'][0]
+    assert (previous['percentage'], previous['analysis_version'], previous['replaced_at']) == (90.0, 'old', now)
+    
+    # An unchanged result only has its version bumped
+    update = reanalyze.reanalysis_update('white_pixel', 'new', doc, dict(doc), now)
+    assert '$push' not in update._doc
+
+
+async def test_previous_versions_are_capped(db, monkeypatch):
+    monkeypatch.setattr(reanalyze, 'MAX_PREVIOUS_VERSIONS', 2)
+    await db.analyses.insert_one({'_id': 1, 'analysis_version': 'v0', 'percentage': 0.0})
+    for version in range(1, 4):
+        doc = await db.analyses.find_one({'_id': 1})
+        result = {'percentage': float(version)}
+        await db.analyses.bulk_write([
+            reanalyze.reanalysis_update('white_pixel', f'v{version}', doc, result, datetime.now(timezone.utc))
+        ])
+    doc = await db.analyses.find_one({'_id': 1})
+    assert [previous['analysis_version'] for previous in doc['previous_versions']] == ['v1', 'v2']
+    
+    # A write based on a version that has since been replaced matches nothing
+    stale = reanalyze.reanalysis_update('white_pixel', 'v9', {**doc, 'analysis_version': 'v1'}, {'percentage': 9.0}, None)
+    assert (await db.analyses.bulk_write([stale])).matched_count == 0
+
+
+@pytest.mark.parametrize('regions', [{'grid': [2, 3]}, {'roi': [[5, 0, 10, 10], [30, 10, 50, 50]]}])
+def test_stored_regions_reproduce_the_regions(regions):
+    data = half_white_png(0)
+    stored = server.count_white_pixels(data, None, regions)['regions']
+    spec = reanalyze.stored_regions(stored)
+    assert server.count_white_pixels(data, None, spec)['regions'] == stored
+    if 'grid' in regions:
+        assert spec == regions
+
+
+async def test_interrupted_run_resumes(db, monkeypatch):
+    await insert_outdated(db, 5)
+    info = reanalyze.logger.info
+    
+    class Interrupted(Exception):
+        pass
+    
+    def interrupt_after_first_batch(message):
+        if message.startswith('Re-analyzed'):
+            raise Interrupted
+        info(message)
+    
+    monkeypatch.setattr(reanalyze.logger, 'info', interrupt_after_first_batch)
+    with pytest.raises(Interrupted):
+        await reanalyze.reanalyze('white_pixel', batch_size=2, concurrency=2)
+    checkpoint = await reanalyze.load_checkpoint(TASK)
+    assert (checkpoint['changed'], checkpoint.get('completed')) == (2, None)
+    
+    monkeypatch.setattr(reanalyze.logger, 'info', info)
+    await reanalyze.reanalyze('white_pixel', batch_size=2, concurrency=2)
+    checkpoint = await reanalyze.load_checkpoint(TASK)
+    assert (checkpoint['completed'], checkpoint['changed'], checkpoint['failed']) == (True, 5, 0)
+    
+    async for doc in db.analyses.find():
+        index = int(doc['id'])
+        assert doc['analysis_version'] == server.WHITE_PIXEL_ANALYSIS_VERSION
+        assert doc['white_pixel_count'] == (20 + index) * 20
+        assert [previous['percentage'] for previous in doc['previous_versions']] == [90.0]
+    
+    # Finished runs are not repeated
+    await reanalyze.reanalyze('white_pixel', batch_size=2, concurrency=2)
+    assert (await reanalyze.load_checkpoint(TASK))['changed'] == 5
+
+
+async def test_changed_results_move_between_rollups(db):
+    await insert_outdated(db, 3)
+    key = '2026-01-01|white_pixel|'
+    assert (await db[server.ROLLUPS_COLLECTION].find_one({'_id': key}))['percentage_sum'] == 270.0
+    
+    await reanalyze.reanalyze('white_pixel', batch_size=10, concurrency=2)
+    rollup = await db[server.ROLLUPS_COLLECTION].find_one({'_id': key})
+    expected = sum(round((20 + index) * 20 / 800 * 100, 2) for index in range(3))
+    assert rollup['count'] == 3
+    assert rollup['percentage_sum'] == pytest.approx(expected)
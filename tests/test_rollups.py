@@ -0,0 +1,132 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import maintenance
+import server
+
+pytestmark = pytest.mark.anyio
+
+DAY = datetime(2026, 3, 2, 9, tzinfo=timezone.utc)
+
+# (condition, wash_or_repaint) as the model answered them
+RESULTS = [
+    ('Good', 'Wash'),
+    ('good - minor swirls', 'Wash and polish'),
+    ('Bad', 'Repaint'),
+    ('BAD', 'Wash, then repaint the bonnet'),
+    ('Bad', 'Wash'),
+    ('Unknown', 'Unknown'),
+    ('', ''),
+    ('Fair', 'Polish'),
+]
+
+
+def bonnet_doc(index: int, condition: str, action: str, timestamp=DAY, color='Red') -> dict:
+    return {
+        'id': f'b{index}', 'analysis_type': 'bonnet', 'timestamp': timestamp, 'car_color': color,
+        'condition': condition, 'wash_or_repaint': action
+    }
+
+
+def white_pixel_doc(index: int, percentage: float) -> dict:
+    return {'id': f'w{index}', 'analysis_type': 'white_pixel', 'timestamp': DAY, 'percentage': percentage}
+
+
+EXPECTED = {
+    'count': 8, 'good': 2, 'bad': 3, 'unknown_condition': 3,
+    'wash': 3, 'repaint': 2, 'unknown_action': 3, 'bad_and_repaint': 2
+}
+
+
+def counters(rollup: dict) -> dict:
+    return {counter: rollup[counter] for counter in EXPECTED}
+
+
+def without_trim(value):
+    """`value` with $trim, which mongomock does not implement, replaced by its input.
+
+    The incremental merge with `since` uses $merge, also missing from mongomock,
+    so only the full rebuild is tested.
+    """
+    if isinstance(value, dict):
+        if '$trim' in value:
+            return without_trim(value['$trim']['input'])
+        return {key: without_trim(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [without_trim(item) for item in value]
+    return value
+
+
+def test_only_explicit_answers_count():
+    totals = {}
+    for index, (condition, action) in enumerate(RESULTS):
+        for counter, value in server.rollup_increments(bonnet_doc(index, condition, action)).items():
+            totals[counter] = totals.get(counter, 0) + value
+    assert totals == EXPECTED
+
+
+async def test_update_rollups_folds_and_removes(db):
+    docs = [bonnet_doc(index, *result) for index, result in enumerate(RESULTS)]
+    await server.update_rollups(docs + [white_pixel_doc(0, 10.0), white_pixel_doc(1, 30.0)])
+    
+    rollup = await db[server.ROLLUPS_COLLECTION].find_one({'_id': '2026-03-02|bonnet|red'})
+    assert counters(rollup) == EXPECTED
+    white_pixel = await db[server.ROLLUPS_COLLECTION].find_one({'_id': '2026-03-02|white_pixel|'})
+    assert (white_pixel['count'], white_pixel['percentage_sum']) == (2, 40.0)
+    
+    await server.update_rollups(docs[:2], sign=-1)
+    rollup = await db[server.ROLLUPS_COLLECTION].find_one({'_id': '2026-03-02|bonnet|red'})
+    assert (rollup['count'], rollup['good'], rollup['wash']) == (6, 0, 1)
+
+
+async def test_rebuild_matches_incremental_rollups(db, monkeypatch):
+    aggregate = type(db.analyses).aggregate
+    monkeypatch.setattr(
+        type(db.analyses), 'aggregate',
+        lambda self, pipeline, **kwargs: aggregate(self, without_trim(pipeline), **kwargs)
+    )
+    docs = [bonnet_doc(index, *result) for index, result in enumerate(RESULTS)]
+    docs.append(bonnet_doc(99, 'Good', 'Wash', timestamp='2026-03-02T09:00:00'))
+    await db.analyses.insert_many(docs + [white_pixel_doc(0, 10.0)])
+    await server.update_rollups([doc for doc in docs + [white_pixel_doc(0, 10.0)] if doc['id'] != 'b99'])
+    incremental = {doc['_id']: doc async for doc in db[server.ROLLUPS_COLLECTION].find()}
+    
+    # Legacy string timestamps are left out of the rebuild
+    await maintenance.rebuild_rollups()
+    rebuilt = {doc['_id']: doc async for doc in db[server.ROLLUPS_COLLECTION].find()}
+    assert rebuilt.keys() == incremental.keys()
+    assert counters(rebuilt['2026-03-02|bonnet|red']) == EXPECTED
+    assert rebuilt['2026-03-02|white_pixel|']['percentage_sum'] == 10.0
+
+
+async def test_stats_endpoint(client):
+    docs = [bonnet_doc(index, *result) for index, result in enumerate(RESULTS)]
+    docs.append(bonnet_doc(50, 'Good', 'Wash', color='blue'))
+    docs.append(bonnet_doc(51, 'Bad', 'Repaint', timestamp=datetime(2026, 3, 5, tzinfo=timezone.utc)))
+    await server.update_rollups(docs + [white_pixel_doc(0, 10.0), white_pixel_doc(1, 30.0)])
+    
+    response = await client.get('/api/analysis/stats')
+    assert response.status_code == 200
+    buckets = response.json()['buckets']
+    assert [(bucket['day'], bucket['car_color']) for bucket in buckets] == [
+        ('2026-03-02', 'blue'), ('2026-03-02', 'red'), ('2026-03-05', 'red')
+    ]
+    red = buckets[1]
+    assert {counter: red[counter] for counter in EXPECTED} == EXPECTED
+    assert (red['good_pct'], red['unknown_condition_pct'], red['unknown_action_pct']) == (25.0, 37.5, 37.5)
+    
+    response = await client.get('/api/analysis/stats', params={'group_by': 'total', 'end': '2026-03-02'})
+    (total,) = response.json()['buckets']
+    assert (total['count'], total['good'], total['wash']) == (9, 3, 4)
+    
+    response = await client.get('/api/analysis/stats', params={'group_by': 'color', 'start': '2026-03-03'})
+    assert [(bucket['car_color'], bucket['bad']) for bucket in response.json()['buckets']] == [('red', 1)]
+    
+    response = await client.get('/api/analysis/stats', params={'analysis_type': 'white_pixel', 'group_by': 'day'})
+    assert response.json()['buckets'] == [
+        {'day': '2026-03-02', 'car_color': None, 'count': 2, 'mean_percentage': 20.0}
+    ]
+    
+    response = await client.get('/api/analysis/stats', params={'group_by': 'week'})
+    assert response.status_code == 422
@@ -0,0 +1,71 @@
+import hashlib
+import os
+from io import BytesIO
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def png(size=(64, 48)) -> bytes:
+    buffer = BytesIO()
+    Image.new('RGB', size, (255, 255, 255)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def upload_file(data: bytes, size=None) -> UploadFile:
+    return UploadFile(file=BytesIO(data), filename='upload.png', size=size)
+
+
+async def ingest_error(data: bytes, **limits) -> HTTPException:
+    with pytest.raises(HTTPException) as error:
+        await server.ingest_upload(upload_file(data), **limits)
+    return error.value
+
+
+async def test_accepted_upload():
+    data = png()
+    upload = await server.ingest_upload(upload_file(data))
+    assert (upload.format, upload.size, upload.path) == ('PNG', (64, 48), None)
+    assert upload.data == data
+    assert upload.digest == hashlib.sha256(data).hexdigest()
+
+
+async def test_size_limit():
+    data = png()
+    assert (await ingest_error(data, max_bytes=len(data) - 1)).status_code == 413
+    # A declared size over the limit is refused before reading
+    with pytest.raises(HTTPException) as error:
+        await server.ingest_upload(upload_file(b'', size=10 ** 9))
+    assert error.value.status_code == 413
+
+
+async def test_archive_limit_applies_only_to_archives():
+    data = png()
+    error = await ingest_error(data, allowed_formats=server.IMAGE_FORMATS | {'ZIP'}, max_bytes=10, archive_max_bytes=10 ** 6)
+    assert error.status_code == 413
+
+
+async def test_format_and_header_checks():
+    assert (await ingest_error(b'%PDF-1.7 not an image at all')).status_code == 415
+    assert (await ingest_error(png()[:30])).status_code == 400
+
+
+async def test_pixel_limit():
+    error = await ingest_error(png((100, 100)), max_pixels=99 * 99)
+    assert error.status_code == 413
+
+
+async def test_large_uploads_are_spooled_to_disk():
+    data = png((400, 300))
+    upload = await server.ingest_upload(upload_file(data), spool_bytes=100)
+    assert upload.data is None
+    assert open(upload.path, 'rb').read() == data
+    assert upload.source == upload.path
+    path = upload.path
+    upload.discard()
+    assert not os.path.exists(path)
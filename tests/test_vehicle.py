@@ -0,0 +1,88 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def panel_photo(color=(30, 60, 200), size=(160, 120)) -> bytes:
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue()
+
+
+async def post_vehicle(client, photos: dict, **params):
+    files = [('files', (name, data, 'image/jpeg')) for name, data in photos.items()]
+    return await client.post('/api/analyze/vehicle', params=params, files=files)
+
+
+def panel_result(condition='Good', action='Wash', color='Blue', issues=(), confidence=0.9) -> dict:
+    return {
+        'car_color': color, 'condition': condition, 'wash_or_repaint': action, 'issues': list(issues),
+        'recommendations': ['Regular washing recommended'], 'detailed_report': '', 'confidence': confidence
+    }
+
+
+def test_panel_results_are_combined():
+    vehicle = server.combine_panel_results(['bonnet', 'door', 'roof'], [
+        panel_result(),
+        panel_result('Bad', 'Repaint', issues=['Deep scratch'], confidence=0.6),
+        panel_result(color='Red', confidence=0.8),
+    ])
+    assert (vehicle['car_color'], vehicle['condition'], vehicle['wash_or_repaint']) == ('Blue', 'Bad', 'Repaint')
+    assert vehicle['issues'] == ['door: Deep scratch']
+    assert vehicle['recommendations'] == ['Regular washing recommended']
+    assert vehicle['detailed_report'] == '1 of 3 panels need work (door).'
+    assert vehicle['confidence'] == 0.6
+
+
+async def test_panels_are_stored_with_the_vehicle(client, db):
+    response = await post_vehicle(
+        client, {'front.jpg': panel_photo(), 'side.jpg': panel_photo()}, panels='bonnet, left door'
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert (body['car_color'], body['condition'], body['provider']) == ('Blue', 'Good', 'local')
+    assert [panel['panel'] for panel in body['panels']] == ['bonnet', 'left door']
+    
+    vehicle = await db.analyses.find_one({'id': body['id']})
+    assert 'panels' not in vehicle
+    assert vehicle['panel_ids'] == [panel['id'] for panel in body['panels']]
+    stored = await db.analyses.find({'vehicle_id': body['id']}).to_list(None)
+    assert sorted(panel['id'] for panel in stored) == sorted(vehicle['panel_ids'])
+    assert {panel['analysis_type'] for panel in stored} == {'panel'}
+
+
+async def test_panel_names_default_to_the_file_names(client, db):
+    response = await post_vehicle(client, {'bonnet.jpg': panel_photo(), 'roof.jpg': panel_photo()})
+    assert [panel['panel'] for panel in response.json()['panels']] == ['bonnet', 'roof']
+
+
+async def test_panel_limits(client, db, monkeypatch):
+    monkeypatch.setattr(server, 'VEHICLE_MAX_PANELS', 2)
+    photos = {f'{index}.jpg': panel_photo() for index in range(3)}
+    response = await post_vehicle(client, photos)
+    assert response.status_code == 413
+    
+    response = await post_vehicle(client, {'a.jpg': panel_photo(), 'b.jpg': panel_photo()}, panels='bonnet')
+    assert response.status_code == 400
+    assert await db.analyses.count_documents({}) == 0
+
+
+async def test_one_uncertain_panel_escalates_the_whole_vehicle(client, stub_model, monkeypatch):
+    monkeypatch.setattr(server.vision_router, 'mode', 'tiered')
+    monkeypatch.setattr(server.vision_router, 'threshold', 0.5)
+    
+    response = await post_vehicle(client, {'bonnet.jpg': panel_photo(), 'roof.jpg': panel_photo()})
+    assert response.json()['provider'] == 'local'
+    assert stub_model.calls == 0
+    
+    # Too small to assess locally, so its confidence is zero
+    response = await post_vehicle(client, {'bonnet.jpg': panel_photo(), 'roof.jpg': panel_photo(size=(8, 8))})
+    body = response.json()
+    assert stub_model.calls == 1
+    assert (body['provider'], body['car_color']) == ('remote', 'Red')
+    assert [panel['provider'] for panel in body['panels']] == ['remote', 'remote']
@@ -0,0 +1,159 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def baseline_count(data: bytes) -> dict:
+    """The original per-pixel count the vectorized engine replaced"""
+    image = Image.open(BytesIO(data)).convert('RGB')
+    pixels = list(image.getdata())
+    white = sum(1 for r, g, b in pixels if r > 240 and g > 240 and b > 240)
+    return {'white_pixel_count': white, 'total_pixels': len(pixels), 'percentage': round(white / len(pixels) * 100, 2)}
+
+
+def encode(image: Image.Image, format: str, **params) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format, **params)
+    return buffer.getvalue()
+
+
+def sample_image(mode: str, size=(97, 61), seed=0) -> Image.Image:
+    """Noise around the threshold with a white block, in `mode`"""
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(225, 256, (size[1], size[0], 4), dtype=np.uint8)
+    pixels[5:25, 10:40] = 255
+    pixels[40:, :30] = rng.integers(0, 256, (size[1] - 40, 30, 4), dtype=np.uint8)
+    image = Image.fromarray(pixels, 'RGBA')
+    if mode == 'P':
+        return image.convert('RGB').quantize(64)
+    return image.convert(mode)
+
+
+CASES = [
+    ('RGB', 'PNG', {}),
+    ('RGBA', 'PNG', {}),
+    ('L', 'PNG', {}),
+    ('LA', 'PNG', {}),
+    ('P', 'PNG', {}),
+    ('1', 'PNG', {}),
+    ('RGB', 'JPEG', {'quality': 90}),
+    ('L', 'JPEG', {}),
+    ('RGB', 'BMP', {}),
+    ('L', 'BMP', {}),
+    ('RGB', 'TIFF', {}),
+    ('RGBA', 'TIFF', {}),
+    ('RGB', 'TIFF', {'compression': 'tiff_deflate'}),
+    ('RGB', 'WEBP', {'lossless': True}),
+    ('RGB', 'GIF', {}),
+]
+
+
+@pytest.mark.parametrize('mode, format, params', CASES)
+def test_counts_match_baseline(mode, format, params):
+    data = encode(sample_image(mode), format, **params)
+    assert server.count_white_pixels(data) == baseline_count(data)
+
+
+@pytest.mark.parametrize('mode, format, params', [case for case in CASES if case[1] in ('PNG', 'BMP', 'TIFF')])
+def test_strip_counts_match_baseline(monkeypatch, tmp_path, mode, format, params):
+    # A budget of a few rows forces strip-by-strip reading, from bytes and from a file
+    monkeypatch.setattr(server, 'TILE_MEMORY_BUDGET_BYTES', 97 * 4 * 3)
+    data = encode(sample_image(mode), format, **params)
+    path = tmp_path / f'image.{format.lower()}'
+    path.write_bytes(data)
+    if params.get('compression'):
+        # Compressed TIFF strips can't be read in place
+        with pytest.raises(HTTPException) as error:
+            server.count_white_pixels(data)
+        assert error.value.status_code == 413
+        return
+    assert server.count_white_pixels(data) == baseline_count(data)
+    assert server.count_white_pixels(str(path)) == baseline_count(data)
+
+
+def test_large_jpeg_needs_approximate(monkeypatch):
+    image = Image.new('RGB', (640, 480), (255, 255, 255))
+    image.paste((0, 0, 0), (0, 0, 320, 480))
+    data = encode(image, 'JPEG', quality=95)
+    # Half the budget holds a 1/2 scale frame but not the full one
+    monkeypatch.setattr(server, 'TILE_MEMORY_BUDGET_BYTES', 640 * 480 * 2)
+    with pytest.raises(HTTPException) as error:
+        server.count_white_pixels(data)
+    assert error.value.status_code == 413
+    
+    result = server.count_white_pixels(data, approximate=True)
+    assert result['sample_scale'] == 2
+    assert result['total_pixels'] == 640 * 480
+    assert abs(result['percentage'] - 50) < 1
+
+
+def test_pil_limit_is_raised_only_while_opening_large_images(monkeypatch):
+    assert Image.MAX_IMAGE_PIXELS == server.PIL_MAX_IMAGE_PIXELS
+    with server.pil_pixel_limit(server.MAX_TILED_IMAGE_PIXELS):
+        with server.pil_pixel_limit(server.PIL_MAX_IMAGE_PIXELS * 2):
+            assert Image.MAX_IMAGE_PIXELS == server.MAX_TILED_IMAGE_PIXELS
+        assert Image.MAX_IMAGE_PIXELS == server.MAX_TILED_IMAGE_PIXELS
+    assert Image.MAX_IMAGE_PIXELS == server.PIL_MAX_IMAGE_PIXELS
+    
+    # A header past PIL's default is still read for white pixel analysis
+    data = encode(sample_image('RGB'), 'PNG')
+    expected = baseline_count(data)
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000)
+    monkeypatch.setattr(server, 'PIL_MAX_IMAGE_PIXELS', 1000)
+    with pytest.raises(Image.DecompressionBombError):
+        server.read_image_header(data, 1000)
+    assert server.read_image_header(data, server.MAX_TILED_IMAGE_PIXELS) == (97, 61)
+    # Strips stay far below the default, only opening needs the raised limit
+    monkeypatch.setattr(server, 'TILE_MEMORY_BUDGET_BYTES', 97 * server.STRIP_BYTES_PER_PIXEL * 10)
+    assert server.count_white_pixels(data) == expected
+    assert Image.MAX_IMAGE_PIXELS == 1000
+
+
+def test_thresholds_and_regions():
+    image = Image.new('RGB', (40, 20), (0, 0, 0))
+    image.paste((250, 250, 250), (0, 0, 20, 20))
+    image.paste((230, 230, 230), (20, 0, 30, 20))
+    result = server.count_white_pixels(encode(image, 'PNG'), [220, 240], {'grid': [1, 2]})
+    assert result['white_pixel_count'] == 400
+    assert [count['white_pixel_count'] for count in result['thresholds']] == [600, 400]
+    left, right = result['regions']
+    assert [count['white_pixel_count'] for count in left['counts']] == [400, 400]
+    assert [count['white_pixel_count'] for count in right['counts']] == [200, 0]
+    
+    # ROI boxes are clipped to the image
+    result = server.count_white_pixels(encode(image, 'PNG'), [220], server.parse_regions(None, '15,0,10,20;35,10,50,50'))
+    first, second = result['regions']
+    assert (first['region'], first['counts'][0]['white_pixel_count']) == ('roi0', 200)
+    assert (second['box'], second['total_pixels'], second['counts'][0]['white_pixel_count']) == ([35, 10, 40, 20], 50, 0)
+
+
+def test_invalid_region_specs_are_rejected():
+    for grid, roi in [('3x4', '0,0,1,1'), ('0x2', None), (None, '1,2,3'), (None, '0,0,0,5')]:
+        with pytest.raises(HTTPException) as error:
+            server.parse_regions(grid, roi)
+        assert error.value.status_code == 400
+
+
+async def test_endpoint_matches_baseline(client):
+    data = encode(sample_image('RGB', (300, 200), seed=3), 'PNG')
+    response = await client.post('/api/analyze/white-pixels', files={'file': ('panel.png', data, 'image/png')})
+    assert response.status_code == 200
+    body = response.json()
+    expected = baseline_count(data)
+    assert {key: body[key] for key in expected} == expected
+    assert body['image_digest']
+    
+    stored = await client.get(f"/api/analysis/{body['id']}")
+    assert stored.json()['white_pixel_count'] == expected['white_pixel_count']
+
+
+async def test_endpoint_rejects_non_images(client):
+    response = await client.post('/api/analyze/white-pixels', files={'file': ('notes.txt', b'not an image', 'text/plain')})
+    assert response.status_code in (400, 415)